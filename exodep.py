@@ -26,117 +26,1095 @@
 #
 #     https://github.com/codalogic/exodep
 
-import argparse
 import sys
 import re
 import io
 import os
-import urllib.request
-import tempfile
-import shutil
-import filecmp
 import glob
+import time
+import threading
 
 host_templates = {
         'github': 'https://raw.githubusercontent.com/${owner}/${project}/${strand}/${path}${file}',
         'gitlab': 'https://gitlab.com/${owner}/${project}/raw/${strand}/${path}${file}',
         'bitbucket': 'https://bitbucket.org/${owner}/${project}/raw/${strand}/${path}${file}',
-        'local': '${path}${file}' }
+        'local': '${path}${file}',
+        'git': 'git:${gitroot}${owner}/${project}.git@${strand}:${path}${file}' }
 
 onstop_exodep = 'exodep-imports/__onstop.exodep'
 
-default_vars = { 'strand': 'master', 'path': '' }
+check_skipped_commands = [ 'mv', 'rm', 'rmdir', 'mkdir', 'touch', 'exec', 'exec&', 'execwait', 'execmemo', 'alertstofile' ]
+
+not_modified = '<not modified>'    # Returned instead of a temp file name when a conditional request finds a file unchanged
 
-exodep_file_set = {}
+default_vars = { 'strand': 'master', 'path': '' }
 
 class StopException( Exception ):
     pass
 
 def main():
-    args = process_command_line_args()
-    collect_exodep_file_set()
-    run( args )
-
-def process_command_line_args():
+    if len( sys.argv ) > 1 and sys.argv[1] == 'serve':
+        serve( process_serve_command_line_args( sys.argv[2:] ) )
+        return
+    if len( sys.argv ) > 1 and sys.argv[1] == 'bundle':
+        args = process_bundle_command_line_args( sys.argv[2:] )
+    else:
+        args = process_command_line_args()
+    result = run( args )
+    if result and (result.incomplete or (args.check and result.stale())):   # Only --check reports being out of date as a failure
+        sys.exit( 1 )
+
+def process_command_line_args( argv = None ):
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument( "recipe", nargs="?", default=None, help="An exodep file to be processed" )
     parser.add_argument( "-p", "--pause", help="pause after execution", action="store_true" )
-    return parser.parse_args()
-
-def collect_exodep_file_set( dir = 'exodep-imports' ):
-    for file in glob.glob( dir + '/*.exodep' ):
-        exodep_file_set[os.path.basename(file)] = 1
-    for subdir in glob.glob( dir + '/*' ):
-        subdir = subdir.replace( '\\', '/' )
-        if os.path.isdir( subdir ):
-            collect_exodep_file_set( subdir )
+    parser.add_argument( "--roots", nargs="+", metavar="DIR", help="process each of the project root directories in turn" )
+    parser.add_argument( "--roots-file", metavar="FILE", help="file listing project root directories to process, one per line" )
+    parser.add_argument( "--watch", help="keep running, re-processing exodep files affected by changes", action="store_true" )
+    parser.add_argument( "--watch-interval", type=float, default=1.0, metavar="SECONDS", help="how often to poll for changes in watch mode" )
+    parser.add_argument( "--trace", metavar="FILE", help="write a Chrome trace-event format timing trace to FILE" )
+    parser.add_argument( "--events", metavar="FILE", help="write an NDJSON event for each action to FILE" )
+    parser.add_argument( "--prometheus", metavar="FILE", help="write end-of-run metrics to FILE in Prometheus textfile format" )
+    parser.add_argument( "--depfile", metavar="FILE", help="write a Make/Ninja depfile listing the inputs behind each destination to FILE" )
+    parser.add_argument( "--changed-list", metavar="FILE", help="write the files created, updated or removed by the run to FILE" )
+    parser.add_argument( "--timeout", type=float, default=60.0, metavar="SECONDS", help="connect and read timeout for each network request" )
+    parser.add_argument( "--deadline", type=float, metavar="SECONDS", help="stop starting new work once the run has taken SECONDS" )
+    parser.add_argument( "--hedge", type=float, metavar="PERCENTILE", help="send a duplicate request if the first byte has not arrived within this percentile of observed latency" )
+    parser.add_argument( "--check", help="report destinations that are out of date, without changing anything", action="store_true" )
+    parser.add_argument( "--parallel", help="process the recipes in exodep-imports concurrently, in the order given by their 'uses' and 'include' commands", action="store_true" )
+    parser.add_argument( "--fetch-uses", help="fetch recipes named by 'uses' commands that are missing from exodep-imports", action="store_true" )
+    parser.add_argument( "--proxy", metavar="URI", help="fetch remote files through an 'exodep.py serve' caching proxy at URI" )
+    parser.add_argument( "--jobs", type=int, default=4, metavar="N", help="maximum number of downloads to run at the same time" )
+    parser.add_argument( "--host-limit", type=host_setting, action="append", metavar="[HOST=]N", help="maximum number of concurrent downloads from HOST (or any host)" )
+    parser.add_argument( "--host-rate", type=host_setting, action="append", metavar="[HOST=]N", help="maximum number of requests per second to HOST (or any host)" )
+    parser.add_argument( "--state", metavar="FILE",
+                            help="file to keep information between runs in, such as download sizes (default: a file for the current directory in the cache directory)" )
+    parser.add_argument( "--no-state", help="do not keep information between runs", action="store_true" )
+    parser.add_argument( "--link", choices=[ 'copy', 'hardlink', 'reflink', 'symlink' ], default='copy',
+                            help="how downloaded files are installed from the shared cache (default: copy)" )
+    parser.add_argument( "--force-link", action="store_true",
+                            help="use --link hardlink or symlink even when running as root, which can write through links into the cache" )
+    parser.add_argument( "--cache-dir", metavar="DIR",
+                            help="directory for the content-addressed cache used by --link, the state file and staged downloads (default: ~/.cache/exodep)" )
+    parser.add_argument( "--bundle", metavar="FILE", help="satisfy all remote fetches from a bundle made by 'exodep.py bundle create', without network access" )
+    parser.add_argument( "--staging-dir", metavar="DIR",
+                            help="directory to keep downloads in until the run completes, so that an interrupted run can be resumed " +
+                                    "(default: a directory for the current directory in the cache directory)" )
+    parser.add_argument( "--no-journal", help="do not keep a journal for resuming interrupted runs", action="store_true" )
+    parser.add_argument( "--fingerprint-ttl", type=float, metavar="SECONDS", help="skip the run if no local inputs or destinations have changed since a run less than SECONDS ago" )
+    output_level = parser.add_mutually_exclusive_group()
+    output_level.add_argument( "-q", "--quiet", dest="verbosity", action="store_const", const="quiet", help="only report errors and alerts" )
+    output_level.add_argument( "--summary", dest="verbosity", action="store_const", const="summary", help="replace per-file lines with an end-of-run summary" )
+    output_level.add_argument( "-v", "--verbose", dest="verbosity", action="store_const", const="verbose", help="also report versions, authority and exec timings and a summary" )
+    parser.set_defaults( verbosity="normal", bundle_create=None )
+    args = parser.parse_args( argv )
+    if args.watch and (args.roots or args.roots_file):
+        parser.error( "--watch can not be used with multiple project roots" )
+    return args
+
+def process_bundle_command_line_args( argv ):
+    # exodep.py bundle create <bundle file> [<exodep arguments>]
+    if len( argv ) < 2 or argv[0] != 'create':
+        print( "Usage: exodep.py bundle create <bundle file> [<exodep arguments>]" )
+        sys.exit( 2 )
+    args = process_command_line_args( argv[2:] )
+    args.bundle_create = argv[1]
+    return args
+
+def host_setting( text ):
+    # Parses settings of the form '[HOST=]N', returning (None, N) when no host is given
+    import argparse
+    host, sep, value = text.rpartition( '=' )
+    try:
+        value = float( value )
+    except ValueError:
+        raise argparse.ArgumentTypeError( "invalid value: " + text )
+    if value <= 0:     # A limit of 0 would never let a download start
+        raise argparse.ArgumentTypeError( "value must be greater than 0: " + text )
+    return (host if sep else None, value)
 
 def run( args ):
+    cache_dir = args.cache_dir if args.cache_dir else default_cache_dir()
+    state_file = os.path.abspath( args.state ) if args.state else project_cache_path( cache_dir, 'state' ) + '.json'
+    staging_dir = os.path.abspath( args.staging_dir ) if args.staging_dir else project_cache_path( cache_dir, 'staging' )
+    # A run skipped by its fingerprint doesn't find the exodep files, so watch mode always does a full first run
+    session = Session( output=Console(), trace_file=args.trace, events_file=args.events, prometheus_file=args.prometheus,
+                        verbosity=args.verbosity, timeout=args.timeout, deadline=args.deadline, hedge=args.hedge,
+                        jobs=args.jobs, host_limits=dict( args.host_limit or [] ), host_rates=dict( args.host_rate or [] ),
+                        state_file=None if args.no_state else state_file, proxy=args.proxy,
+                        check=args.check, fetch_uses=args.fetch_uses, parallel=args.parallel,
+                        fingerprint_ttl=None if args.watch else args.fingerprint_ttl,
+                        link=args.link, force_link=args.force_link, cache_dir=cache_dir, bundle=args.bundle, bundle_create=args.bundle_create,
+                        staging_dir=None if args.no_journal else staging_dir )
     try:
-        if args.recipe:
-            ProcessDeps( args.recipe )
-        elif os.path.isfile( 'mydeps.exodep' ):
-            ProcessDeps( 'mydeps.exodep' )
-        elif os.path.isfile( 'exodep-imports/mydeps.exodep' ):
-            ProcessDeps( 'exodep-imports/mydeps.exodep' )
+        roots = collect_roots( args, session )
+        if roots == []:
+            sys.exit( 1 )   # The current directory is never processed in place of the roots asked for
+        result = session.run( args.recipe, roots )
+        if args.depfile:
+            try:
+                write_depfile( args.depfile, result )
+            except OSError:
+                session.report_error( "Unable to write depfile: " + args.depfile )
+        if args.changed_list:
+            try:
+                write_changed_list( args.changed_list, result )
+            except OSError:
+                session.report_error( "Unable to write changed list: " + args.changed_list )
+        if not result.is_stopped:
+            if args.watch:
+                session.watch( args.watch_interval )
+            if args.pause:
+                session.pause()
+        return result
+    finally:
+        session.close()
+
+def default_cache_dir():
+    return os.path.join( os.environ.get( 'XDG_CACHE_HOME' ) or os.path.join( os.path.expanduser( '~' ), '.cache' ), 'exodep' )
+
+def project_cache_path( cache_dir, kind ):
+    # Files that exodep keeps for a project are kept in the cache directory, named for the directory exodep
+    # is run in, rather than in the project itself
+    import hashlib
+    return os.path.join( cache_dir, kind, hashlib.sha256( os.getcwd().encode( 'utf-8' ) ).hexdigest()[:16] )
+
+def collect_roots( args, session ):
+    # Returns None if no roots were given, and an empty list if the roots file can't be used
+    roots = list( args.roots ) if args.roots else None
+    if args.roots_file:
+        roots = roots if roots else []
+        try:
+            roots_file_dir = os.path.dirname( args.roots_file )
+            with open( args.roots_file ) as fin:
+                for line in fin:
+                    line = remove_comments( line )
+                    if not is_blank_line( line ):
+                        roots.append( os.path.join( roots_file_dir, line.strip() ).replace( '\\', '/' ) )
+        except OSError:
+            session.report_error( "Unable to open roots file: " + args.roots_file )
+            return []
+        if not roots:
+            session.report_error( "No project root directories listed in roots file: " + args.roots_file )
+    return roots
+
+def find_commands( file, name ):
+    # Returns (<arguments>, <line number>) for each name command in file, which may also be an io.StringIO object
+    uses = []
+    try:
+        with (io.StringIO( file.getvalue() ) if isinstance( file, io.StringIO ) else open( file )) as fin:
+            for line_num, line in enumerate( fin, 1 ):
+                line = remove_comments( line.strip() )
+                if not is_blank_line( line ):
+                    command, arguments = split_in_2( line )
+                    if command == name and arguments != None:
+                        uses.append( (arguments, line_num) )
+    except OSError:
+        pass
+    return uses
+
+def make_fingerprint( files ):
+    import hashlib
+    import json
+    # Directories are represented by the names of the files within them, and files by their size and modification time
+    signatures = []
+    for file in files:
+        if os.path.isdir( file ):
+            signatures.append( [ file, sorted( os.path.relpath( os.path.join( dirpath, name ), file )
+                                                for dirpath, dirnames, filenames in os.walk( file ) for name in filenames ) ] )
         else:
-            process_globbed_exodep_imports( 'exodep-imports', default_vars )
+            try:
+                stat = os.stat( file )
+                signatures.append( [ file, stat.st_size, stat.st_mtime_ns ] )
+            except OSError:
+                signatures.append( [ file, None ] )
+    return hashlib.sha256( json.dumps( signatures ).encode( 'utf-8' ) ).hexdigest()
 
-        if args.pause:
-            pause()
+def is_ignored_glob( file ):
+    return file.find( '/__' ) >= 0 or file.find( '/^' ) >= 0;
 
-    except StopException:
-        pass
+class Session:
+    # A Session owns all the state of exodep runs, so that exodep can be embedded in other Python
+    # programs and run more than once in the same process.  Output is passed to the output function,
+    # if any, and the outcome of each run is returned as a SessionResult.
+    verbosity_levels = [ 'quiet', 'summary', 'normal', 'verbose' ]
+
+    hedge_min_samples = 5       # Number of request latencies that must be observed before requests are hedged
+    hedge_max_samples = 100
+
+    def __init__( self, output = None, trace_file = None, events_file = None, prometheus_file = None, verbosity = 'normal',
+                    timeout = 60.0, deadline = None, hedge = None, jobs = 4, host_limits = None, host_rates = None, state_file = None,
+                    proxy = None, check = False, fetch_uses = False, parallel = False, fingerprint_ttl = None, link = 'copy',
+                    force_link = False, cache_dir = None, bundle = None, bundle_create = None, staging_dir = None ):
+        self.output = output
+        self.verbosity = verbosity
+        self.timeout = timeout
+        self.deadline = deadline
+        self.hedge = hedge
+        self.deadline_time = None
+        self.is_deadline_reported = False
+        self.request_latencies = []
+        self.scheduler = DownloadScheduler( self, jobs, host_limits, host_rates )
+        self.state = StateStore( state_file ) if state_file else None
+        self.proxy = proxy
+        self.check = check
+        self.fetch_uses = fetch_uses
+        self.parallel = parallel
+        self.fingerprint_ttl = fingerprint_ttl
+        self.link = link
+        if link in [ 'hardlink', 'symlink' ] and not force_link and is_superuser():
+            # Read-only cached files don't stop root from editing them through a link, which would affect every project using them
+            self.print_urgent( "Warning: --link " + link + " is not used when running as root, files are copied instead (use --force-link to override)" )
+            self.link = 'copy'
+        self.journal = RunJournal( staging_dir ) if staging_dir else None
+        self.bundle = BundleReader( bundle ) if bundle else None
+        self.bundle_writer = BundleWriter( bundle_create ) if bundle_create else None
+        self.content_cache = ContentCache( cache_dir if cache_dir else default_cache_dir() )
+        self.input_files = set()        # Absolute names of the local files read by the run, whether or not they exist
+        self.git_repos = GitRepos()
+        self.response_validators = {}   # Each entry is <uri> : (<ETag>, <Last-Modified>) of the last response for the uri
+        self.trace_file = trace_file
+        self.prometheus_file = prometheus_file
+        self.tracer = Tracer() if trace_file else None
+        self.metrics = None
+        self.lock = threading.Lock()
+        self.results = SessionResult()
+        self.setup_errors = []          # Errors setting up the session, which are included in the results of each run
+        if events_file or prometheus_file:
+            try:
+                self.metrics = Metrics( events_file )
+            except OSError:
+                self.metrics = Metrics()
+                self.setup_errors.append( "Unable to open events file: " + events_file )
+                self.report_error( self.setup_errors[-1] )
+        self.versions_cache = {}        # Each entry is <versions uri> : <versions dict>, shared between project roots
+        self.processed_downloads = {}
+        self.fetched_files = {}         # Each entry is (<handler command>, <uri>) : <temp file holding the fetched body>
+        self.background_execs = []
+        self.root = None
+        self.reset_project_state()
+
+    def reset_project_state( self ):
+        self.exodep_file_set = {}
+        # Records of how exodep files were processed, so that watch mode can work out what to re-run
+        self.globbed_dir_vars = {}      # Each entry is <globbed dir> : <vars passed into the dir before its __init.exodep>
+        self.recipe_vars = {}           # Each entry is <top-level exodep file> : <vars it was processed with>
+        self.exodep_includers = {}      # Each entry is <included or read file> : <set of exodep files that read it>
+        self.processed_configs = {}
+        self.are_any_files_changed = False
+        self.alert_messages = ""
+        self.shown_alert_messages = ""
+
+    def run( self, recipe = None, roots = None ):
+        start = time.perf_counter()
+        self.results = SessionResult()
+        self.results.errors.extend( self.setup_errors )
+        self.versions_cache = {}
+        self.processed_downloads = {}
+        self.git_repos.reset()
+        self.input_files = set()
+        self.deadline_time = start + self.deadline if self.deadline != None else None
+        self.is_deadline_reported = False
+        run_key = self.find_run_key( recipe, roots )
+        if run_key and self.is_run_unchanged( run_key ):
+            self.results.is_unchanged = True
+            self.results.inputs = self.state.get( 'runs' )[run_key].get( 'inputs', {} )   # So that a depfile is written the same as before
+            self.print_action( 'Unchanged.', "Nothing has changed since the last run" )
+            self.flush_output()
+            return self.results
+        if self.journal:
+            self.journal.open()
+        is_completed = False
+        try:
+            if roots != None:    # An empty list of roots processes nothing, rather than the current directory
+                self.process_roots( roots, recipe )
+            else:
+                self.reset_project_state()
+                self.process_project( recipe )
+            is_completed = True
+        except StopException:
+            self.results.is_stopped = True
+            is_completed = True
+        finally:
+            if is_completed or not self.journal:
+                self.discard_fetched_files()
+                if self.journal:
+                    self.journal.complete()
+            else:
+                self.fetched_files = {}     # Interrupted, so the fetched files are kept for the next run to resume from
+        if run_key and self.is_fingerprintable_run():
+            self.record_run_fingerprint( run_key, roots )
+        if self.check:
+            self.print_check_report()
+        if self.results.incomplete:
+            self.print_urgent( "DEADLINE: " + str( len( self.results.incomplete ) ) + " commands were not completed:" )
+            for incomplete in self.results.incomplete:
+                self.print_urgent( "      ", incomplete )
+        if self.verbosity in [ 'summary', 'verbose' ]:
+            self.print_summary( time.perf_counter() - start )
+        self.flush_output()
+        return self.results
+
+    def find_run_key( self, recipe, roots ):
+        # Runs are fingerprinted by where they were run from and what they were asked to process
+        if not self.fingerprint_ttl or not self.state or self.check or self.bundle_writer or isinstance( recipe, io.StringIO ):
+            return None
+        return '\n'.join( [ os.getcwd(), recipe if recipe else '' ] + list( roots if roots else [] ) )
+
+    def is_run_unchanged( self, run_key ):
+        # A stat sweep of the files the previous run read and wrote.  Remote content is assumed to be
+        # unchanged until fingerprint_ttl seconds after the previous run.
+        record = self.state.get( 'runs' ).get( run_key )
+        if not record or time.time() - record['time'] > self.fingerprint_ttl:
+            return False
+        return make_fingerprint( record['files'] ) == record['fingerprint']
+
+    def is_fingerprintable_run( self ):
+        # Runs that didn't complete cleanly are repeated in full next time
+        return not (self.results.errors or self.results.alerts or self.results.incomplete or self.results.is_stopped)
+
+    def record_run_fingerprint( self, run_key, roots ):
+        files = set( self.input_files )
+        for root in (roots if roots != None else [ '.' ]):
+            files.add( os.path.abspath( os.path.join( root, 'exodep-imports' ) ) )     # So that new exodep files are noticed
+        for action in self.results.actions:
+            if action['dst']:
+                files.add( os.path.abspath( action['dst'] ) )
+        for inputs in self.results.inputs.values():
+            files.update( os.path.abspath( input ) for input in inputs )
+        files = sorted( files )
+        self.state.set( 'runs', run_key, { 'time': time.time(), 'files': files, 'fingerprint': make_fingerprint( files ),
+                                            'inputs': self.results.inputs } )
+
+    def make_temp_file( self, mode, **kwargs ):
+        import tempfile
+        # With a journal, temp files are made in the staging directory, so that any left by an interrupted run can be found
+        if self.journal:
+            return self.journal.make_temp_file( mode, **kwargs )
+        return tempfile.NamedTemporaryFile( mode=mode, delete=False, **kwargs )
+
+    def install_file( self, tmp_name, to_file ):
+        import shutil
+        # Other than for 'copy', the file is added to the content-addressed cache, and the destination is linked to it
+        if self.link == 'copy':
+            shutil.move( tmp_name, to_file )
+            return
+        method = self.content_cache.install( self.content_cache.add( tmp_name ), to_file, self.link )
+        if method != self.link:
+            self.print_verbose( 'Fallback..', to_file, "(" + self.link + " not supported, used " + method + ")" )
+
+    def note_input_file( self, file ):
+        with self.lock:
+            self.input_files.add( os.path.abspath( file ) )
+
+    def close( self ):
+        if self.bundle_writer:
+            self.bundle_writer.write()
+            self.print_action( 'Bundled...', self.bundle_writer.file, "(" + str( len( self.bundle_writer.objects ) ) + " resources)" )
+            self.bundle_writer = None
+        if self.bundle:
+            self.bundle.close()
+        self.flush_output()
+        self.discard_fetched_files()
+        self.git_repos.close()
+        if self.state and not self.check:
+            try:
+                self.state.save()
+            except OSError:
+                self.report_error( "Unable to write state file: " + self.state.file )
+        if self.tracer:
+            try:
+                self.tracer.write( self.trace_file )
+            except OSError:
+                self.report_error( "Unable to write trace file: " + self.trace_file )
+        if self.metrics:
+            self.metrics.close()
+            if self.prometheus_file:
+                try:
+                    self.metrics.write_prometheus( self.prometheus_file )
+                except OSError:
+                    self.report_error( "Unable to write Prometheus metrics file: " + self.prometheus_file )
 
-def process_globbed_exodep_imports( dir, vars ):
-    init_exodep = dir + '/__init.exodep'
-    end_exodep = dir + '/__end.exodep'
-    pause_exodep = dir + '/__pause.exodep'
-    if os.path.isfile( init_exodep ):
-        pd = ProcessDeps( init_exodep, vars )
-        vars = pd.get_vars()
-    for file in glob.glob( dir + '/*.exodep' ):
-        file = file.replace( '\\', '/' )
-        if not is_ignored_glob( file ):
-            ProcessDeps( file, vars )
-    for subdir in glob.glob( dir + '/*' ):
-        subdir = subdir.replace( '\\', '/' )
-        if os.path.isdir( subdir ):
-            process_globbed_exodep_imports( subdir, vars )
-    if os.path.isfile( end_exodep ):
-        ProcessDeps( end_exodep, vars )
-    if os.path.isfile( pause_exodep ):
-        pause()
+    def __enter__( self ):
+        return self
 
-def is_ignored_glob( file ):
-    return file.find( '/__' ) >= 0 or file.find( '/^' ) >= 0;
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+        return False
 
-class ProcessDeps:
-    are_any_files_changed = False
-    alert_messages = ""
-    shown_alert_messages = ""
+    def print( self, *args ):
+        if self.is_shown( 'summary' ):
+            self.write_output( args )
+
+    def print_action( self, *args ):
+        # Per-file lines, which are collapsed into the end-of-run summary unless normal or verbose output is selected
+        if self.is_shown( 'normal' ):
+            self.write_output( args )
+
+    def print_verbose( self, *args ):
+        if self.is_shown( 'verbose' ):
+            self.write_output( args )
+
+    def print_urgent( self, *args ):
+        # Errors and alerts are always shown, and are not held back by any output buffering
+        self.write_output( args )
+        self.flush_output()
+
+    def is_shown( self, level ):
+        return Session.verbosity_levels.index( self.verbosity ) >= Session.verbosity_levels.index( level )
+
+    def write_output( self, args ):
+        if self.output:
+            self.output( ' '.join( str( arg ) for arg in args ) )
+
+    def flush_output( self ):
+        if hasattr( self.output, 'flush' ):
+            self.output.flush()
+
+    def show_progress( self ):
+        if self.verbosity == 'summary' and hasattr( self.output, 'progress' ):
+            actions = self.results.actions
+            self.output.progress( str( len( actions ) ) + " actions, " + str( len( self.results.changed() ) ) + " changed: " +
+                                    str( actions[-1]['dst'] or actions[-1]['uri'] ) )
+
+    def print_summary( self, wall ):
+        outcomes = {}
+        durations = {}
+        queue_wait = transfer = 0
+        for action in self.results.actions:
+            outcomes[action['outcome']] = outcomes.get( action['outcome'], 0 ) + 1
+            durations[action['command']] = durations.get( action['command'], 0 ) + action['duration']
+            queue_wait += action.get( 'queue_wait', 0 )
+            transfer += action.get( 'transfer', 0 )
+        counts = [str( outcomes[outcome] ) + " " + outcome for outcome in [ 'created', 'updated', 'same', 'repeat', 'copied', 'moved', 'pruned' ] if outcome in outcomes]
+        counts.append( str( len( self.results.errors ) ) + " errors" )
+        counts.append( str( len( self.results.alerts ) ) + " alerts" )
+        self.write_output( [ 'Summary...', ', '.join( counts ), "in " + format( wall, '.2f' ) + "s" ] )
+        if durations:
+            self.write_output( [ 'Timings...', ', '.join( command + " " + format( durations[command], '.2f' ) + "s" for command in sorted( durations ) ) ] )
+        if transfer:
+            self.write_output( [ 'Downloads.', "queue wait " + format( queue_wait, '.2f' ) + "s, transfer " + format( transfer, '.2f' ) + "s" ] )
+        self.flush_output()
+
+    def print_check_report( self ):
+        stale = self.results.stale()
+        n_checked = len( [action for action in self.results.actions if action['outcome'] in [ 'same', 'stale', 'different' ]] )
+        self.print_urgent( "CHECK: " + str( len( stale ) ) + " of " + str( n_checked ) + " destinations are out of date, " +
+                            str( self.results.bytes_avoided ) + " bytes not transferred" )
+        for dst in stale:
+            self.print_urgent( "      ", dst )
+
+    def pause( self, message = None ):
+        self.flush_output()
+        pause( message )
+
+    def collect_exodep_file_set( self, dir = 'exodep-imports' ):
+        for file in glob.glob( dir + '/*.exodep' ):
+            self.exodep_file_set[os.path.basename(file)] = 1
+        for subdir in glob.glob( dir + '/*' ):
+            subdir = subdir.replace( '\\', '/' )
+            if os.path.isdir( subdir ):
+                self.collect_exodep_file_set( subdir )
+
+    def process_project( self, recipe ):
+        imports_dir = self.root_relative( 'exodep-imports' )
+        self.collect_exodep_file_set( imports_dir )
+        self.note_input_file( self.root_relative( 'mydeps.exodep' ) )
+        self.note_input_file( imports_dir + '/mydeps.exodep' )
+        if not recipe:
+            if os.path.isfile( self.root_relative( 'mydeps.exodep' ) ):
+                recipe = self.root_relative( 'mydeps.exodep' )
+            elif os.path.isfile( imports_dir + '/mydeps.exodep' ):
+                recipe = imports_dir + '/mydeps.exodep'
+        elif isinstance( recipe, str ):
+            recipe = self.root_relative( recipe )
+        if self.fetch_uses and not self.check:
+            self.fetch_uses_closure( recipe )
+        try:
+            if recipe:
+                self.process_recipe( recipe, default_vars )
+            else:
+                self.process_globbed_exodep_imports( imports_dir, default_vars )
+        finally:
+            self.wait_for_background_execs()
+
+    def fetch_uses_closure( self, recipe ):
+        # Recipes named by 'uses' commands in the recipe or exodep-imports that aren't in exodep-imports are
+        # fetched into it, along with the recipes that they in turn use.  This is done breadth-first, with each level fetched concurrently.
+        imports_dir = self.root_relative( 'exodep-imports' )
+        files = [file.replace( '\\', '/' ) for file in glob.glob( imports_dir + '/**/*.exodep', recursive=True )]
+        if recipe:
+            files.insert( 0, recipe )
+        seen = set( self.exodep_file_set )
+        def fetch( download ):
+            download.tmp_name = download.handler.download_to_temp_file( download.uri )
+        while files:
+            downloads = []
+            for file in files:
+                for uri, line_num in find_commands( file, 'uses' ):
+                    name = os.path.basename( uri )
+                    if name not in seen and (re.match( 'https?://', uri ) or is_git_uri( uri )):
+                        seen.add( name )
+                        download = PendingDownload( uri, imports_dir + '/' + name, TextDownloadHandler( self ), time.perf_counter(), line_num )
+                        download.file = file if isinstance( file, str ) else '<StringIO>'
+                        downloads.append( download )
+            self.scheduler.fetch_all( downloads, fetch )
+            files = [download.dst for download in downloads if self.install_uses_recipe( download )]
+        self.collect_exodep_file_set( imports_dir )
+
+    def install_uses_recipe( self, download ):
+        import shutil
+        event = { 'command': 'uses', 'uri': download.uri, 'dst': download.dst, 'outcome': 'created', 'bytes': 0,
+                    'duration': round( time.perf_counter() - download.start, 6 ), 'file': download.file, 'line': download.line_num }
+        if not download.tmp_name:
+            self.record_error( download.file + ", line " + str( download.line_num ) + ": Unable to fetch 'uses' recipe: " + download.uri )
+            self.print_urgent( "Error:", download.file + ", line " + str( download.line_num ) + ":" )
+            self.print_urgent( "      ", "Unable to fetch 'uses' recipe: " + download.uri )
+            event['outcome'] = 'error'
+            self.record_action( event )
+            return False
+        os.makedirs( os.path.dirname( download.dst ), exist_ok=True )
+        event['bytes'] = os.path.getsize( download.tmp_name )
+        shutil.move( download.tmp_name, download.dst )
+        self.print_action( 'Created...', download.dst )
+        self.record_action( event )
+        return True
 
-    processed_configs = {}
+    def process_roots( self, roots, recipe = None ):
+        # Each root gets its own variable scope and processed state, but the download and versions caches are shared.
+        # Paths are resolved relative to the root, rather than changing the process-wide working directory.
+        for root in roots:
+            self.print_action( 'Root......', root )
+            if not os.path.isdir( root ):
+                self.report_error( "Unable to find project root directory: " + root )
+                continue
+            self.reset_project_state()
+            self.root = root
+            try:
+                self.process_project( recipe )
+            except StopException:
+                pass
+            finally:
+                self.root = None
+
+    def process_globbed_exodep_imports( self, dir, vars ):
+        if self.parallel:
+            self.process_globbed_exodep_imports_in_parallel( dir, vars )
+            return
+        init_exodep = dir + '/__init.exodep'
+        end_exodep = dir + '/__end.exodep'
+        pause_exodep = dir + '/__pause.exodep'
+        self.globbed_dir_vars[os.path.normpath( dir )] = vars
+        if os.path.isfile( init_exodep ):
+            pd = ProcessDeps( init_exodep, vars, self )
+            vars = pd.get_vars()
+        for file in glob.glob( dir + '/*.exodep' ):
+            file = file.replace( '\\', '/' )
+            if not is_ignored_glob( file ):
+                self.process_recipe( file, vars )
+        for subdir in glob.glob( dir + '/*' ):
+            subdir = subdir.replace( '\\', '/' )
+            if os.path.isdir( subdir ):
+                self.process_globbed_exodep_imports( subdir, vars )
+        if os.path.isfile( end_exodep ):
+            self.process_recipe( end_exodep, vars )
+        if os.path.isfile( pause_exodep ):
+            self.pause()
+
+    def process_globbed_exodep_imports_in_parallel( self, dir, vars ):
+        # The __init.exodep files are processed first, so that the variables for each directory are known.  The
+        # other recipes are then processed concurrently, each starting once the recipes it depends on are complete,
+        # followed by the __end.exodep files.
+        recipes = []    # Each entry is (<file>, <vars>)
+        ends = []
+        is_pause = self.collect_globbed_exodep_imports( dir, vars, recipes, ends )
+        graph = RecipeGraph( [file for file, vars in recipes] )
+        cycle = graph.find_cycle()
+        if cycle:
+            self.record_error( "Cycle in 'uses' and 'include' dependencies: " + ' -> '.join( cycle ) )
+            self.print_urgent( "Error: Cycle in 'uses' and 'include' dependencies:", ' -> '.join( cycle ) )
+            for file, vars in recipes:
+                self.process_recipe( file, vars )
+        else:
+            self.process_recipe_graph( graph, dict( recipes ) )
+        for file, vars in ends:
+            self.process_recipe( file, vars )
+        if is_pause:
+            self.pause()
+
+    def collect_globbed_exodep_imports( self, dir, vars, recipes, ends ):
+        init_exodep = dir + '/__init.exodep'
+        end_exodep = dir + '/__end.exodep'
+        pause_exodep = dir + '/__pause.exodep'
+        self.globbed_dir_vars[os.path.normpath( dir )] = vars
+        if os.path.isfile( init_exodep ):
+            pd = ProcessDeps( init_exodep, vars, self )
+            vars = pd.get_vars()
+        for file in glob.glob( dir + '/*.exodep' ):
+            file = file.replace( '\\', '/' )
+            if not is_ignored_glob( file ):
+                recipes.append( (file, vars) )
+        is_pause = False
+        for subdir in glob.glob( dir + '/*' ):
+            subdir = subdir.replace( '\\', '/' )
+            if os.path.isdir( subdir ):
+                is_pause = self.collect_globbed_exodep_imports( subdir, vars, recipes, ends ) or is_pause
+        if os.path.isfile( end_exodep ):
+            ends.append( (end_exodep, vars) )
+        return is_pause or os.path.isfile( pause_exodep )
+
+    def process_recipe_graph( self, graph, recipe_vars ):
+        import concurrent.futures
+        for file in graph.files:
+            after = graph.prerequisites[file]
+            self.print_verbose( 'Schedule..', file + (' after ' + ', '.join( after ) if after else '') )
+        durations = {}
+        waiting_for = { file: len( graph.prerequisites[file] ) for file in graph.files }
+        dependents = graph.find_dependents()
+        def process( file ):
+            start = time.perf_counter()
+            self.process_recipe( file, recipe_vars[file] )
+            durations[file] = time.perf_counter() - start
+        executor = concurrent.futures.ThreadPoolExecutor( max_workers=self.scheduler.jobs )
+        try:
+            running = { executor.submit( process, file ): file for file in graph.files if waiting_for[file] == 0 }
+            while running:
+                done, not_done = concurrent.futures.wait( running, return_when=concurrent.futures.FIRST_COMPLETED )
+                for future in done:
+                    file = running.pop( future )
+                    future.result()     # Raises any exception from the recipe, such as a StopException
+                    for dependent in dependents[file]:
+                        waiting_for[dependent] -= 1
+                        if waiting_for[dependent] == 0:
+                            running[executor.submit( process, dependent )] = dependent
+        finally:
+            executor.shutdown( wait=True, cancel_futures=True )
+        path, duration = graph.find_critical_path( durations )
+        if path:
+            self.print_verbose( 'Critical..', ' -> '.join( path ), "in " + format( duration, '.2f' ) + "s" )
+
+    def process_recipe( self, file, vars ):
+        if isinstance( file, str ):
+            self.recipe_vars[os.path.normpath( file )] = vars
+        ProcessDeps( file, vars, self )
+
+    def record_exodep_includer( self, file, includer ):
+        self.exodep_includers.setdefault( os.path.normpath( file ), set() ).add( os.path.normpath( includer ) )
+
+    def watch( self, interval ):
+        self.print( "Watching for changes. Press Ctrl-C to stop." )
+        self.flush_output()
+        snapshot = self.take_watch_snapshot()
+        try:
+            while True:
+                time.sleep( interval )
+                latest = self.take_watch_snapshot()
+                changed = [file for file in latest if snapshot.get( file ) != latest[file]]
+                snapshot = latest
+                if changed:
+                    self.rerun_affected_exodep_files( changed )
+                    self.flush_output()
+        except KeyboardInterrupt:
+            pass
+
+    def take_watch_snapshot( self ):
+        files = set( self.recipe_vars ) | set( self.exodep_includers )
+        for dir in self.globbed_dir_vars:
+            for file in glob.glob( dir + '/*.exodep' ):
+                files.add( os.path.normpath( file ) )
+        snapshot = {}
+        for file in files:
+            try:
+                snapshot[file] = os.stat( file ).st_mtime_ns
+            except OSError:
+                pass
+        return snapshot
+
+    def find_affected_exodep_files( self, changed ):
+        # Returns the globbed dirs that need re-processing from scratch and the top-level exodep files
+        # outside those dirs that need re-running, following include relationships back to their roots
+        dirs = set()
+        recipes = set()
+        pending = [os.path.normpath( file ) for file in changed]
+        seen = set()
+        while pending:
+            file = pending.pop()
+            if file in seen:
+                continue
+            seen.add( file )
+            dir = os.path.dirname( file )
+            if os.path.basename( file ) == '__init.exodep' and dir in self.globbed_dir_vars:
+                dirs.add( dir )
+            elif file in self.recipe_vars:
+                recipes.add( file )
+            elif dir in self.globbed_dir_vars and not is_ignored_glob( file.replace( '\\', '/' ) ) and file.endswith( '.exodep' ):
+                recipes.add( file )     # A newly added exodep file
+            pending.extend( self.exodep_includers.get( file, [] ) )
+            self.versions_cache.pop( os.path.abspath( file ), None )
+        dirs = set( d for d in dirs if not is_within_any_dir( d, dirs - { d } ) )
+        recipes = set( r for r in recipes if not is_within_any_dir( r, dirs ) )
+        return sorted( dirs ), sorted( recipes )
+
+    def rerun_affected_exodep_files( self, changed ):
+        dirs, recipes = self.find_affected_exodep_files( changed )
+        if not dirs and not recipes:
+            return
+        self.processed_configs = {}
+        self.processed_downloads = {}
+        self.discard_fetched_files()     # Upstream files may also have changed
+        self.exodep_file_set = {}
+        self.collect_exodep_file_set()
+        try:
+            for dir in dirs:
+                self.print_action( 'Rerun.....', dir )
+                self.process_globbed_exodep_imports( dir.replace( '\\', '/' ), self.globbed_dir_vars[dir] )
+            for recipe in recipes:
+                self.print_action( 'Rerun.....', recipe )
+                vars = self.recipe_vars.get( recipe, self.globbed_dir_vars.get( os.path.dirname( recipe ), default_vars ) )
+                self.process_recipe( recipe.replace( '\\', '/' ), vars )
+        except StopException:
+            pass
+        finally:
+            self.wait_for_background_execs()
+
+    def discard_fetched_files( self ):
+        for fetched_name in self.fetched_files.values():
+            try:
+                os.unlink( fetched_name )
+            except OSError:
+                pass
+        self.fetched_files = {}
+
+    def wait_for_background_execs( self ):
+        # Output is reported in the order the commands were started, so it is not interleaved
+        while self.background_execs:
+            self.background_execs.pop( 0 ).wait()
+
+    def record_action( self, event ):
+        with self.lock:
+            self.results.actions.append( event )
+        if event['command'] in [ 'versions', 'authority', 'exec', 'execmemo' ] or event['outcome'] == 'error':
+            self.print_verbose( (event['command'].capitalize() + '.' * 10)[:10], event['uri'], "(" + event['outcome'] + ", " + format( event['duration'], '.3f' ) + "s)" )
+        self.show_progress()
+        if self.metrics:
+            self.metrics.record_action( dict( event ) )
+
+    def record_dst_inputs( self, dst, inputs ):
+        with self.lock:
+            dst_inputs = self.results.inputs.setdefault( dst, [] )
+            for input in inputs:
+                if input not in dst_inputs:
+                    dst_inputs.append( input )
+
+    def root_relative( self, path ):
+        # When processing multiple project roots, paths are resolved and reported relative to where exodep was started
+        if self.root and path and not os.path.isabs( path ):
+            return self.root.rstrip( '/' ) + '/' + path
+        return path
+
+    def find_exodep_includers( self, file ):
+        includers = []
+        pending = [ os.path.normpath( file ) ]
+        while pending:
+            for includer in sorted( self.exodep_includers.get( pending.pop(), [] ) ):
+                if includer not in includers:
+                    includers.append( includer )
+                    pending.append( includer )
+        return [ includer.replace( '\\', '/' ) for includer in includers ]
+
+    def record_error( self, message ):
+        with self.lock:
+            self.results.errors.append( message )
+        if self.metrics:
+            self.metrics.count_error()
+
+    def report_error( self, message ):
+        self.record_error( message )
+        self.print_urgent( "Error: " + message )
+
+    def count_cache( self, cache, is_hit ):
+        if self.metrics:
+            self.metrics.count_cache( cache, is_hit )
+
+    def trace_span( self, name, cat, **args ):
+        return TraceSpan( self.tracer, name, cat, args )
+
+    def trace_instant( self, name, cat, **args ):
+        if self.tracer:
+            self.tracer.add_instant( name, cat, args )
+
+    def open_uri( self, uri, headers = None ):
+        import urllib.request
+        import urllib.parse
+        # The 'request' span covers connection set-up, sending the request and waiting for the first byte of the response
+        if is_git_uri( uri ):
+            return self.git_repos.open( uri )
+        if self.bundle:
+            if self.bundle.is_rejected( uri ):
+                self.report_error( "Bundled body does not match its digest: " + uri )
+            return self.bundle.open( uri )
+        start = time.perf_counter()
+        org_uri = uri
+        if self.proxy:
+            uri = make_proxy_uri( self.proxy, uri )
+        try:
+            with self.trace_span( 'request', 'network', uri=uri ) as span:
+                hedge_delay = self.find_hedge_delay()
+                request = urllib.request.Request( uri, headers=headers if headers else {} )
+                if hedge_delay != None:
+                    response = self.open_uri_hedged( request, hedge_delay, span )
+                else:
+                    response = urllib.request.urlopen( request, timeout=self.request_timeout() )
+                self.note_request_latency( time.perf_counter() - start )
+                return self.bundle_writer.record( org_uri, response ) if self.bundle_writer else response
+        finally:
+            if self.metrics:
+                self.metrics.observe_request( urllib.parse.urlsplit( uri ).hostname, time.perf_counter() - start )
+
+    def open_uri_hedged( self, request, hedge_delay, span ):
+        import urllib.request
+        import queue
+        # If the first request is slow to respond, a second one is sent and the first successful response is used
+        uri = request.full_url
+        responses = queue.Queue()
+        def attempt():
+            try:
+                responses.put( (urllib.request.urlopen( request, timeout=self.request_timeout() ), None) )
+            except Exception as e:
+                responses.put( (None, e) )
+        threading.Thread( target=attempt, daemon=True ).start()
+        n_pending = 1
+        try:
+            response, error = responses.get( timeout=hedge_delay )
+        except queue.Empty:
+            span.set( 'hedged', True )
+            self.trace_instant( 'hedge', 'network', uri=uri, delay=hedge_delay )
+            self.count_retry()
+            threading.Thread( target=attempt, daemon=True ).start()
+            n_pending = 2
+            response, error = responses.get()
+        n_pending -= 1
+        if error and n_pending:
+            response, error = responses.get()
+            n_pending -= 1
+        if n_pending:
+            threading.Thread( target=close_late_response, args=(responses,), daemon=True ).start()
+        if error:
+            raise error
+        return response
+
+    def find_hedge_delay( self ):
+        if not self.hedge or len( self.request_latencies ) < Session.hedge_min_samples:
+            return None
+        latencies = sorted( self.request_latencies )
+        return latencies[min( len( latencies ) - 1, int( len( latencies ) * self.hedge / 100 ) )]
+
+    def note_request_latency( self, latency ):
+        with self.lock:
+            self.request_latencies.append( latency )
+            if len( self.request_latencies ) > Session.hedge_max_samples:
+                self.request_latencies.pop( 0 )
+
+    def request_timeout( self ):
+        timeout = self.timeout
+        if self.deadline_time != None:
+            remaining = max( self.deadline_time - time.perf_counter(), 0.001 )
+            timeout = min( timeout, remaining ) if timeout else remaining
+        return timeout
+
+    def is_past_deadline( self ):
+        return self.deadline_time != None and time.perf_counter() > self.deadline_time
+
+    def check_deadline( self ):
+        if self.is_past_deadline():
+            raise TimeoutError( "Run deadline reached" )
+
+    def note_incomplete( self, file, line_num, line ):
+        if not self.is_deadline_reported:
+            self.is_deadline_reported = True
+            self.print_urgent( "DEADLINE: Run deadline of " + str( self.deadline ) + "s reached, skipping remaining commands" )
+        with self.lock:
+            self.results.incomplete.append( file + " (" + str( line_num ) + "): " + line.strip() )
+
+    def expected_download_size( self, uri ):
+        return self.state.get( 'sizes' ).get( uri, 0 ) if self.state else 0
+
+    def note_download_size( self, uri, size ):
+        if self.state:
+            self.state.set( 'sizes', uri, size )
+
+    def note_response_validators( self, uri, headers ):
+        with self.lock:
+            self.response_validators[uri] = (headers.get( 'ETag' ), headers.get( 'Last-Modified' ))
+
+    def note_download_validators( self, uri, tmp_name ):
+        # Records what was fetched, so that a later --check run can use a conditional request for it
+        if self.state and uri in self.response_validators:
+            etag, last_modified = self.response_validators[uri]
+            if etag or last_modified:
+                self.state.set( 'validators', uri, { 'etag': etag, 'last_modified': last_modified,
+                                                        'digest': file_digest( tmp_name ), 'size': os.path.getsize( tmp_name ) } )
+
+    def find_check_validators( self, uri, dst ):
+        # Returns the stored validators for uri if dst still holds what was last fetched from it
+        if not self.check or not self.state:
+            return None
+        validators = self.state.get( 'validators' ).get( uri )
+        if not validators or not os.path.isfile( dst ) or file_digest( dst ) != validators['digest']:
+            return None
+        return validators
+
+    def note_bytes_avoided( self, size ):
+        with self.lock:
+            self.results.bytes_avoided += size
+
+    def count_retry( self ):
+        if self.metrics:
+            self.metrics.count_retry()
+
+    def note_bytes_fetched( self, span, size ):
+        span.set( 'bytes', size )
+        if self.metrics:
+            self.metrics.add_bytes_fetched( size )
+
+class SessionResult:
+    def __init__( self ):
+        self.actions = []       # One dict per action performed, holding command, uri, dst, outcome, bytes, duration, file and line
+        self.alerts = []
+        self.errors = []
+        self.inputs = {}        # Each entry is <destination file> : <list of local files that went into making it>
+        self.incomplete = []    # Commands skipped because the run deadline was reached
+        self.bytes_avoided = 0  # Bytes not transferred in check mode because conditional requests found files unchanged
+        self.is_stopped = False
+        self.is_unchanged = False   # True if the run was skipped because nothing had changed since the last run
+
+    def stale( self ):
+        stale = []
+        for action in self.actions:
+            if action['outcome'] in [ 'stale', 'different' ] and action['dst'] not in stale:
+                stale.append( action['dst'] )
+        return stale
+
+    def changed( self ):
+        changed = []
+        for action in self.actions:
+            if action['outcome'] in [ 'created', 'updated', 'copied', 'moved', 'pruned' ] and action['dst'] not in changed:
+                changed.append( action['dst'] )
+        return changed
+
+def close_late_response( responses ):
+    response, error = responses.get()
+    if response:
+        response.close()
+
+def write_depfile( file, result ):
+    with open( file, 'w' ) as fout:
+        for dst in sorted( result.inputs ):
+            fout.write( escape_depfile_path( dst ) + ':' )
+            for input in result.inputs[dst]:
+                fout.write( ' \\\n    ' + escape_depfile_path( input ) )
+            fout.write( '\n' )
+
+def escape_depfile_path( path ):
+    return path.replace( '\\', '/' ).replace( '$', '$$' ).replace( '#', '\\#' ).replace( ' ', '\\ ' )
+
+def write_changed_list( file, result ):
+    with open( file, 'w' ) as fout:
+        for dst in result.changed():
+            fout.write( dst + '\n' )
+
+class Console:
+    # Buffers output lines so that large runs don't pay for a console write per line, and shows an
+    # in-place progress line when writing to a terminal
+    flush_lines = 100
+    flush_interval = 0.25
+    progress_interval = 0.1
+
+    def __init__( self, stream = None ):
+        self.stream = stream if stream else sys.stdout
+        self.is_tty = hasattr( self.stream, 'isatty' ) and self.stream.isatty()
+        self.lock = threading.Lock()
+        self.lines = []
+        self.last_flush = time.perf_counter()
+        self.flush_timer = None
+        self.progress_text = ''
+        self.last_progress = 0
+
+    def __call__( self, text ):
+        with self.lock:
+            self.lines.append( text )
+            if len( self.lines ) < Console.flush_lines and time.perf_counter() - self.last_flush < Console.flush_interval:
+                if not self.flush_timer:
+                    # So that lines aren't held back while a long operation, such as an exec, runs
+                    self.flush_timer = threading.Timer( Console.flush_interval, self.flush )
+                    self.flush_timer.daemon = True
+                    self.flush_timer.start()
+                return
+        self.flush()
+
+    def flush( self ):
+        with self.lock:
+            if self.flush_timer:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            self.clear_progress()
+            if self.lines:
+                self.stream.write( '\n'.join( self.lines ) + '\n' )
+                self.lines = []
+            self.stream.flush()
+            self.last_flush = time.perf_counter()
+
+    def progress( self, text ):
+        if not self.is_tty or time.perf_counter() - self.last_progress < Console.progress_interval:
+            return
+        self.flush()
+        import shutil
+        text = text[:shutil.get_terminal_size().columns - 1]
+        with self.lock:
+            self.stream.write( '\r' + text.ljust( len( self.progress_text ) ) )
+            self.stream.flush()
+            self.progress_text = text
+            self.last_progress = time.perf_counter()
+
+    def clear_progress( self ):
+        if self.progress_text:
+            self.stream.write( '\r' + ' ' * len( self.progress_text ) + '\r' )
+            self.progress_text = ''
+
+def is_within_any_dir( file, dirs ):
+    for dir in dirs:
+        if file.startswith( dir + os.sep ):
+            return True
+    return False
 
-    def __init__( self, dependencies_src, vars = default_vars ):
+class ProcessDeps:
+    def __init__( self, dependencies_src, vars = default_vars, session = None ):
+        self.session = session if session else get_default_session()
         self.is_last_file_changed = self.are_files_changed = False
         self.line_num = 0
         self.uritemplate = host_templates['github']
         self.set_vars( vars )
         self.primary_branch = 'master'
         self.versions = {}  # Each entry is <string of space separated strand names> : <string to use as strand in uri template>
+        self.versions_files = []    # Local versions files read, which destinations depend on
+        self.pending_downloads = []
         self.sought_condition = True
         self.default_dest = None
-        if isinstance( dependencies_src, str ):
-            if self.is_config_already_processed( dependencies_src ):
-                return
-            self.file = dependencies_src
-            self.process_dependency_file()
-        elif isinstance( dependencies_src, io.StringIO ):    # Primarily for testing
-            self.file = "<StringIO>"
-            self.process_dependency_stream( dependencies_src )
-        else:
-            self.error( "Unrecognised dependencies_src type format" )
+        try:
+            if isinstance( dependencies_src, str ):
+                if self.is_config_already_processed( dependencies_src ):
+                    return
+                self.file = dependencies_src
+                self.process_dependency_file()
+            elif isinstance( dependencies_src, io.StringIO ):    # Primarily for testing
+                self.file = "<StringIO>"
+                self.process_dependency_stream( dependencies_src )
+            else:
+                self.error( "Unrecognised dependencies_src type format" )
+        finally:
+            if not session:     # The default session is never closed, so fetched bodies are only kept while it is processing
+                self.session.discard_fetched_files()
 
     def get_vars( self ):
         return self.vars
@@ -148,14 +1126,16 @@ class ProcessDeps:
 
     def is_config_already_processed( self, dependencies_src ):
         abs_dependencies_src = os.path.abspath( dependencies_src )
-        if abs_dependencies_src in ProcessDeps.processed_configs:
-            return True
-        ProcessDeps.processed_configs[abs_dependencies_src] = True
-        return False
+        with self.session.lock:     # Recipes may be processed concurrently
+            if abs_dependencies_src in self.session.processed_configs:
+                return True
+            self.session.processed_configs[abs_dependencies_src] = True
+            return False
 
     def process_dependency_file( self ):
+        self.session.note_input_file( self.file )
         try:
-            with open(self.file) as f:
+            with open(self.file) as f, self.session.trace_span( self.file, 'recipe' ):
                 self.process_dependency_stream( f )
         except FileNotFoundError:
             self.error( "Unable to open exodep file: " + self.file )
@@ -164,7 +1144,16 @@ class ProcessDeps:
         for line in f:
             self.line_num += 1
             self.sought_condition = True
-            self.process_line( line )
+            if self.session.deadline_time != None and self.session.is_past_deadline():
+                if not is_blank_line( remove_comments( line ) ):
+                    self.session.note_incomplete( self.file, self.line_num, line )
+                continue
+            if self.session.tracer and not is_blank_line( remove_comments( line ) ):
+                with self.session.trace_span( line.split()[0], 'command', file=self.file, line=self.line_num, text=line.strip() ):
+                    self.process_line( line )
+            else:
+                self.process_line( line )
+        self.drain_downloads()
 
     def process_line( self, line ):
         line = line.strip()
@@ -173,6 +1162,13 @@ class ProcessDeps:
         if is_blank_line( line ):
             return
         command, arguments = split_in_2( line )
+        if self.session.check and command in check_skipped_commands:
+            return
+        if self.pending_downloads and not self.is_pipelinable_command( command ):
+            self.drain_downloads()
+            if self.session.is_past_deadline():
+                self.session.note_incomplete( self.file, self.line_num, line )
+                return
         if not (self.consider_include( command, arguments ) or
                 self.consider_sinclude( command, arguments ) or
                 self.consider_hosting( command, arguments ) or
@@ -189,8 +1185,13 @@ class ProcessDeps:
                 self.consider_dest( command, arguments ) or
                 self.consider_get( command, arguments ) or
                 self.consider_bget( command, arguments ) or
+                self.consider_getdir( command, arguments ) or
+                self.consider_getarchive( command, arguments ) or
                 self.consider_file_ops( command, arguments ) or
                 self.consider_exec( command, arguments ) or
+                self.consider_background_exec( command, arguments ) or
+                self.consider_execwait( command, arguments ) or
+                self.consider_execmemo( command, arguments ) or
                 self.consider_subst( command, arguments ) or
                 self.consider_on_conditional( command, arguments ) or
                 self.consider_ondir( command, arguments ) or
@@ -209,19 +1210,26 @@ class ProcessDeps:
                 self.consider_stop( command, arguments ) ):
             self.report_unrecognised_command( line )
 
+    def is_pipelinable_command( self, command ):
+        # Commands that can be processed while earlier downloads are still pending, because they
+        # don't depend on the downloads having completed
+        return command in [ 'get', 'bget', 'uritemplate', 'hosting', 'dest' ] or command[0] == '$'
+
     def consider_include( self, command, arguments ):
         if command == 'include' and  arguments != None:
             file_name = self.script_relative_path( arguments )
+            if self.file[0] != "<":
+                self.session.record_exodep_includer( file_name, self.file )
             if not os.path.isfile( file_name ):
                 self.error( "'include' file not found: " + file_name )
                 return True     # It was an 'include' command, even though it was a bad one
-            ProcessDeps( file_name, self.vars )
+            ProcessDeps( file_name, self.vars, self.session )
             return True
         return False
 
     def consider_sinclude( self, command, arguments ):        # This method is used to support testing
         if command == 'sinclude' and arguments != None:
-            ProcessDeps( io.StringIO( arguments.replace( '\t', '\n' ) ), self.vars )
+            ProcessDeps( io.StringIO( arguments.replace( '\t', '\n' ) ), self.vars, self.session )
             return True
         return False
 
@@ -246,18 +1254,21 @@ class ProcessDeps:
 
     def consider_authority( self, command, arguments ):
         if command == 'authority' and arguments != None:
+            start = time.perf_counter()
             src = arguments
             from_uri = self.make_uri( src )
             self.vars['__authority'] = from_uri
-            if re.match( 'https?://', from_uri ):
-                tmp_name = TextDownloadHandler().download_to_temp_file( from_uri )
-            else:
-                tmp_name = self.local_copy_to_temp_file( from_uri )     # Taking a local copy is not optimal, but keeps the subsequent update logic the same
+            tmp_name = self.fetch_to_temp_file( from_uri, TextDownloadHandler( self.session ) )
             if not tmp_name:
                 self.error( "Unable to retrieve authority exodep file from: " + from_uri )
+                self.record_action( 'authority', from_uri, self.file, 'error', 0, start )
                 return True
-            if self.file[0] != "<" and not text_filecmp( tmp_name, self.file ):
+            with self.session.trace_span( 'compare', 'file', src=from_uri, dst=self.file ) as span:
+                is_same = self.file[0] == "<" or text_filecmp( tmp_name, self.file )
+                span.set( 'outcome', 'same' if is_same else 'different' )
+            if not is_same:
                 self.error( "local exodep file out of sync with authority: " + self.file )
+            self.record_action( 'authority', from_uri, self.file, 'same' if is_same else 'different', os.path.getsize( tmp_name ), start )
             os.unlink( tmp_name )
             return True
         return False
@@ -265,38 +1276,44 @@ class ProcessDeps:
     def consider_uses( self, command, arguments ):
         if command == 'uses' and arguments != None:
             exodep_file = os.path.basename( arguments )
-            if not exodep_file in exodep_file_set:
+            if not exodep_file in self.session.exodep_file_set:
                 self.error( "uses command specifies unfound exodep file: " + exodep_file )
             return True
         return False
 
     def consider_versions( self, command, arguments ):
         if command == 'versions':
+            start = time.perf_counter()
             file_name = arguments if arguments else 'versions.exodep'
             uri = self.make_master_strand_uri( file_name )
-            try:
-                if re.match( 'https?://', uri ):
-                    with urllib.request.urlopen( uri ) as fin:
-                        self.parse_versions_info( fin )
-                else:
-                    with open( uri, "rt" ) as fin:
-                        self.parse_versions_info( fin )
-            except:
-                self.error( "Unable to retrieve 'versions' information from: " + uri )
+            is_remote = re.match( 'https?://', uri ) or is_git_uri( uri )
+            cache_key = uri if is_remote else os.path.abspath( uri )
+            if not is_remote:
+                self.session.note_input_file( uri )
+            if not is_remote and self.file[0] != "<":
+                self.session.record_exodep_includer( uri, self.file )
+                if uri not in self.versions_files:
+                    self.versions_files.append( uri )
+            is_cached = cache_key in self.session.versions_cache
+            self.session.trace_instant( 'versions', 'cache', uri=uri, outcome='hit' if is_cached else 'miss' )
+            self.session.count_cache( 'versions', is_cached )
+            if not is_cached:
+                try:
+                    if is_remote:
+                        with self.session.open_uri( uri ) as fin:
+                            self.session.versions_cache[cache_key] = parse_versions_info( fin )
+                    else:
+                        with open( uri, "rt" ) as fin:
+                            self.session.versions_cache[cache_key] = parse_versions_info( fin )
+                except:
+                    self.error( "Unable to retrieve 'versions' information from: " + uri )
+                    self.record_action( 'versions', uri, None, 'error', 0, start )
+                    return True
+            self.versions.update( self.session.versions_cache[cache_key] )
+            self.record_action( 'versions', uri, None, 'cached' if is_cached else 'fetched', 0, start )
             return True
         return False
 
-    def parse_versions_info( self, fin ):
-        for line in fin:
-            if isinstance( line, bytes ):
-                line = line.decode( 'utf-8' )
-            line = line.rstrip()
-            line = remove_comments( line )
-            if not is_blank_line( line ):
-                m = re.match( '^(\S+)\s+(.*)', line )
-                if m != None:
-                    self.versions[m.group(2)] = m.group(1)
-
     def consider_variable( self, command, arguments ):
         if command[0] == '$':
             self.set_single_variable( command[1:], arguments )
@@ -323,7 +1340,7 @@ class ProcessDeps:
                 raw = self.vars[var]
                 expanded = self.expand_variables( raw )
                 expansion = '' if expanded == raw else (' -> ' + expanded)
-                print( var + ": " + raw + expansion )
+                self.session.print( var + ": " + raw + expansion )
             return True
         return False
 
@@ -436,13 +1453,16 @@ class ProcessDeps:
         return False
 
     def retrieve_text_file( self, src, dst ):
-        self.retrieve_file( src, dst, TextDownloadHandler() )
+        self.retrieve_file( src, dst, TextDownloadHandler( self.session ) )
 
     def retrieve_binary_file( self, src, dst ):
-        self.retrieve_file( src, dst, BinaryDownloadHandler() )
+        self.retrieve_file( src, dst, BinaryDownloadHandler( self.session ) )
 
     def retrieve_file( self, src, dst, handler ):
+        start = time.perf_counter()
         self.is_last_file_changed = False
+        from_uri = self.make_uri( src )
+        is_wildcard_src = is_wildcard( src ) and from_uri != '' and not re.match( 'https?://', from_uri ) and not is_git_uri( from_uri )
         if dst == None:
             if self.default_dest != None:
                 dst = self.default_dest
@@ -453,7 +1473,11 @@ class ProcessDeps:
                 dst = src
                 if self.uritemplate.find( '${path}' ) >= 0:
                     dst = self.vars['path'] + dst   # If present in the uri template, the ${path} variable will be included in the uri, so include it in the dst for symmetry
-        from_uri = self.make_uri( src )
+                if is_wildcard_src:
+                    dst = os.path.dirname( dst ) or '.'     # The matching files go in the directory the pattern is in
+        if is_wildcard_src:
+            self.retrieve_wildcard_files( from_uri, dst, handler )
+            return
         to_file = self.make_destination_file_name( src, dst )
         if from_uri == '':
             self.error( "Unable to evaluate source of: " + src )
@@ -461,41 +1485,330 @@ class ProcessDeps:
         if to_file == '':
             self.error( "Unable to evaluate destination of: " + dst )
             return
+        if self.is_download_pending( from_uri, to_file ):
+            self.drain_downloads()      # So that the repeat is reported after the original
         if self.is_file_already_downloaded( from_uri, to_file ):
-            print( 'Repeat....', to_file )
+            self.session.trace_instant( 'repeat', 'cache', uri=from_uri, dst=to_file )
+            self.session.print_action( 'Repeat....', to_file )
+            self.record_action( handler.command, from_uri, to_file, 'repeat', 0, start )
             return
-        if re.match( 'https?://', from_uri ):
-            tmp_name = handler.download_to_temp_file( from_uri )
-        else:
-            tmp_name = self.local_copy_to_temp_file( from_uri )     # Taking a local copy is not optimal, but keeps the subsequent update logic the same
-        if not tmp_name:
-            self.error( "Unable to retrieve: " + from_uri )
+        self.pending_downloads.append( PendingDownload( from_uri, to_file, handler, start, self.line_num ) )
+        if not self.session.scheduler.is_pipelined():
+            self.drain_downloads()
+
+    def drain_downloads( self ):
+        # Pending downloads are fetched by the scheduler, and then installed in the order they were requested
+        if not self.pending_downloads:
+            return
+        downloads = self.pending_downloads
+        self.pending_downloads = []
+        self.session.scheduler.fetch_all( downloads, self.fetch_download )
+        org_line_num = self.line_num
+        for download in downloads:
+            self.line_num = download.line_num
+            self.finish_download( download )
+        self.line_num = org_line_num
+
+    def fetch_download( self, download ):
+        if is_git_uri( download.uri ) and self.session.git_repos.is_blob_at( download.uri, download.dst ):
+            download.tmp_name = not_modified    # The file is not read from the repository at all
             return
-        self.conditionally_update_dst_file( tmp_name, to_file )
+        validators = self.session.find_check_validators( download.uri, download.dst )
+        download.tmp_name = self.fetch_to_temp_file( download.uri, download.handler, validators )
+        if download.tmp_name == not_modified:
+            self.session.note_bytes_avoided( validators['size'] )
 
-    processed_downloads = {}
+    def finish_download( self, download ):
+        self.is_last_file_changed = False
+        timings = { 'queue_wait': round( download.queue_wait, 6 ), 'transfer': round( download.transfer, 6 ) }
+        if not download.tmp_name and self.session.is_past_deadline():
+            self.note_cut_short( download.uri )
+            self.record_action( download.handler.command, download.uri, download.dst, 'incomplete', 0, download.start, timings )
+            return
+        if not download.tmp_name:
+            self.error( "Unable to retrieve: " + download.uri )
+            self.record_action( download.handler.command, download.uri, download.dst, 'error', 0, download.start, timings )
+            return
+        if download.tmp_name == not_modified:
+            self.session.print_action( 'Same......', download.dst )
+            self.record_action( download.handler.command, download.uri, download.dst, 'same', 0, download.start, timings )
+            return
+        if download.host:
+            self.session.note_download_validators( download.uri, download.tmp_name )
+        size = os.path.getsize( download.tmp_name )
+        outcome = self.conditionally_update_dst_file( download.tmp_name, download.dst )
+        self.record_action( download.handler.command, download.uri, download.dst, outcome, size, download.start, timings )
+
+    def retrieve_wildcard_files( self, from_uri, dst, handler ):
+        dst_dir = self.local_path( self.expand_variables( dst ) )
+        if dst_dir == '':
+            self.error( "Unable to evaluate destination of: " + dst )
+            return
+        self.session.note_input_file( os.path.dirname( from_uri ) or '.' )   # So that new matching files are noticed
+        sources = {}
+        for file in glob.glob( from_uri ):
+            if os.path.isfile( file ):
+                sources[os.path.basename( file )] = file
+        if not sources:
+            self.error( "No files match: " + from_uri )
+            return
+        self.sync_files( handler.command, sources, dst_dir, False )
+
+    def consider_getdir( self, command, arguments ):
+        if command == 'getdir' and arguments != None:
+            self.is_last_file_changed = False
+            parts = arguments.split()
+            is_prune = len( parts ) == 3 and parts[2] == 'prune'
+            if len( parts ) != 2 and not is_prune:
+                self.error( "'getdir' requires a source and destination directory, optionally followed by 'prune'" )
+                return True
+            src_dir = self.make_uri( parts[0] )
+            dst_dir = self.local_path( self.expand_variables( parts[1] ) )
+            if src_dir == '' or dst_dir == '':
+                return True
+            if re.match( 'https?://', src_dir ) or is_git_uri( src_dir ):
+                self.error( "'getdir' is only supported for local sources: " + src_dir )
+                return True
+            if not os.path.isdir( src_dir ):
+                self.error( "'getdir' source directory not found: " + src_dir )
+                return True
+            self.session.note_input_file( src_dir )
+            sources = scan_dir_tree( src_dir )
+            if not sources:
+                self.error( "'getdir' source directory has no files: " + src_dir )
+                return True
+            self.sync_files( 'getdir', sources, dst_dir, is_prune )
+            return True
+        return False
+
+    def consider_getarchive( self, command, arguments ):
+        import tarfile
+        import zipfile
+        if command == 'getarchive' and arguments != None:
+            self.is_last_file_changed = False
+            parts = arguments.split()
+            if len( parts ) < 2:
+                self.error( "'getarchive' requires an archive and a destination directory, optionally followed by the members to extract" )
+                return True
+            src = self.make_uri( parts[0] )
+            dst_dir = self.local_path( self.expand_variables( parts[1] ) )
+            if src == '' or dst_dir == '':
+                return True
+            start = time.perf_counter()
+            try:
+                with self.session.trace_span( 'getarchive', 'archive', uri=src ):
+                    if src.lower().endswith( '.zip' ):
+                        n_extracted = self.extract_zip_archive( src, dst_dir, parts[2:], start )
+                    else:
+                        n_extracted = self.extract_tar_archive( src, dst_dir, parts[2:], start )
+                if n_extracted == 0:
+                    self.error( "No files extracted from archive: " + src )
+            except (OSError, EOFError, tarfile.TarError, zipfile.BadZipFile):
+                if self.session.is_past_deadline():
+                    self.note_cut_short( src )
+                    self.record_action( 'getarchive', src, None, 'incomplete', 0, start )
+                    return True
+                self.error( "Unable to extract archive: " + src )
+                self.record_action( 'getarchive', src, None, 'error', 0, start )
+            return True
+        return False
+
+    def extract_tar_archive( self, src, dst_dir, members, start ):
+        import tarfile
+        # The archive is decompressed as it is read, so only the current member is ever held on disk
+        n_extracted = 0
+        with self.open_archive( src ) as fin, tarfile.open( fileobj=fin, mode='r|*' ) as tar:
+            for member in tar:
+                rel = self.select_archive_member( member.name, members ) if member.isfile() else None
+                if rel:
+                    self.extract_archive_member( tar.extractfile( member ), src, os.path.join( dst_dir, rel ), start )
+                    n_extracted += 1
+        return n_extracted
+
+    def extract_zip_archive( self, src, dst_dir, members, start ):
+        import zipfile
+        # A zip file's directory is at its end, so a remote archive is fetched to a temp file before being read
+        is_remote = re.match( 'https?://', src ) or is_git_uri( src )
+        archive_name = self.fetch_to_temp_file( src, BinaryDownloadHandler( self.session ) ) if is_remote else src
+        if not archive_name:
+            raise FileNotFoundError( "Unable to retrieve: " + src )
+        try:
+            n_extracted = 0
+            with zipfile.ZipFile( archive_name ) as zip:
+                for member in zip.infolist():
+                    rel = self.select_archive_member( member.filename, members ) if not member.is_dir() else None
+                    if rel:
+                        with zip.open( member ) as fin:
+                            self.extract_archive_member( fin, src, os.path.join( dst_dir, rel ), start )
+                        n_extracted += 1
+            return n_extracted
+        finally:
+            if is_remote:
+                discard_temp_file( archive_name )
+
+    def open_archive( self, src ):
+        if re.match( 'https?://', src ) or is_git_uri( src ):
+            return self.session.open_uri( src )
+        return open( src, 'rb' )
+
+    def select_archive_member( self, name, members ):
+        import fnmatch
+        # Returns the name relative to the destination directory that an archive member is extracted to,
+        # or None if it isn't wanted.  A member ending in '/' selects a directory, whose files are extracted
+        # relative to it.  Other members are matched, including wildcards, against the whole name.
+        name = re.sub( '^(\\./)+', '', name.replace( '\\', '/' ) )
+        if name.startswith( '/' ) or '..' in name.split( '/' ) or re.match( '[A-Za-z]:', name ):
+            self.error( "Unsafe archive member name not extracted: " + name )
+            return None
+        if not members:
+            return name
+        for member in members:
+            if member.endswith( '/' ) and name.startswith( member ):
+                return name[len( member ):]
+            if not member.endswith( '/' ) and fnmatch.fnmatchcase( name, member ):
+                return name
+        return None
+
+    def extract_archive_member( self, fin, src, dst, start ):
+        dst = dst.replace( '\\', '/' )
+        tmp_name = None
+        try:
+            with self.session.make_temp_file( 'wb' ) as fout:
+                tmp_name = fout.name
+                size = 0
+                while True:
+                    self.session.check_deadline()
+                    data = fin.read( 65536 )
+                    if not data:
+                        break
+                    size += len( data )
+                    fout.write( data )
+        except:
+            discard_temp_file( tmp_name )
+            raise
+        outcome = self.conditionally_update_dst_file( tmp_name, dst )
+        self.record_action( 'getarchive', src, dst, outcome, size, start )
+
+    sync_workers = 8
+
+    def sync_files( self, command, sources, dst_dir, is_prune ):
+        import concurrent.futures
+        # sources maps destination relative names to source files.  Only files that differ are
+        # copied, and the copying is done in parallel
+        start = time.perf_counter()
+        plan = [(rel, sources[rel], os.path.join( dst_dir, rel ).replace( '\\', '/' )) for rel in sorted( sources )]
+        with self.session.trace_span( command, 'sync', dst=dst_dir, files=len( plan ) ):
+            with concurrent.futures.ThreadPoolExecutor( max_workers=ProcessDeps.sync_workers ) as executor:
+                outcomes = list( executor.map( lambda item: sync_file( item[1], item[2], self.session.check ), plan ) )
+        for (rel, src, dst), outcome in zip( plan, outcomes ):
+            if outcome == 'error':
+                self.error( "Unable to copy '" + src + "' to '" + dst + "'" )
+            else:
+                if outcome != 'same':
+                    self.note_file_changed()
+                self.session.print_action( { 'created': 'Created...', 'updated': 'Updated...', 'same': 'Same......', 'stale': 'Stale.....' }[outcome], dst )
+            self.record_action( command, src, dst, outcome, os.path.getsize( dst ) if outcome in ('created', 'updated') else 0, start )
+        if is_prune:
+            self.prune_files( command, sources, dst_dir )
+
+    def prune_files( self, command, sources, dst_dir ):
+        for dirpath, dirnames, filenames in os.walk( dst_dir ):
+            for file in filenames:
+                dst = os.path.join( dirpath, file )
+                rel = os.path.relpath( dst, dst_dir ).replace( '\\', '/' )
+                if rel not in sources and self.session.check:
+                    self.note_file_changed()
+                    self.session.print_action( 'Stale.....', dst.replace( '\\', '/' ) )
+                    self.record_action( command, None, dst, 'stale', 0, time.perf_counter() )
+                elif rel not in sources:
+                    try:
+                        os.unlink( dst )
+                        self.note_file_changed()
+                        self.session.print_action( 'Pruned....', dst.replace( '\\', '/' ) )
+                        self.record_action( command, None, dst, 'pruned', 0, time.perf_counter() )
+                    except OSError:
+                        self.error( "Unable to prune file: " + dst )
+
+    def fetch_to_temp_file( self, from_uri, handler, validators = None ):
+        # Each remote file is only fetched once per run, however many destinations it is installed to.  If
+        # validators are given, a conditional request is made, and not_modified is returned if the file is unchanged.
+        if not re.match( 'https?://', from_uri ) and not is_git_uri( from_uri ):
+            return self.local_copy_to_temp_file( from_uri )     # Taking a local copy is not optimal, but keeps the subsequent update logic the same
+        key = (handler.command, from_uri)
+        fetched_name = self.session.fetched_files.get( key )
+        if fetched_name and not os.path.isfile( fetched_name ):
+            fetched_name = None
+        self.session.trace_instant( 'fetch', 'cache', uri=from_uri, outcome='hit' if fetched_name else 'miss' )
+        self.session.count_cache( 'download', fetched_name != None )
+        if not fetched_name:
+            # A download staged by an interrupted run is revalidated, and only used if the server says it is unchanged
+            resumed = self.session.journal.take( handler.command, from_uri ) if self.session.journal else None
+            fetched_name = handler.download_to_temp_file( from_uri, make_conditional_headers( resumed if resumed else validators ) )
+            if resumed and fetched_name == not_modified:
+                self.session.trace_instant( 'resume', 'cache', uri=from_uri )
+                self.session.note_response_validators( from_uri, { 'ETag': resumed.get( 'etag' ), 'Last-Modified': resumed.get( 'last_modified' ) } )
+                fetched_name = resumed['tmp']
+                if self.session.bundle_writer:     # The body wasn't fetched in this run, but is still needed in the bundle
+                    self.session.bundle_writer.record_file( from_uri, fetched_name )
+            elif resumed:
+                discard_temp_file( resumed['tmp'] )
+            if not fetched_name or fetched_name == not_modified:
+                return fetched_name
+            if self.session.journal:
+                self.session.journal.record( handler.command, from_uri, fetched_name, self.session.response_validators.get( from_uri ) )
+        self.session.fetched_files[key] = fetched_name
+        return self.local_copy_to_temp_file( fetched_name )
 
     def is_file_already_downloaded( self, src, dst ):
-        key = src + "\n" + dst
-        if os.path.isfile( dst ) and key in ProcessDeps.processed_downloads:    # Allow for file being deleted between downloads for some reason
+        key = src + "\n" + os.path.abspath( dst )     # Absolute, so that downloads are distinguished across project roots
+        if os.path.isfile( dst ) and key in self.session.processed_downloads:    # Allow for file being deleted between downloads for some reason
             return True
-        ProcessDeps.processed_downloads[key] = True
+        self.session.processed_downloads[key] = True
+        return False
+
+    def is_download_pending( self, src, dst ):
+        for download in self.pending_downloads:
+            if download.uri == src and download.dst == dst:
+                return True
         return False
 
     def conditionally_update_dst_file( self, tmp_name, to_file ):
-        if not os.path.isfile( to_file ):
+        import filecmp
+        with self.session.trace_span( 'compare', 'file', dst=to_file ) as span:
+            if not os.path.isfile( to_file ):
+                outcome = 'created'
+            elif not filecmp.cmp( tmp_name, to_file ):
+                outcome = 'updated'
+            else:
+                outcome = 'same'
+            span.set( 'outcome', outcome )
+        if self.session.check:
+            os.unlink( tmp_name )
+            if outcome == 'same':
+                self.session.print_action( 'Same......', to_file )
+                return 'same'
+            self.note_file_changed()
+            self.session.print_action( 'Stale.....', to_file )
+            return 'stale'
+        if outcome == 'created':
             if os.path.dirname( to_file ):
                 os.makedirs( os.path.dirname( to_file ), exist_ok=True )
-            shutil.move( tmp_name, to_file )
-            self.is_last_file_changed = self.are_files_changed = ProcessDeps.are_any_files_changed = True
-            print( 'Created...', to_file )
-        elif not filecmp.cmp( tmp_name, to_file ):
-            shutil.move( tmp_name, to_file )
-            self.is_last_file_changed = self.are_files_changed = ProcessDeps.are_any_files_changed = True
-            print( 'Updated...', to_file )
+            with self.session.trace_span( 'move', 'file', dst=to_file ):
+                self.session.install_file( tmp_name, to_file )
+            self.note_file_changed()
+            self.session.print_action( 'Created...', to_file )
+        elif outcome == 'updated':
+            with self.session.trace_span( 'move', 'file', dst=to_file ):
+                self.session.install_file( tmp_name, to_file )
+            self.note_file_changed()
+            self.session.print_action( 'Updated...', to_file )
         else:
             os.unlink( tmp_name )
-            print( 'Same......', to_file )
+            self.session.print_action( 'Same......', to_file )
+        return outcome
+
+    def note_file_changed( self ):
+        self.is_last_file_changed = self.are_files_changed = self.session.are_any_files_changed = True
 
     def make_master_strand_uri( self, file_name ):
         # Override ${master} and ${path} variable
@@ -509,17 +1822,21 @@ class ProcessDeps:
         if uri == None:
             uri = self.uritemplate
         uri = re.compile( '\$\{file\}' ).sub( file_name, uri )
-        return self.expand_variables( uri )
+        uri = self.expand_variables( uri )
+        return uri if re.match( 'https?://', uri ) or is_git_uri( uri ) else self.local_path( uri )
 
     def make_destination_file_name( self, src, dst ):
         # dst in a get command may refer to a folder, in which case the base file name from the src needs to be incorporated
-        dst = self.expand_variables( dst )
+        dst = self.local_path( self.expand_variables( dst ) )
         if dst.endswith( '/' ) or os.path.isdir( dst ):
             if not dst.endswith( '/' ):
                 dst = dst + '/'
             return dst + os.path.basename( src )
         return dst
 
+    def local_path( self, path ):
+        return self.session.root_relative( path )
+
     def expand_variables( self, uri ):
         while( True ):
             m = re.search( '\$\{(\w+)\}', uri )
@@ -547,7 +1864,7 @@ class ProcessDeps:
     def local_copy_to_temp_file( self, file ):
         try:
             with open( file, 'rb' ) as fin:
-                with tempfile.NamedTemporaryFile( mode='wb', delete=False ) as fout:
+                with self.session.make_temp_file( 'wb' ) as fout:
                     while True:
                         data = fin.read( 1000 )
                         if not data:
@@ -560,20 +1877,26 @@ class ProcessDeps:
 
     def consider_subst( self, command, arguments ):
         if command == 'subst' and arguments != None:
+            start = time.perf_counter()
             src, dst = split_in_2( arguments )    # dst maybe = None
             if dst == None:
                 dst = src
+            src = self.local_path( src )
+            dst = self.local_path( dst )
             try:
                 with open( src, 'rt', encoding='utf-8' ) as fin:
                     tempname = None
-                    with tempfile.NamedTemporaryFile( mode='wt', delete=False, encoding='utf-8' ) as fout:
+                    with self.session.make_temp_file( 'wt', encoding='utf-8' ) as fout:
                         tempname = fout.name
                         for line in fin:
                             fout.write( self.subst_expand_variables( line ) )
                     if tempname:    # Temp file needs to be closed (via 'with' statement) before we can move it
-                        self.conditionally_update_dst_file( tempname, dst )
+                        size = os.path.getsize( tempname )
+                        outcome = self.conditionally_update_dst_file( tempname, dst )
+                        self.record_action( 'subst', src, dst, outcome, size, start )
             except FileNotFoundError:
                 self.error( "Unable to open file for 'subst' command: " + src )
+                self.record_action( 'subst', src, dst, 'error', 0, start )
             return True
         return False
 
@@ -592,73 +1915,159 @@ class ProcessDeps:
                 return line
 
     def consider_file_ops( self, command, arguments ):
+        import shutil
         if (command == 'cp' or command == 'mv') and arguments != None:
             src_spec, dst_spec = split_in_2( arguments )    # dst_spec maybe = None
             if dst_spec == None:
                 return False
             op = command
-            src = self.expand_variables( src_spec )
+            src = self.local_path( self.expand_variables( src_spec ) )
             dst = self.make_destination_file_name( src, dst_spec )
+            start = time.perf_counter()
             if op == 'cp':
                 try:
-                    if self.is_copy_needed( src, dst ):
+                    if self.session.check:
+                        outcome = 'stale' if self.is_copy_needed( src, dst ) else 'same'
+                        self.session.print_action( { 'stale': 'Stale.....', 'same': 'Same......' }[outcome], dst )
+                        self.record_action( 'cp', src, dst, outcome, 0, start )
+                    elif self.is_copy_needed( src, dst ):
+                        if os.path.isfile( dst ) or os.path.islink( dst ):
+                            os.unlink( dst )    # So that a destination linked into the content cache is replaced, rather than written through
                         shutil.copy( src, dst )
-                        print( 'cp........', dst )
+                        self.session.print_action( 'cp........', dst )
+                        self.record_action( 'cp', src, dst, 'copied', os.path.getsize( dst ), start )
+                    else:
+                        self.record_action( 'cp', src, dst, 'same', 0, start )
                 except:
                     self.error( "Unable to 'cp' file '" + src + "' to '" + dst + "'" )
+                    self.record_action( 'cp', src, dst, 'error', 0, start )
             elif op == 'mv':
                 try:
                     shutil.move( src, dst )
-                    print( 'mv........', dst )
+                    self.session.print_action( 'mv........', dst )
+                    self.record_action( 'mv', src, dst, 'moved', 0, start )
                 except:
                     self.error( "Unable to 'mv' file '" + src + "' to '" + dst + "'" )
+                    self.record_action( 'mv', src, dst, 'error', 0, start )
             return True
 
         if (command == 'mkdir' or command == 'rmdir' or command == 'rm') and arguments != None:
             op = command
-            path = self.expand_variables( arguments )
+            path = self.local_path( self.expand_variables( arguments ) )
             if op == 'mkdir':
                 try:
                     os.makedirs( path, exist_ok=True )
-                    print( 'mkdir.....', path )
+                    self.session.print_action( 'mkdir.....', path )
                 except:
                     self.error( "Unable to 'mkdir' for '" + path + "'" )
             elif op == 'rmdir':
                 try:
                     shutil.rmtree( path )
-                    print( 'rmdir.....', path )
+                    self.session.print_action( 'rmdir.....', path )
                 except:
                     self.error( "Unable to 'rmdir' on '" + path + "'" )
             elif op == 'rm':
                 try:
                     os.unlink( path )
-                    print( 'rm........', path )
+                    self.session.print_action( 'rm........', path )
                 except:
                     self.error( "Unable to 'rm' file '" + path + "'" )
             return True
 
         if command == 'touch' and arguments != None:
             op = command
-            file = self.expand_variables( arguments )
+            file = self.local_path( self.expand_variables( arguments ) )
             open( file, 'a' ).close()
             return True
         return False
 
     def is_copy_needed( self, src, dst ):
+        import filecmp
         return not os.path.isfile( dst ) or not filecmp.cmp( src, dst )
 
     def consider_exec( self, command, arguments ):
         if command == 'exec' and arguments != None:
-            cmd = arguments
-            org_cwd = os.getcwd()
-            file_dirname = os.path.dirname( self.file )
-            if file_dirname:
-                os.chdir( file_dirname )
-            os.system( self.expand_variables( cmd ) )
-            os.chdir( org_cwd )
+            start = time.perf_counter()
+            cmd = self.expand_variables( arguments )
+            result = run_exec_command( cmd, self.exec_cwd(), self.make_exec_output_printer( self.line_num ) )
+            self.report_exec_result( cmd, result, self.line_num, start )
+            return True
+        return False
+
+    def consider_background_exec( self, command, arguments ):
+        if command == 'exec&' and arguments != None:
+            cmd = self.expand_variables( arguments )
+            self.session.background_execs.append( BackgroundExec( self, cmd, self.exec_cwd() ) )
+            return True
+        return False
+
+    def consider_execwait( self, command, arguments ):
+        if command == 'execwait':
+            self.session.wait_for_background_execs()
             return True
         return False
 
+    def consider_execmemo( self, command, arguments ):
+        if command == 'execmemo' and arguments != None:
+            start = time.perf_counter()
+            parts = self.expand_variables( arguments ).split( maxsplit=2 )
+            if len( parts ) != 3:
+                self.error( "'execmemo' requires comma separated lists of input and output files (or '-'), followed by a command" )
+                return True
+            inputs_spec, outputs_spec, cmd = parts
+            cwd = self.exec_cwd()
+            inputs = self.find_execmemo_files( inputs_spec, cwd, True )
+            outputs = self.find_execmemo_files( outputs_spec, cwd, False )
+            for file in inputs + outputs:
+                self.session.note_input_file( file )
+            # The command is skipped if it last succeeded with the same inputs, and its outputs still exist
+            key = os.path.abspath( cwd if cwd else '.' ) + '\n' + cmd
+            digest = make_execmemo_digest( cmd, inputs )
+            if self.session.state and self.session.state.get( 'execmemo' ).get( key ) == digest and all( os.path.exists( output ) for output in outputs ):
+                self.session.print_action( 'Memoised..', cmd )
+                self.record_action( 'execmemo', cmd, None, 'cached', 0, start )
+                return True
+            result = run_exec_command( cmd, cwd, self.make_exec_output_printer( self.line_num ) )
+            self.report_exec_result( cmd, result, self.line_num, start, 'execmemo' )
+            if result.returncode == 0 and self.session.state:
+                self.session.state.set( 'execmemo', key, digest )
+            return True
+        return False
+
+    def find_execmemo_files( self, spec, cwd, is_input ):
+        # Names are relative to the directory the command is run in.  Inputs may contain wildcards.
+        files = []
+        if spec == '-':
+            return files
+        for name in spec.split( ',' ):
+            file = os.path.join( cwd, name ) if cwd else name
+            if is_input and is_wildcard( name ):
+                files.extend( sorted( glob.glob( file ) ) )
+            else:
+                files.append( file )
+        return files
+
+    def exec_cwd( self ):
+        # Commands are run in the directory of the exodep file, without changing the process-wide working directory
+        file_dirname = os.path.dirname( self.file ) if self.file[0] != "<" else self.session.root
+        return file_dirname if file_dirname else None
+
+    def make_exec_output_printer( self, line_num ):
+        # Output is shown as the command produces it, rather than once it has exited
+        prefix = '[' + os.path.basename( self.file ) + ':' + str( line_num ) + '] '
+        def print_line( line ):
+            self.session.print( prefix + line )
+            self.session.flush_output()
+        return print_line
+
+    def report_exec_result( self, cmd, result, line_num, start, command = 'exec' ):
+        print_line = self.make_exec_output_printer( line_num )
+        for line in result.stdout.splitlines():     # Output that was not shown while the command ran
+            print_line( line )
+        if result.returncode != 0:
+            self.add_alert( "'" + command + "' command exited with status " + str( result.returncode ) + ": " + cmd, line_num )
+        self.record_action( command, cmd, None, 'ok' if result.returncode == 0 else 'failed', 0, start )
+
     def consider_on_conditional( self, command, arguments ):
         if command == 'on' and arguments != None and arguments[0] == '$':
             var, instruction = split_in_2( arguments )
@@ -679,7 +2088,7 @@ class ProcessDeps:
             dir, instruction = split_in_2( arguments )
             if instruction == None:
                 return False
-            if self.is_sought_condition( os.path.isdir( dir ) ):
+            if self.is_sought_condition( os.path.isdir( self.local_path( dir ) ) ):
                 self.process_line( instruction )
             return True
         return False
@@ -689,7 +2098,7 @@ class ProcessDeps:
             file, instruction = split_in_2( arguments )
             if instruction == None:
                 return False
-            if self.is_sought_condition( os.path.isfile( file ) ):
+            if self.is_sought_condition( os.path.isfile( self.local_path( file ) ) ):
                 self.process_line( instruction )
             return True
         return False
@@ -713,7 +2122,7 @@ class ProcessDeps:
     def consider_onanychanged( self, command, arguments ):
         if command == 'onanychanged' and arguments != None:
             instruction = arguments
-            if self.is_sought_condition( ProcessDeps.are_any_files_changed ):
+            if self.is_sought_condition( self.session.are_any_files_changed ):
                 self.process_line( instruction )
             return True
         return False
@@ -721,7 +2130,7 @@ class ProcessDeps:
     def consider_onalerts( self, command, arguments ):
         if command == 'onalerts' and arguments != None:
             instruction = arguments
-            if self.is_sought_condition( ProcessDeps.shown_alert_messages != "" or ProcessDeps.alert_messages != "" ):
+            if self.is_sought_condition( self.session.shown_alert_messages != "" or self.session.alert_messages != "" ):
                 self.process_line( instruction )
             return True
         return False
@@ -756,9 +2165,9 @@ class ProcessDeps:
         if command == 'echo':
             message = arguments
             if message:
-                print( self.expand_variables( message ) )
+                self.session.print( self.expand_variables( message ) )
             else:
-                print( "" )
+                self.session.print( "" )
             return True
         return False
 
@@ -767,64 +2176,96 @@ class ProcessDeps:
             message = arguments
             if message:
                 message = self.expand_variables( message )
-            pause( message )
+            self.session.pause( message )
             return True
         return False
 
     def consider_alert( self, command, arguments ):
         if command == 'alert' and arguments != None:
             message = self.expand_variables( arguments )
-            alert = "ALERT: " + self.file + " (" + str(self.line_num) + "):\n" + "       " + message
-            print( alert )
-            if ProcessDeps.alert_messages != "":
-                ProcessDeps.alert_messages += "\n"
-            ProcessDeps.alert_messages += alert
+            self.add_alert( message, self.line_num )
             return True
         return False
 
+    def add_alert( self, message, line_num ):
+        alert = "ALERT: " + self.file + " (" + str(line_num) + "):\n" + "       " + message
+        self.session.print_urgent( alert )
+        with self.session.lock:
+            if self.session.alert_messages != "":
+                self.session.alert_messages += "\n"
+            self.session.alert_messages += alert
+            self.session.results.alerts.append( alert )
+
     def consider_showalerts( self, command, arguments ):
         if command == 'showalerts':
-            if ProcessDeps.alert_messages != "":
-                print( "RECORDED ALERTS:" )
-                print( ProcessDeps.alert_messages )
-                if ProcessDeps.shown_alert_messages != "":
-                    ProcessDeps.shown_alert_messages += "\n"
-                ProcessDeps.shown_alert_messages = ProcessDeps.alert_messages
-                ProcessDeps.alert_messages = ""
+            if self.session.alert_messages != "":
+                self.session.print_urgent( "RECORDED ALERTS:" )
+                self.session.print_urgent( self.session.alert_messages )
+                if self.session.shown_alert_messages != "":
+                    self.session.shown_alert_messages += "\n"
+                self.session.shown_alert_messages = self.session.alert_messages
+                self.session.alert_messages = ""
             return True
         return False
 
     def consider_alertstofile( self, command, arguments ):
+        import shutil
         if command == 'alertstofile' and arguments != None:
-            file = arguments
+            file = self.local_path( arguments )
             if os.path.isfile( file ):
                 shutil.move( file, file + ".old" )
-            if ProcessDeps.shown_alert_messages != "" or ProcessDeps.alert_messages != "":
+            if self.session.shown_alert_messages != "" or self.session.alert_messages != "":
                 with open( file, 'w') as fout:
-                    if ProcessDeps.shown_alert_messages != "":
-                        fout.write( ProcessDeps.shown_alert_messages + "\n" )
-                    if ProcessDeps.alert_messages != "":
-                        fout.write( ProcessDeps.alert_messages + "\n" )
+                    if self.session.shown_alert_messages != "":
+                        fout.write( self.session.shown_alert_messages + "\n" )
+                    if self.session.alert_messages != "":
+                        fout.write( self.session.alert_messages + "\n" )
             return True
         return False
 
     def consider_stop( self, command, arguments ):
         if command == 'stop':
             message = arguments # May be None
-            print( "STOPPED: " + self.file + " (" + str(self.line_num) + "):" )
+            self.session.print_urgent( "STOPPED: " + self.file + " (" + str(self.line_num) + "):" )
             if message:
-                print( "      " + self.expand_variables( message ) )
-            if self.file != onstop_exodep and os.path.isfile( onstop_exodep ):
-                ProcessDeps( onstop_exodep, self.vars )
+                self.session.print_urgent( "      " + self.expand_variables( message ) )
+            onstop_file = self.local_path( onstop_exodep )
+            if self.file != onstop_file and os.path.isfile( onstop_file ):
+                ProcessDeps( onstop_file, self.vars, self.session )
             raise StopException
         return False
 
     def report_unrecognised_command( self, line ):
         self.error( "Unrecognised command: " + line )
 
+    def record_action( self, command, uri, dst, outcome, size, start, timings = None ):
+        if dst and outcome in [ 'created', 'updated', 'same', 'repeat', 'copied', 'moved' ] and command != 'authority':
+            self.session.record_dst_inputs( dst, self.find_dst_inputs( uri ) )
+        event = { 'command': command, 'uri': uri, 'dst': dst, 'outcome': outcome, 'bytes': size,
+                    'duration': round( time.perf_counter() - start, 6 ), 'file': self.file, 'line': self.line_num }
+        if timings:
+            event.update( timings )
+        self.session.record_action( event )
+
+    def find_dst_inputs( self, src ):
+        # The exodep files that led to a destination being made, along with any local files it was made from
+        inputs = []
+        if self.file[0] != "<":
+            inputs.append( self.file )
+            inputs.extend( self.session.find_exodep_includers( self.file ) )
+        inputs.extend( self.versions_files )
+        if src and not re.match( '[a-z]+://', src ) and os.path.isfile( src ):
+            inputs.append( src.replace( '\\', '/' ) )
+        return inputs
+
+    def note_cut_short( self, uri ):
+        # Transfers stopped by the run deadline are reported as incomplete, rather than as errors
+        self.session.note_incomplete( self.file, self.line_num, "Cut short by the run deadline: " + uri )
+
     def error( self, what ):
-        print( "Error:", self.file + ", line " + str(self.line_num) + ":" )
-        print( "      ", what )
+        self.session.record_error( self.file + ", line " + str(self.line_num) + ": " + what )
+        self.session.print_urgent( "Error:", self.file + ", line " + str(self.line_num) + ":" )
+        self.session.print_urgent( "      ", what )
 
 def remove_comments( line ):
     return line.split( '#', 1 )[0].rstrip()
@@ -838,6 +2279,574 @@ def split_in_2( text ):
         return [ parts[0], None ]
     return parts
 
+def parse_versions_info( fin ):
+    versions = {}
+    for line in fin:
+        if isinstance( line, bytes ):
+            line = line.decode( 'utf-8' )
+        line = line.rstrip()
+        line = remove_comments( line )
+        if not is_blank_line( line ):
+            m = re.match( '^(\S+)\s+(.*)', line )
+            if m != None:
+                versions[m.group(2)] = m.group(1)
+    return versions
+
+class RecipeGraph:
+    # The order recipes must be processed in.  A recipe comes after the recipes named by its 'uses' commands,
+    # and a recipe that another recipe includes comes after that recipe, so that it is processed with the
+    # includer's variables.
+    def __init__( self, files ):
+        self.files = files
+        by_name = {}
+        for file in files:
+            by_name.setdefault( os.path.basename( file ), file )
+        by_path = { os.path.normpath( file ): file for file in files }
+        self.prerequisites = { file: [] for file in files }     # Each entry is <file> : <files that must be processed before it>
+        for file in files:
+            for uri, line_num in find_commands( file, 'uses' ):
+                self.add_edge( by_name.get( os.path.basename( uri ) ), file )
+            for included, line_num in find_commands( file, 'include' ):
+                self.add_edge( file, by_path.get( os.path.normpath( os.path.join( os.path.dirname( file ), included ) ) ) )
+
+    def add_edge( self, before, after ):
+        if before and after and before != after and before not in self.prerequisites[after]:
+            self.prerequisites[after].append( before )
+
+    def find_dependents( self ):
+        dependents = { file: [] for file in self.files }
+        for file in self.files:
+            for prerequisite in self.prerequisites[file]:
+                dependents[prerequisite].append( file )
+        return dependents
+
+    def find_cycle( self ):
+        # Returns the files making up a cycle, with the first file repeated at the end, or None if there is no cycle
+        states = {}     # Each entry is <file> : 'visiting' or 'done'
+        def visit( file, path ):
+            states[file] = 'visiting'
+            path.append( file )
+            for prerequisite in self.prerequisites[file]:
+                if states.get( prerequisite ) == 'visiting':
+                    return path[path.index( prerequisite ):] + [prerequisite]
+                if prerequisite not in states:
+                    cycle = visit( prerequisite, path )
+                    if cycle:
+                        return cycle
+            path.pop()
+            states[file] = 'done'
+            return None
+        for file in self.files:
+            if file not in states:
+                cycle = visit( file, [] )
+                if cycle:
+                    return list( reversed( cycle ) )
+        return None
+
+    def find_critical_path( self, durations ):
+        # Returns the chain of dependent recipes that took the longest in total, and its duration
+        longest = {}    # Each entry is <file> : (<duration of longest chain ending at file>, <chain>)
+        def chain( file ):
+            if file not in longest:
+                best = (0, [])
+                for prerequisite in self.prerequisites[file]:
+                    best = max( best, chain( prerequisite ), key=lambda item: item[0] )
+                longest[file] = (best[0] + durations.get( file, 0 ), best[1] + [file])
+            return longest[file]
+        best = (0, [])
+        for file in self.files:
+            best = max( best, chain( file ), key=lambda item: item[0] )
+        return (best[1], best[0])
+
+class PendingDownload:
+    def __init__( self, uri, dst, handler, start, line_num ):
+        import urllib.parse
+        self.uri = uri
+        self.dst = dst
+        self.handler = handler
+        self.start = start
+        self.line_num = line_num
+        self.host = urllib.parse.urlsplit( uri ).hostname if re.match( 'https?://', uri ) else ''
+        self.tmp_name = None
+        self.queue_wait = self.transfer = 0
+
+class DownloadScheduler:
+    # Runs batches of downloads concurrently, largest first (based on the sizes seen in earlier runs),
+    # while keeping to any per-host concurrency and request rate limits.  Local files are not limited.
+    def __init__( self, session, jobs = 4, host_limits = None, host_rates = None ):
+        self.session = session
+        self.jobs = max( jobs, 1 )
+        self.host_limits = host_limits if host_limits else {}   # Each entry is <host, or None for any host> : <max concurrent downloads>
+        self.host_rates = host_rates if host_rates else {}      # Each entry is <host, or None for any host> : <max requests per second>
+        if any( value <= 0 for value in list( self.host_limits.values() ) + list( self.host_rates.values() ) ):
+            raise ValueError( "Host limits and rates must be greater than 0" )
+        self.condition = threading.Condition()
+        self.n_active = 0
+        self.host_active = {}
+        self.host_last_start = {}
+
+    def is_pipelined( self ):
+        return self.jobs > 1
+
+    def fetch_all( self, downloads, fetch ):
+        # Downloads of the same file are grouped so that the file is only fetched once
+        groups = {}
+        for download in downloads:
+            groups.setdefault( (download.handler.command, download.uri), [] ).append( download )
+        queue = list( groups.values() )
+        queue.sort( key=lambda group: -self.session.expected_download_size( group[0].uri ) )
+        threads = []
+        while queue:
+            group = self.start_next( queue )
+            if self.jobs <= 1 or not queue:     # The last group is fetched on this thread, which saves starting another
+                self.fetch_group_in_slot( group, fetch )
+            else:
+                thread = threading.Thread( target=self.fetch_group_in_slot, args=(group, fetch) )
+                thread.start()
+                threads.append( thread )
+        for thread in threads:
+            thread.join()
+
+    def start_next( self, queue ):
+        # Waits until a group in the queue can be started within the limits, and takes a slot for it.  Single
+        # downloads go through here too, so that the limits also apply to them, and to other recipes' downloads.
+        with self.condition:
+            while True:
+                group = self.find_startable( queue )
+                if group != None:
+                    break
+                self.condition.wait( self.find_rate_wait( queue ) )
+            queue.remove( group )
+            host = group[0].host
+            self.n_active += 1
+            self.host_active[host] = self.host_active.get( host, 0 ) + 1
+            self.host_last_start[host] = time.perf_counter()
+            return group
+
+    def find_startable( self, queue ):
+        if self.n_active >= self.jobs:
+            return None
+        now = time.perf_counter()
+        for group in queue:
+            host = group[0].host
+            if host == '' or (self.host_active.get( host, 0 ) < self.host_limit( host ) and now >= self.next_start_time( host )):
+                return group
+        return None
+
+    def find_rate_wait( self, queue ):
+        # Returns how long to wait before a rate limited host can be started, or None to wait for a download to finish
+        if self.n_active >= self.jobs:
+            return None
+        now = time.perf_counter()
+        waits = [self.next_start_time( group[0].host ) - now for group in queue
+                    if group[0].host != '' and self.host_active.get( group[0].host, 0 ) < self.host_limit( group[0].host )]
+        return max( min( waits ), 0.001 ) if waits else None
+
+    def host_limit( self, host ):
+        return int( self.host_limits.get( host, self.host_limits.get( None, self.jobs ) ) )
+
+    def next_start_time( self, host ):
+        rate = self.host_rates.get( host, self.host_rates.get( None ) )
+        if not rate or host not in self.host_last_start:
+            return 0
+        return self.host_last_start[host] + 1 / rate
+
+    def fetch_group_in_slot( self, group, fetch ):
+        try:
+            self.fetch_group( group, fetch )
+        finally:
+            with self.condition:
+                self.n_active -= 1
+                self.host_active[group[0].host] -= 1
+                self.condition.notify_all()    # Several batches may be waiting when recipes are processed concurrently
+
+    def fetch_group( self, group, fetch ):
+        for download in group:
+            started = time.perf_counter()
+            download.queue_wait = started - download.start
+            if self.session.tracer:
+                self.session.tracer.add_span( 'queue', 'scheduler', download.start, started, { 'uri': download.uri } )
+            fetch( download )
+            download.transfer = time.perf_counter() - started
+        if group[0].host and group[0].tmp_name and group[0].tmp_name != not_modified:
+            self.session.note_download_size( group[0].uri, os.path.getsize( group[0].tmp_name ) )
+
+class ContentCache:
+    # Files stored under the sha256 digest of their contents.  Cached files are made read-only, so that destinations
+    # that are hard or symbolic links to them are less likely to be edited in place, which would corrupt the cache.
+    # exodep itself never writes to an existing destination in place.
+    def __init__( self, dir ):
+        self.dir = dir
+
+    def add( self, tmp_name ):
+        # Moves tmp_name into the cache, and returns the name of the cached file
+        import shutil
+        digest = file_digest( tmp_name )
+        cached = os.path.join( self.dir, 'objects', digest[:2], digest[2:] )
+        if os.path.isfile( cached ):
+            if os.path.getsize( cached ) == os.path.getsize( tmp_name ) and file_digest( cached ) == digest:
+                os.unlink( tmp_name )
+                return cached
+            try:    # Truncated or corrupted, so replaced with the new copy
+                os.chmod( cached, 0o644 )
+                os.unlink( cached )
+            except OSError:
+                pass
+        os.makedirs( os.path.dirname( cached ), exist_ok=True )
+        staged = cached + '.' + str( os.getpid() ) + '-' + str( threading.get_ident() )
+        shutil.move( tmp_name, staged )
+        os.chmod( staged, 0o444 )
+        os.replace( staged, cached )
+        return cached
+
+    def install( self, cached, dst, link ):
+        import shutil
+        # Each destination falls back to a copy if the filesystem doesn't support the link method (for example,
+        # hard links across devices).  Returns the method used.
+        staged = dst + '.exodep-tmp'
+        for method in [ link, 'copy' ]:
+            try:
+                discard_temp_file( staged )
+                if method == 'hardlink':
+                    os.link( cached, staged )
+                elif method == 'symlink':
+                    os.symlink( os.path.abspath( cached ), staged )
+                elif method == 'reflink':
+                    reflink_file( cached, staged )
+                else:
+                    shutil.copyfile( cached, staged )
+                os.replace( staged, dst )
+                return method
+            except OSError:
+                discard_temp_file( staged )
+                if method == 'copy':
+                    raise
+
+def is_superuser():
+    return hasattr( os, 'geteuid' ) and os.geteuid() == 0
+
+def reflink_file( src, dst ):
+    # A copy-on-write clone, which shares the data blocks of src until either file is changed
+    if not sys.platform.startswith( 'linux' ):
+        raise OSError( "reflink is not supported on " + sys.platform )
+    import fcntl
+    ficlone = 0x40049409
+    with open( src, 'rb' ) as fin, open( dst, 'wb' ) as fout:
+        fcntl.ioctl( fout.fileno(), ficlone, fin.fileno() )
+
+class RunJournal:
+    # Downloads are made to temp files in the staging directory, and each one that has validators (an ETag or
+    # Last-Modified header) is journaled with its digest once complete.  If a run is interrupted, the next run
+    # revalidates the staged files that still match their digests with conditional requests, and reuses those the
+    # server says are unchanged rather than downloading them again.  Temp files left by runs that are no longer active
+    # are removed.
+    max_age = 3600      # Seconds that staged files are kept for resuming
+
+    def __init__( self, dir ):
+        self.dir = dir
+        self.file = os.path.join( dir, 'journal.ndjson' )
+        self.prefix = 'exodep-' + str( os.getpid() ) + '-'
+        self.resumable = {}
+        self.lock = threading.Lock()
+
+    def open( self ):
+        self.resumable = {}
+        if not os.path.isdir( self.dir ):
+            return
+        import json
+        entries = []
+        try:
+            with open( self.file, 'rt', encoding='utf-8' ) as fin:
+                for line in fin:
+                    try:
+                        entries.append( json.loads( line ) )
+                    except ValueError:
+                        pass    # Probably a partial line written when the run was interrupted
+        except OSError:
+            pass
+        for entry in entries:
+            try:
+                if (time.time() - entry['time'] <= self.max_age and
+                        os.path.getsize( entry['tmp'] ) == entry['size'] and file_digest( entry['tmp'] ) == entry['digest']):
+                    self.resumable[(entry['command'], entry['uri'])] = entry
+                    continue
+            except (OSError, KeyError, TypeError):
+                pass
+            discard_temp_file( entry.get( 'tmp' ) if isinstance( entry, dict ) else None )
+        self.remove_orphans()
+        with open( self.file, 'wt', encoding='utf-8' ) as fout:
+            for entry in self.resumable.values():
+                fout.write( json.dumps( entry ) + '\n' )
+
+    def remove_orphans( self ):
+        kept = set( os.path.basename( entry['tmp'] ) for entry in self.resumable.values() )
+        for name in os.listdir( self.dir ):
+            m = re.match( r'exodep-(\d+)-', name )
+            if m and name not in kept and not self.is_active_run( int( m.group( 1 ) ), os.path.join( self.dir, name ) ):
+                discard_temp_file( os.path.join( self.dir, name ) )
+
+    def is_active_run( self, pid, file ):
+        if pid == os.getpid():
+            return True
+        if sys.platform == 'win32':     # os.kill() can't probe a process on Windows, so go by the age of the file
+            try:
+                return time.time() - os.path.getmtime( file ) <= self.max_age
+            except OSError:
+                return False
+        try:
+            os.kill( pid, 0 )
+            return True
+        except ProcessLookupError:
+            return False
+        except OSError:     # For example, PermissionError for a process owned by another user
+            return True
+
+    def make_temp_file( self, mode, **kwargs ):
+        import tempfile
+        os.makedirs( self.dir, exist_ok=True )
+        return tempfile.NamedTemporaryFile( mode=mode, delete=False, dir=self.dir, prefix=self.prefix, **kwargs )
+
+    def record( self, command, uri, tmp_name, validators ):
+        import json
+        if not validators or not any( validators ):
+            return      # Can't be revalidated, so wouldn't be resumed
+        entry = { 'command': command, 'uri': uri, 'tmp': tmp_name, 'digest': file_digest( tmp_name ),
+                    'size': os.path.getsize( tmp_name ), 'time': time.time(), 'etag': validators[0], 'last_modified': validators[1] }
+        with self.lock:
+            with open( self.file, 'at', encoding='utf-8' ) as fout:
+                fout.write( json.dumps( entry ) + '\n' )
+
+    def take( self, command, uri ):
+        # Returns the journal entry of a staged download of uri, which the caller then owns
+        with self.lock:
+            entry = self.resumable.pop( (command, uri), None )
+        return entry if entry and os.path.isfile( entry['tmp'] ) else None
+
+    def complete( self ):
+        # The run has finished, so there is nothing to resume
+        for entry in self.resumable.values():
+            discard_temp_file( entry['tmp'] )
+        self.resumable = {}
+        discard_temp_file( self.file )
+        try:
+            os.rmdir( self.dir )
+        except OSError:
+            pass    # Not empty, perhaps because another run is in progress, or doesn't exist
+
+class BundleWriter:
+    # Keeps the body of each remote resource fetched, so that they can be written to a bundle for build
+    # machines without network access.  The bundle is a tar file holding an index.json file, mapping each uri to
+    # the SHA-256 hash of its body, followed by the bodies, named objects/<hash>.
+    def __init__( self, file ):
+        self.file = file
+        self.objects = {}       # Each entry is <uri> : <temp file holding its body>
+        self.lock = threading.Lock()
+
+    def record( self, uri, response ):
+        import tempfile
+        import shutil
+        with response, tempfile.NamedTemporaryFile( mode='wb', delete=False ) as fout:
+            shutil.copyfileobj( response, fout )
+        self.keep( uri, fout.name )
+        return BundleResponse( fout.name, response.headers )
+
+    def record_file( self, uri, file ):
+        import tempfile
+        import shutil
+        with open( file, 'rb' ) as fin, tempfile.NamedTemporaryFile( mode='wb', delete=False ) as fout:
+            shutil.copyfileobj( fin, fout )
+        self.keep( uri, fout.name )
+
+    def keep( self, uri, tmp_name ):
+        with self.lock:
+            discard_temp_file( self.objects.get( uri ) )
+            self.objects[uri] = tmp_name
+
+    def write( self ):
+        import tarfile
+        import json
+        index = { uri: { 'digest': file_digest( tmp_name ), 'size': os.path.getsize( tmp_name ) } for uri, tmp_name in self.objects.items() }
+        index_data = json.dumps( { 'objects': index }, indent=1, sort_keys=True ).encode( 'utf-8' )
+        tmp_file = self.file + '.exodep-tmp'
+        with tarfile.open( tmp_file, 'w:gz' if self.file.endswith( 'gz' ) else 'w' ) as tar:
+            info = tarfile.TarInfo( 'index.json' )  # First, so that readers know what they have before reading the bodies
+            info.size = len( index_data )
+            info.mtime = time.time()
+            tar.addfile( info, io.BytesIO( index_data ) )
+            written = set()
+            for uri in sorted( self.objects ):
+                digest = index[uri]['digest']
+                if digest not in written:
+                    tar.add( self.objects[uri], arcname='objects/' + digest )
+                    written.add( digest )
+        os.replace( tmp_file, self.file )
+        for tmp_name in self.objects.values():
+            discard_temp_file( tmp_name )
+
+class BundleReader:
+    # Serves remote resources from a bundle made by BundleWriter.  The bundle is read once, sequentially,
+    # when the first resource is needed, and the bodies are unpacked to a temp directory.  Entries whose
+    # bodies don't match the digest in the index are rejected.
+    def __init__( self, file ):
+        self.file = file
+        self.index = None
+        self.rejected = set()
+        self.dir = None
+        self.lock = threading.Lock()
+
+    def load( self ):
+        import tarfile
+        import tempfile
+        import shutil
+        import json
+        self.index = {}
+        self.dir = tempfile.mkdtemp( prefix='exodep-bundle-' )
+        try:
+            with tarfile.open( self.file, 'r|*' ) as tar:
+                for member in tar:
+                    if member.name == 'index.json':
+                        self.index = json.load( tar.extractfile( member ) )['objects']
+                    elif member.isfile() and re.match( 'objects/[0-9a-f]{64}$', member.name ):
+                        with tar.extractfile( member ) as fin, open( os.path.join( self.dir, member.name[8:] ), 'wb' ) as fout:
+                            shutil.copyfileobj( fin, fout )
+        except (tarfile.TarError, ValueError, KeyError) as e:
+            raise OSError( "Unable to read bundle " + self.file + ": " + str( e ) )
+        for uri, entry in list( self.index.items() ):
+            object_file = os.path.join( self.dir, str( entry.get( 'digest' ) ) )
+            if not (re.match( '[0-9a-f]{64}$', str( entry.get( 'digest' ) ) ) and os.path.isfile( object_file ) and
+                    os.path.getsize( object_file ) == entry.get( 'size' ) and file_digest( object_file ) == entry['digest']):
+                del self.index[uri]
+                self.rejected.add( uri )
+
+    def is_rejected( self, uri ):
+        with self.lock:
+            if self.index == None:
+                self.load()
+        return uri in self.rejected
+
+    def open( self, uri ):
+        if self.is_rejected( uri ):
+            raise OSError( "Digest mismatch in bundle " + self.file + ": " + uri )
+        if uri not in self.index:
+            raise FileNotFoundError( "Not in bundle " + self.file + ": " + uri )
+        return BundleResponse( os.path.join( self.dir, self.index[uri]['digest'] ), {} )
+
+    def close( self ):
+        import shutil
+        if self.dir:
+            shutil.rmtree( self.dir, ignore_errors=True )
+        self.index = self.dir = None
+
+class BundleResponse:
+    # A body kept in a file, presented in the same way as an HTTP response
+    def __init__( self, file, headers ):
+        self.fin = open( file, 'rb' )
+        self.headers = headers
+
+    def read( self, size = -1 ):
+        return self.fin.read( size )
+
+    def __iter__( self ):
+        return iter( self.fin )
+
+    def close( self ):
+        self.fin.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+        return False
+
+class StateStore:
+    # Information kept between runs, stored as JSON
+    def __init__( self, file ):
+        self.file = file
+        self.data = None    # Loaded when first needed, so that runs that don't need it don't read it
+        self.is_changed = False
+        self.lock = threading.Lock()
+
+    def load( self ):
+        with self.lock:
+            if self.data != None:
+                return
+            self.data = {}
+            if os.path.isfile( self.file ):
+                import json
+                try:
+                    with open( self.file ) as fin:
+                        self.data = json.load( fin )
+                except (OSError, ValueError):
+                    self.data = {}
+
+    def get( self, section ):
+        self.load()
+        return self.data.get( section, {} )
+
+    def set( self, section, key, value ):
+        self.load()
+        with self.lock:
+            if self.data.get( section, {} ).get( key ) != value:
+                self.data.setdefault( section, {} )[key] = value
+                self.is_changed = True
+
+    def save( self ):
+        if not self.is_changed:
+            return
+        import json
+        os.makedirs( os.path.dirname( self.file ), exist_ok=True )
+        tmp_name = self.file + '.tmp'
+        with open( tmp_name, 'w' ) as fout:
+            json.dump( self.data, fout, indent=1, sort_keys=True )
+        os.replace( tmp_name, self.file )
+        self.is_changed = False
+
+def is_git_uri( uri ):
+    return uri.startswith( 'git:' )
+
+def is_wildcard( file_name ):
+    return re.search( '[*?[]', file_name ) != None
+
+def scan_dir_tree( dir ):
+    # Returns a dict mapping '/' separated relative names to the files in the dir tree
+    files = {}
+    pending = [ '' ]
+    while pending:
+        rel_dir = pending.pop()
+        with os.scandir( os.path.join( dir, rel_dir ) ) as it:
+            for entry in it:
+                rel = rel_dir + entry.name
+                if entry.is_dir():
+                    pending.append( rel + '/' )
+                elif entry.is_file():
+                    files[rel] = entry.path.replace( '\\', '/' )
+    return files
+
+def sync_file( src, dst, is_check = False ):
+    import filecmp
+    import shutil
+    # Size and mtime are checked before contents, as copies made here preserve the source's mtime
+    try:
+        src_stat = os.stat( src )
+        try:
+            dst_stat = os.stat( dst )
+        except FileNotFoundError:
+            dst_stat = None
+        if dst_stat and dst_stat.st_size == src_stat.st_size and \
+                (dst_stat.st_mtime_ns == src_stat.st_mtime_ns or filecmp.cmp( src, dst, shallow=False )):
+            return 'same'
+        if is_check:
+            return 'stale'
+        if os.path.dirname( dst ):
+            os.makedirs( os.path.dirname( dst ), exist_ok=True )
+        tmp_name = dst + '.exodep-tmp'
+        shutil.copy2( src, tmp_name )
+        os.replace( tmp_name, dst )
+        return 'updated' if dst_stat else 'created'
+    except OSError:
+        return 'error'
+
 def pause( message = None ):
     print( "" )
     if message:
@@ -845,6 +2854,44 @@ def pause( message = None ):
     print( ">>> Press <Return> to continue <<<" )
     input()
 
+def run_exec_command( cmd, cwd, on_line = None ):
+    import subprocess
+    # A shell is still used so that existing recipes using shell built-ins and redirection keep working.  Each
+    # line of output is passed to on_line as it is produced, or, if there is no on_line, returned in the result.
+    lines = []
+    try:
+        with subprocess.Popen( cmd, shell=True, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True, errors='replace' ) as process:
+            for line in process.stdout:
+                (on_line if on_line else lines.append)( line.rstrip( '\n' ) )
+        return subprocess.CompletedProcess( cmd, process.returncode, ''.join( line + '\n' for line in lines ) )
+    except OSError as e:
+        return subprocess.CompletedProcess( cmd, -1, str( e ) + '\n' )
+
+def make_execmemo_digest( cmd, inputs ):
+    import hashlib
+    digest = hashlib.sha256( cmd.encode( 'utf-8' ) )
+    for input in inputs:
+        digest.update( ('\n' + input + '\n' + (file_digest( input ) if os.path.isfile( input ) else 'missing')).encode( 'utf-8' ) )
+    return digest.hexdigest()
+
+class BackgroundExec:
+    def __init__( self, pd, cmd, cwd ):
+        self.pd = pd
+        self.cmd = cmd
+        self.line_num = pd.line_num
+        self.start = time.perf_counter()
+        self.result = None
+        self.thread = threading.Thread( target=self.run, args=(cwd,) )
+        self.thread.start()
+
+    def run( self, cwd ):
+        self.result = run_exec_command( self.cmd, cwd )
+
+    def wait( self ):
+        self.thread.join()
+        self.pd.report_exec_result( self.cmd, self.result, self.line_num, self.start )
+
 def text_filecmp( file1, file2 ):
     try:
         with open( file1 ) as f1, open( file2 ) as f2:
@@ -857,17 +2904,181 @@ def text_filecmp( file1, file2 ):
     except IOError:
         return False
 
+class GitRepos:
+    # Files in local (typically bare) git repositories are identified by uris of the form 'git:<repo dir>@<strand>:<path>'
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.repos = {}     # Each entry is <repo dir> : <GitRepo>
+
+    def find( self, uri ):
+        m = re.match( 'git:([^@]*)@([^:]*):(.*)$', uri )
+        if not m:
+            return (None, None)
+        with self.lock:
+            if m.group(1) not in self.repos:
+                self.repos[m.group(1)] = GitRepo( m.group(1) )
+            repo = self.repos[m.group(1)]
+        return (repo, repo.find_blob( m.group(2), m.group(3) ))
+
+    def is_blob_at( self, uri, file ):
+        repo, blob = self.find( uri )
+        return blob != None and os.path.isfile( file ) and os.path.getsize( file ) == blob[1] and git_blob_id( file, blob[0] ) == blob[0]
+
+    def open( self, uri ):
+        repo, blob = self.find( uri )
+        if not blob:
+            raise FileNotFoundError( "Not found in git repository: " + uri )
+        return repo.open_blob( blob[0] )
+
+    def reset( self ):
+        # Strands are resolved afresh on each run
+        with self.lock:
+            for repo in self.repos.values():
+                repo.commits = {}
+
+    def close( self ):
+        with self.lock:
+            for repo in self.repos.values():
+                repo.close()
+            self.repos = {}
+
+class GitRepo:
+    # Each strand is resolved to a commit once, and file contents are streamed through one long-lived
+    # 'git cat-file --batch' process, so that only the blob ids of unchanged files need to be looked up
+    def __init__( self, dir ):
+        self.dir = dir
+        self.lock = threading.Lock()
+        self.commits = {}       # Each entry is <strand> : <commit id, or None if the strand isn't found>
+        self.batch_check = None
+        self.batch = None
+
+    def start( self, option ):
+        import subprocess
+        return subprocess.Popen( [ 'git', '-C', self.dir, 'cat-file', option ],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL )
+
+    def find_blob( self, strand, path ):
+        # Returns (<blob id>, <size>), or None if path is not a file in strand
+        try:
+            with self.lock:
+                if strand not in self.commits:
+                    info = self.query( strand + '^{commit}' )
+                    self.commits[strand] = info[0] if info else None
+                if not self.commits[strand]:
+                    return None
+                info = self.query( self.commits[strand] + ':' + path )
+                return (info[0], info[2]) if info and info[1] == 'blob' else None
+        except OSError:     # Includes git not being installed
+            return None
+
+    def query( self, object_name ):
+        if not self.batch_check:
+            self.batch_check = self.start( '--batch-check' )
+        self.batch_check.stdin.write( (object_name + '\n').encode( 'utf-8' ) )
+        self.batch_check.stdin.flush()
+        fields = self.batch_check.stdout.readline().decode( 'utf-8' ).split()
+        if len( fields ) != 3:     # '<object name> missing', or the directory isn't a git repository
+            return None
+        return (fields[0], fields[1], int( fields[2] ))
+
+    def open_blob( self, blob_id ):
+        self.lock.acquire()     # Released when the returned GitBlobReader is closed
+        try:
+            if not self.batch:
+                self.batch = self.start( '--batch' )
+            self.batch.stdin.write( (blob_id + '\n').encode( 'utf-8' ) )
+            self.batch.stdin.flush()
+            fields = self.batch.stdout.readline().decode( 'utf-8' ).split()
+            if len( fields ) != 3:
+                raise FileNotFoundError( "Unable to read git blob: " + blob_id )
+            return GitBlobReader( self, int( fields[2] ) )
+        except:
+            self.lock.release()
+            raise
+
+    def close( self ):
+        for process in [ self.batch_check, self.batch ]:
+            if process:
+                process.stdin.close()
+                process.wait()
+                process.stdout.close()
+        self.batch_check = self.batch = None
+
+class GitBlobReader:
+    # A file-like view of a blob being streamed from 'git cat-file --batch'
+    headers = {}
+
+    def __init__( self, repo, size ):
+        self.repo = repo
+        self.remaining = size
+
+    def read( self, size = -1 ):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.repo.batch.stdout.read( size ) if size else b''
+        if len( data ) < size:
+            raise OSError( "Unexpected end of git blob" )
+        self.remaining -= len( data )
+        return data
+
+    def __iter__( self ):
+        while self.remaining:
+            line = self.repo.batch.stdout.readline( self.remaining )
+            if not line:
+                raise OSError( "Unexpected end of git blob" )
+            self.remaining -= len( line )
+            yield line
+
+    def close( self ):
+        if self.repo:
+            self.repo.batch.stdout.read( self.remaining + 1 )  # Includes the newline that follows each blob
+            self.repo.lock.release()
+            self.repo = None
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+        return False
+
+def git_blob_id( file, like_id ):
+    import hashlib
+    # Git hashes a header followed by the content.  The type of hash matches that of like_id
+    digest = hashlib.sha1() if len( like_id ) == 40 else hashlib.sha256()
+    digest.update( ('blob ' + str( os.path.getsize( file ) ) + '\0').encode( 'utf-8' ) )
+    with open( file, 'rb' ) as fin:
+        while True:
+            data = fin.read( 65536 )
+            if not data:
+                break
+            digest.update( data )
+    return digest.hexdigest()
+
 class TextDownloadHandler:
-    def download_to_temp_file( self, uri ):
+    command = 'get'
+
+    def __init__( self, session ):
+        self.session = session
+
+    def download_to_temp_file( self, uri, headers = None ):
+        tmp_name = None
         try:
-            with urllib.request.urlopen( uri ) as fin:
-                with tempfile.NamedTemporaryFile( mode='wt', delete=False, encoding='utf-8' ) as fout:
+            with self.session.open_uri( uri, headers ) as fin, self.session.trace_span( 'body', 'network', uri=uri ) as span:
+                self.session.note_response_validators( uri, fin.headers )
+                with self.session.make_temp_file( 'wt', encoding='utf-8' ) as fout:
+                    tmp_name = fout.name
+                    size = 0
                     for line in fin:
+                        self.session.check_deadline()
+                        size += len( line )
                         fout.write( self.normalise_line_ending( line.decode('utf-8') ) )
+                    self.session.note_bytes_fetched( span, size )
                     return fout.name
             return ''
-        except urllib.error.URLError:
-            return ''
+        except OSError as e:    # Includes HTTP errors and timeouts
+            discard_temp_file( tmp_name )
+            return not_modified if getattr( e, 'code', None ) == 304 else ''
 
     def normalise_line_ending( self, line ):
         org_len = len( line )
@@ -877,19 +3088,395 @@ class TextDownloadHandler:
         return line
 
 class BinaryDownloadHandler:
-    def download_to_temp_file( self, uri ):
+    command = 'bget'
+
+    def __init__( self, session ):
+        self.session = session
+
+    def download_to_temp_file( self, uri, headers = None ):
+        tmp_name = None
         try:
-            with urllib.request.urlopen( uri ) as fin:
-                with tempfile.NamedTemporaryFile( mode='wb', delete=False ) as fout:
+            with self.session.open_uri( uri, headers ) as fin, self.session.trace_span( 'body', 'network', uri=uri ) as span:
+                self.session.note_response_validators( uri, fin.headers )
+                with self.session.make_temp_file( 'wb' ) as fout:
+                    tmp_name = fout.name
+                    size = 0
                     while True:
+                        self.session.check_deadline()
                         data = fin.read( 1000 )
                         if not data:
                             break
+                        size += len( data )
                         fout.write( data )
+                    self.session.note_bytes_fetched( span, size )
                     return fout.name
             return ''
-        except urllib.error.URLError:
-            return ''
+        except OSError as e:    # Includes HTTP errors and timeouts
+            discard_temp_file( tmp_name )
+            return not_modified if getattr( e, 'code', None ) == 304 else ''
+
+def make_conditional_headers( validators ):
+    headers = {}
+    if validators and validators.get( 'etag' ):
+        headers['If-None-Match'] = validators['etag']
+    if validators and validators.get( 'last_modified' ):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+def file_digest( file ):
+    import hashlib
+    digest = hashlib.sha256()
+    with open( file, 'rb' ) as fin:
+        while True:
+            data = fin.read( 65536 )
+            if not data:
+                break
+            digest.update( data )
+    return digest.hexdigest()
+
+def discard_temp_file( tmp_name ):
+    if tmp_name:
+        try:
+            os.unlink( tmp_name )
+        except OSError:
+            pass
+
+class Tracer:
+    def __init__( self ):
+        self.events = []
+        self.origin = time.perf_counter()
+
+    def add_span( self, name, cat, start, end, args ):
+        self.events.append( { 'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                                'ts': self.to_us( start ), 'dur': self.to_us( end ) - self.to_us( start ), 'args': args } )
+
+    def add_instant( self, name, cat, args ):
+        self.events.append( { 'name': name, 'cat': cat, 'ph': 'i', 's': 't', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                                'ts': self.to_us( time.perf_counter() ), 'args': args } )
+
+    def to_us( self, t ):
+        return int( (t - self.origin) * 1000000 )
+
+    def write( self, file ):
+        import json
+        with open( file, 'w' ) as fout:
+            json.dump( { 'traceEvents': self.events, 'displayTimeUnit': 'ms' }, fout, indent=0 )
+
+class TraceSpan:
+    def __init__( self, tracer, name, cat, args ):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__( self ):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        if self.tracer:
+            if exc_type:
+                self.args['exception'] = exc_type.__name__
+            self.tracer.add_span( self.name, self.cat, self.start, time.perf_counter(), self.args )
+        return False
+
+    def set( self, key, value ):
+        self.args[key] = value
+
+class Metrics:
+    latency_buckets = [ 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10 ]
+    file_commands = [ 'get', 'bget', 'getarchive', 'subst' ]
+
+    def __init__( self, events_file = None ):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.events = open( events_file, 'w', encoding='utf-8' ) if events_file else None
+        self.actions = {}           # Each entry is (<command>, <outcome>) : <count>
+        self.cache_lookups = {}     # Each entry is (<cache>, <'hit' or 'miss'>) : <count>
+        self.bytes_fetched = 0
+        self.retries = 0
+        self.errors = 0
+        self.host_latencies = {}    # Each entry is <host> : [<bucket counts>, <sum>, <count>]
+        self.queue_wait = 0.0
+        self.transfer = 0.0
+
+    def record_action( self, event ):
+        import json
+        with self.lock:
+            key = (event['command'], event['outcome'])
+            self.actions[key] = self.actions.get( key, 0 ) + 1
+            if event['outcome'] == 'repeat':
+                self.count_cache_locked( 'repeat', True )
+            self.queue_wait += event.get( 'queue_wait', 0 )
+            self.transfer += event.get( 'transfer', 0 )
+            if self.events:
+                event['time'] = round( time.time(), 6 )
+                self.events.write( json.dumps( event ) + '\n' )
+                self.events.flush()
+
+    def count_cache( self, cache, is_hit ):
+        with self.lock:
+            self.count_cache_locked( cache, is_hit )
+
+    def count_cache_locked( self, cache, is_hit ):
+        key = (cache, 'hit' if is_hit else 'miss')
+        self.cache_lookups[key] = self.cache_lookups.get( key, 0 ) + 1
+
+    def count_retry( self ):
+        with self.lock:
+            self.retries += 1
+
+    def count_error( self ):
+        with self.lock:
+            self.errors += 1
+
+    def add_bytes_fetched( self, size ):
+        with self.lock:
+            self.bytes_fetched += size
+
+    def observe_request( self, host, seconds ):
+        with self.lock:
+            if host not in self.host_latencies:
+                self.host_latencies[host] = [ [0] * len( Metrics.latency_buckets ), 0.0, 0 ]
+            buckets, total, count = self.host_latencies[host]
+            for i, le in enumerate( Metrics.latency_buckets ):
+                if seconds <= le:
+                    buckets[i] += 1
+            self.host_latencies[host] = [ buckets, total + seconds, count + 1 ]
+
+    def close( self ):
+        if self.events:
+            self.events.close()
+            self.events = None
+
+    def write_prometheus( self, file ):
+        lines = []
+        def family( name, type, help ):
+            lines.append( '# HELP ' + name + ' ' + help )
+            lines.append( '# TYPE ' + name + ' ' + type )
+        family( 'exodep_actions_total', 'counter', 'Actions performed, by command and outcome.' )
+        for (command, outcome), count in sorted( self.actions.items() ):
+            lines.append( 'exodep_actions_total' + prometheus_labels( command=command, outcome=outcome ) + ' ' + str( count ) )
+        family( 'exodep_files_total', 'counter', 'Destination files processed, by outcome.' )
+        for outcome in [ 'created', 'updated', 'same' ]:
+            count = sum( c for (command, o), c in self.actions.items() if o == outcome and command in Metrics.file_commands )
+            lines.append( 'exodep_files_total' + prometheus_labels( outcome=outcome ) + ' ' + str( count ) )
+        family( 'exodep_cache_lookups_total', 'counter', 'Cache look-ups, by cache and result.' )
+        for (cache, result), count in sorted( self.cache_lookups.items() ):
+            lines.append( 'exodep_cache_lookups_total' + prometheus_labels( cache=cache, result=result ) + ' ' + str( count ) )
+        family( 'exodep_fetched_bytes_total', 'counter', 'Bytes fetched from remote servers.' )
+        lines.append( 'exodep_fetched_bytes_total ' + str( self.bytes_fetched ) )
+        family( 'exodep_retries_total', 'counter', 'Repeated requests made for the same resource.' )
+        lines.append( 'exodep_retries_total ' + str( self.retries ) )
+        family( 'exodep_errors_total', 'counter', 'Errors reported.' )
+        lines.append( 'exodep_errors_total ' + str( self.errors ) )
+        family( 'exodep_request_duration_seconds', 'histogram', 'Time to first byte of remote requests, by host.' )
+        for host, (buckets, total, count) in sorted( self.host_latencies.items() ):
+            for le, bucket_count in zip( Metrics.latency_buckets, buckets ):
+                lines.append( 'exodep_request_duration_seconds_bucket' + prometheus_labels( host=host, le=str( le ) ) + ' ' + str( bucket_count ) )
+            lines.append( 'exodep_request_duration_seconds_bucket' + prometheus_labels( host=host, le='+Inf' ) + ' ' + str( count ) )
+            lines.append( 'exodep_request_duration_seconds_sum' + prometheus_labels( host=host ) + ' ' + repr( round( total, 6 ) ) )
+            lines.append( 'exodep_request_duration_seconds_count' + prometheus_labels( host=host ) + ' ' + str( count ) )
+        family( 'exodep_download_queue_wait_seconds_total', 'counter', 'Time downloads spent waiting to be scheduled.' )
+        lines.append( 'exodep_download_queue_wait_seconds_total ' + repr( round( self.queue_wait, 6 ) ) )
+        family( 'exodep_download_transfer_seconds_total', 'counter', 'Time spent fetching downloads once scheduled.' )
+        lines.append( 'exodep_download_transfer_seconds_total ' + repr( round( self.transfer, 6 ) ) )
+        family( 'exodep_run_duration_seconds', 'gauge', 'Duration of the exodep run.' )
+        lines.append( 'exodep_run_duration_seconds ' + repr( round( time.time() - self.start, 6 ) ) )
+        family( 'exodep_last_run_timestamp_seconds', 'gauge', 'Time the exodep run finished.' )
+        lines.append( 'exodep_last_run_timestamp_seconds ' + str( int( time.time() ) ) )
+        # Write to a temporary file and rename so that a textfile collector never sees a partial file
+        tmp_name = file + '.tmp'
+        with open( tmp_name, 'w' ) as fout:
+            fout.write( '\n'.join( lines ) + '\n' )
+        os.replace( tmp_name, file )
+
+def prometheus_labels( **labels ):
+    return '{' + ','.join( name + '="' + str( value ).replace( '\\', '\\\\' ).replace( '"', '\\"' ) + '"' for name, value in labels.items() ) + '}'
+
+def make_proxy_uri( proxy, uri ):
+    # The proxy serves https://<host>/<path> as <proxy>/<host>/<path>
+    m = re.match( 'https://(.*)', uri )
+    if not m:
+        return uri
+    return proxy.rstrip( '/' ) + '/' + m.group( 1 )
+
+def process_serve_command_line_args( argv ):
+    import argparse
+    parser = argparse.ArgumentParser( prog="exodep.py serve", description="Run a caching proxy for exodep downloads" )
+    parser.add_argument( "--port", type=int, default=8080, help="port to listen on" )
+    parser.add_argument( "--bind", default="127.0.0.1", metavar="ADDRESS", help="address to listen on (default 127.0.0.1)" )
+    parser.add_argument( "--allow-host", action="append", metavar="HOST",
+                            help="also proxy requests for HOST (or HOST:PORT), as well as the hosts used by 'hosting'.  Can be used multiple times" )
+    parser.add_argument( "--cache", default="exodep-cache", metavar="DIR", help="directory to cache downloaded files in" )
+    parser.add_argument( "--max-age", type=float, default=300, metavar="SECONDS", help="how long cached files are used before being revalidated" )
+    parser.add_argument( "--upstream-scheme", choices=[ "https", "http" ], default="https", help="scheme used to fetch from upstream hosts" )
+    return parser.parse_args( argv )
+
+def serve( args ):
+    proxy = CacheProxy( args.cache, args.max_age, args.upstream_scheme, hosting_hosts() + (args.allow_host or []) )
+    server = make_proxy_server( (args.bind, args.port), proxy )
+    print( "Serving exodep cache from " + args.cache + " on port " + str( server.server_address[1] ) + ". Press Ctrl-C to stop." )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def hosting_hosts():
+    # The hosts named in the 'hosting' uri templates
+    hosts = []
+    for template in host_templates.values():
+        m = re.match( 'https?://([^/]+)/', template )
+        if m:
+            hosts.append( m.group( 1 ) )
+    return hosts
+
+class CacheProxy:
+    # Proxies requests of the form /<host>/<path> to <upstream scheme>://<host>/<path>, caching the responses on
+    # disk.  Only requests for allowed_hosts are proxied, so that the proxy can't be used to reach other servers.
+    # Cached files are revalidated with the upstream server using their ETag or Last-Modified validators
+    # once they are older than max_age.  Concurrent requests for the same file are collapsed into one upstream fetch.
+    def __init__( self, cache_dir, max_age = 300, upstream_scheme = 'https', allowed_hosts = None ):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.upstream_scheme = upstream_scheme
+        self.allowed_hosts = set( host.lower() for host in (allowed_hosts if allowed_hosts != None else hosting_hosts()) )
+        self.lock = threading.Lock()
+        self.in_flight = {}     # Each entry is <upstream uri> : <lock held while the uri is being fetched>
+        self.upstream_requests = 0
+        os.makedirs( cache_dir, exist_ok=True )
+
+    def upstream_uri( self, path ):
+        m = re.match( '/+([^/?#]+)(/[^#]*)', path )     # The query string is kept, so that it's part of the cache key too
+        if not m or m.group( 1 ).lower() not in self.allowed_hosts:
+            return None
+        return self.upstream_scheme + '://' + m.group( 1 ) + m.group( 2 )
+
+    def cache_files( self, uri ):
+        import hashlib
+        name = os.path.join( self.cache_dir, hashlib.sha256( uri.encode( 'utf-8' ) ).hexdigest() )
+        return name + '.body', name + '.json'
+
+    def read_meta( self, uri ):
+        import json
+        body_file, meta_file = self.cache_files( uri )
+        try:
+            with open( meta_file ) as fin:
+                meta = json.load( fin )
+            if meta.get( 'uri' ) == uri and os.path.isfile( body_file ):
+                return meta
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def write_meta( self, uri, meta ):
+        import json
+        body_file, meta_file = self.cache_files( uri )
+        with open( meta_file + '.tmp', 'w' ) as fout:
+            json.dump( meta, fout )
+        os.replace( meta_file + '.tmp', meta_file )
+
+    def get( self, uri ):
+        # Returns (<status>, <meta>, <cache outcome>), where meta describes the cached body when status is 200
+        with self.lock:
+            uri_lock = self.in_flight.setdefault( uri, threading.Lock() )
+        with uri_lock:      # Requests arriving while the uri is being fetched wait here, and are then served from the cache
+            meta = self.read_meta( uri )
+            if meta and time.time() - meta['fetched'] < self.max_age:
+                return 200, meta, 'HIT'
+            return self.fetch( uri, meta )
+
+    def fetch( self, uri, meta ):
+        import urllib.request
+        import urllib.error
+        headers = {}
+        if meta and meta.get( 'etag' ):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get( 'last_modified' ):
+            headers['If-Modified-Since'] = meta['last_modified']
+        with self.lock:
+            self.upstream_requests += 1
+        body_file, meta_file = self.cache_files( uri )
+        try:
+            with urllib.request.urlopen( urllib.request.Request( uri, headers=headers ), timeout=60 ) as fin:
+                with open( body_file + '.tmp', 'wb' ) as fout:
+                    while True:
+                        data = fin.read( 65536 )
+                        if not data:
+                            break
+                        fout.write( data )
+                os.replace( body_file + '.tmp', body_file )
+                meta = { 'uri': uri, 'etag': fin.headers.get( 'ETag' ), 'last_modified': fin.headers.get( 'Last-Modified' ),
+                            'size': os.path.getsize( body_file ), 'fetched': time.time() }
+                self.write_meta( uri, meta )
+                return 200, meta, 'MISS'
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and meta:
+                meta['fetched'] = time.time()
+                self.write_meta( uri, meta )
+                return 200, meta, 'REVALIDATED'
+            if meta and e.code >= 500:
+                return 200, meta, 'STALE'
+            return e.code, None, 'MISS'
+        except OSError:
+            if meta:
+                return 200, meta, 'STALE'     # Serve what we have if the upstream server can't be reached
+            return 502, None, 'MISS'
+
+def make_proxy_server( address, proxy ):
+    import http.server
+    class ProxyHandler( http.server.BaseHTTPRequestHandler ):
+        def do_GET( self ):
+            self.respond( True )
+
+        def do_HEAD( self ):
+            self.respond( False )
+
+        def respond( self, is_body_sent ):
+            uri = proxy.upstream_uri( self.path )
+            if not uri:
+                self.send_error( 403, "Not an allowed host" )
+                return
+            status, meta, outcome = proxy.get( uri )
+            if status != 200:
+                self.send_error( status )
+                return
+            if meta.get( 'etag' ) and self.headers.get( 'If-None-Match' ) == meta['etag']:
+                self.send_response( 304 )
+                self.send_header( 'ETag', meta['etag'] )
+                self.end_headers()
+                return
+            body_file, meta_file = proxy.cache_files( uri )
+            try:
+                fin = open( body_file, 'rb' )
+            except OSError:
+                self.send_error( 503 )
+                return
+            with fin:
+                self.send_response( 200 )
+                self.send_header( 'Content-Length', str( os.fstat( fin.fileno() ).st_size ) )
+                for header, key in [ ('ETag', 'etag'), ('Last-Modified', 'last_modified') ]:
+                    if meta.get( key ):
+                        self.send_header( header, meta[key] )
+                self.send_header( 'X-Exodep-Cache', outcome )
+                self.end_headers()
+                if is_body_sent:
+                    import shutil
+                    shutil.copyfileobj( fin, self.wfile )
+
+        def log_message( self, format, *args ):
+            pass
+    return http.server.ThreadingHTTPServer( address, ProxyHandler )
+
+default_session = None     # Used by ProcessDeps objects not created for a specific session.  Made when first needed.
+
+def get_default_session():
+    global default_session
+    if default_session == None:
+        default_session = Session( output=print )
+    return default_session
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Codalogic Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Exodep is a simple dependency downloader. See the following for more details:
+#
+#     https://github.com/codalogic/exodep
+#
+# This script benchmarks exodep's download paths against a local HTTP stand-in
+# server, so that performance regressions can be detected without network access.
+
+import argparse
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import http.server
+
+exodep_py = os.path.abspath( os.path.join( os.path.dirname( __file__ ), '..', 'exodep.py' ) )
+
+workload_names = [ 'get', 'bget', 'versions', 'authority', 'startup', 'noop' ]
+
+def main():
+    args = process_command_line_args()
+    server = StandInServer( args.latency, args.bandwidth, args.error_rate )
+    try:
+        results = run_benchmarks( server, args )
+    finally:
+        server.stop()
+    report = { 'config': vars_of( args ), 'workloads': results }
+    print( json.dumps( report, indent=4 ) )
+    if args.output:
+        write_json( args.output, report )
+    if args.save_baseline:
+        write_json( args.save_baseline, report )
+    regressions = check_startup_budget( results, args.startup_budget )
+    if args.baseline:
+        regressions += compare_with_baseline( results, read_json( args.baseline ), args.tolerance )
+    for regression in regressions:
+        print( "REGRESSION:", regression )
+    if regressions:
+        sys.exit( 1 )
+
+def process_command_line_args():
+    parser = argparse.ArgumentParser( description="Benchmark exodep download paths against a local HTTP stand-in server" )
+    parser.add_argument( "--workloads", nargs="+", choices=workload_names, default=workload_names, help="workloads to run" )
+    parser.add_argument( "--files", type=int, default=50, help="number of files per workload" )
+    parser.add_argument( "--size", type=int, default=16384, help="size in bytes of each generated file" )
+    parser.add_argument( "--latency", type=float, default=0.0, help="seconds of latency added to each response" )
+    parser.add_argument( "--bandwidth", type=int, default=0, help="bytes per second per response (0 = unlimited)" )
+    parser.add_argument( "--error-rate", type=float, default=0.0, help="fraction of requests answered with a 503 error" )
+    parser.add_argument( "--repeat", type=int, default=3, help="number of times to run each workload (the median is reported)" )
+    parser.add_argument( "--output", metavar="FILE", help="write the JSON results to FILE" )
+    parser.add_argument( "--baseline", metavar="FILE", help="compare the results with a previously saved baseline" )
+    parser.add_argument( "--save-baseline", metavar="FILE", help="save the results as a baseline" )
+    parser.add_argument( "--tolerance", type=float, default=0.2, help="allowed fractional increase over the baseline" )
+    parser.add_argument( "--startup-budget", type=float, default=0.1, metavar="SECONDS",
+                            help="allowed time for a 'python -m exodep' run with nothing to do, over the time to start the interpreter" )
+    return parser.parse_args()
+
+def vars_of( args ):
+    config = dict( vars( args ) )
+    for key in [ 'output', 'baseline', 'save_baseline' ]:
+        config.pop( key, None )
+    return config
+
+class StandInServer:
+    def __init__( self, latency, bandwidth, error_rate ):
+        self.root = tempfile.mkdtemp( prefix='exodep-bench-srv-' )
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.random = random.Random( 1 )
+        self.lock = threading.Lock()
+        self.reset_counts()
+        self.httpd = http.server.ThreadingHTTPServer( ('127.0.0.1', 0), make_handler_class( self ) )
+        self.thread = threading.Thread( target=self.httpd.serve_forever, daemon=True )
+        self.thread.start()
+
+    def base_uri( self ):
+        return 'http://127.0.0.1:' + str( self.httpd.server_address[1] ) + '/'
+
+    def reset_counts( self ):
+        with self.lock:
+            self.requests = 0
+            self.bytes = 0
+            self.errors = 0
+
+    def count( self, size, is_error ):
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+            if is_error:
+                self.errors += 1
+
+    def should_inject_error( self ):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def stop( self ):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree( self.root, ignore_errors=True )
+
+def make_handler_class( server ):
+    class Handler( http.server.BaseHTTPRequestHandler ):
+        def do_GET( self ):
+            if server.latency:
+                time.sleep( server.latency )
+            if server.should_inject_error():
+                server.count( 0, True )
+                self.send_error( 503 )
+                return
+            file = os.path.join( server.root, self.path.lstrip( '/' ).split( '?' )[0] )
+            if not os.path.isfile( file ):
+                server.count( 0, True )
+                self.send_error( 404 )
+                return
+            with open( file, 'rb' ) as fin:
+                data = fin.read()
+            self.send_response( 200 )
+            self.send_header( 'Content-Length', str( len( data ) ) )
+            self.end_headers()
+            self.send_throttled( data )
+            server.count( len( data ), False )
+
+        def send_throttled( self, data ):
+            if not server.bandwidth:
+                self.wfile.write( data )
+                return
+            chunk_size = max( 1, server.bandwidth // 20 )
+            for i in range( 0, len( data ), chunk_size ):
+                self.wfile.write( data[i:i+chunk_size] )
+                time.sleep( chunk_size / server.bandwidth )
+
+        def log_message( self, format, *args ):
+            pass
+    return Handler
+
+def run_benchmarks( server, args ):
+    results = {}
+    pycache_dir = tempfile.mkdtemp( prefix='exodep-bench-pycache-' )
+    cache_dir = tempfile.mkdtemp( prefix='exodep-bench-cache-' )
+    os.environ['XDG_CACHE_HOME'] = cache_dir    # So that exodep's state files and staged downloads aren't left in the user's cache
+    try:
+        for name in args.workloads:
+            runs = []
+            for i in range( args.repeat ):
+                work_dir = tempfile.mkdtemp( prefix='exodep-bench-' )
+                try:
+                    recipe = generate_workload( name, server, work_dir, args.files, args.size )
+                    flags = []
+                    if name == 'noop':
+                        # The files are downloaded by an untimed run, so the timed run finds the fingerprint unchanged
+                        flags = [ '--fingerprint-ttl', '3600' ]
+                        run_exodep( work_dir, recipe, False, flags )
+                    server.reset_counts()
+                    wall, peak_rss, import_us = run_exodep( work_dir, recipe, name in [ 'startup', 'noop' ], flags )
+                    runs.append( { 'wall_s': wall, 'requests': server.requests, 'bytes': server.bytes,
+                                    'errors': server.errors, 'peak_rss_kb': peak_rss, 'import_us': import_us } )
+                    if name == 'startup':
+                        runs[-1].update( measure_startup( work_dir, recipe, pycache_dir ) )
+                finally:
+                    shutil.rmtree( work_dir, ignore_errors=True )
+            results[name] = summarise_runs( runs )
+    finally:
+        shutil.rmtree( pycache_dir, ignore_errors=True )
+        shutil.rmtree( cache_dir, ignore_errors=True )
+    return results
+
+def measure_startup( work_dir, recipe, pycache_dir ):
+    # Running exodep.py as a script compiles all of it on every run, as Python only caches the bytecode of
+    # imported modules.  So startup is also timed running it with 'python -m exodep' (once the bytecode has been
+    # cached by an untimed run), and compared with the time to start the interpreter and to compile exodep.py.
+    start = time.perf_counter()
+    subprocess.run( [ sys.executable, '-c', 'pass' ], cwd=work_dir )
+    interpreter = time.perf_counter() - start
+    run_exodep( work_dir, recipe, False, [], pycache_dir )
+    module_wall, peak_rss, import_us = run_exodep( work_dir, recipe, False, [], pycache_dir )
+    with open( exodep_py ) as fin:
+        source = fin.read()
+    start = time.perf_counter()
+    compile( source, exodep_py, 'exec' )
+    return { 'module_wall_s': module_wall, 'interpreter_s': interpreter, 'compile_s': time.perf_counter() - start }
+
+def summarise_runs( runs ):
+    summary = { 'wall_s': round( statistics.median( [r['wall_s'] for r in runs] ), 4 ),
+                'wall_min_s': round( min( [r['wall_s'] for r in runs] ), 4 ) }
+    for key in [ 'requests', 'bytes', 'errors' ]:
+        summary[key] = max( [r[key] for r in runs] )
+    rss = [r['peak_rss_kb'] for r in runs if r['peak_rss_kb'] != None]
+    summary['peak_rss_kb'] = max( rss ) if rss else None
+    import_us = [r['import_us'] for r in runs if r['import_us'] != None]
+    if import_us:
+        summary['import_us'] = int( statistics.median( import_us ) )
+    for key in [ 'module_wall_s', 'interpreter_s', 'compile_s' ]:
+        if key in runs[0]:
+            summary[key] = round( statistics.median( [r[key] for r in runs] ), 4 )
+    return summary
+
+def generate_workload( name, server, work_dir, n_files, size ):
+    # Returns the name of the recipe to run (None for globbing exodep-imports) after creating the
+    # files that will be served and the exodep files that will be processed
+    srv_dir = os.path.join( server.root, name )
+    shutil.rmtree( srv_dir, ignore_errors=True )
+    os.makedirs( srv_dir )
+    base = server.base_uri() + name + '/'
+    if name == 'get' or name == 'bget' or name == 'noop':
+        lines = [ 'uritemplate ' + base + '${file}' ]
+        for i in range( n_files ):
+            file_name = 'file' + str( i ) + ('.bin' if name == 'bget' else '.txt')
+            write_generated_file( os.path.join( srv_dir, file_name ), size, i, name != 'bget' )
+            lines.append( ('bget' if name == 'bget' else 'get') + ' ' + file_name + ' out/' )
+        to_file( os.path.join( work_dir, 'bench.exodep' ), '\n'.join( lines ) + '\n' )
+        return 'bench.exodep'
+    if name == 'startup':
+        # A run with nothing to download, as made by build steps when everything is up to date
+        lines = [ '$var' + str( i ) + ' ' + str( i ) for i in range( n_files ) ]
+        to_file( os.path.join( work_dir, 'bench.exodep' ), '\n'.join( lines ) + '\n' )
+        return 'bench.exodep'
+    imports_dir = os.path.join( work_dir, 'exodep-imports' )
+    os.makedirs( imports_dir )
+    if name == 'versions':
+        to_file( os.path.join( srv_dir, 'versions.exodep' ), 'master alpha\nbranch-1 beta\n' )
+        write_generated_file( os.path.join( srv_dir, 'common.txt' ), size, 0, True )
+        for i in range( n_files ):
+            to_file( os.path.join( imports_dir, 'recipe' + str( i ) + '.exodep' ),
+                    'uritemplate ' + base + '${file}\n' +
+                    '$strand beta\n' +
+                    'versions\n' +
+                    'get common.txt out' + str( i ) + '/\n' )
+        return None
+    if name == 'authority':
+        for i in range( n_files ):
+            recipe_name = 'recipe' + str( i ) + '.exodep'
+            content = 'uritemplate ' + base + '${file}\nauthority ' + recipe_name + '\n'
+            to_file( os.path.join( srv_dir, recipe_name ), content )
+            to_file( os.path.join( imports_dir, recipe_name ), content )
+        return None
+    raise ValueError( "Unknown workload: " + name )
+
+def write_generated_file( file, size, seed, is_text ):
+    r = random.Random( seed )
+    if is_text:
+        line = ''.join( r.choice( 'abcdefghijklmnopqrstuvwxyz ' ) for i in range( 79 ) ) + '\n'
+        data = (line * (size // len( line ) + 1))[:size].encode( 'utf-8' )
+    else:
+        data = bytes( r.getrandbits( 8 ) for i in range( size ) )
+    with open( file, 'wb' ) as fout:
+        fout.write( data )
+
+def run_exodep( work_dir, recipe, is_importtime = False, flags = [], pycache_dir = None ):
+    # Returns the wall time, the peak RSS and, if is_importtime is set, the total time spent importing modules.
+    # If pycache_dir is set, exodep is run as a module, with its bytecode cached in pycache_dir.
+    cmd = [ sys.executable ]
+    env = None
+    if is_importtime:
+        cmd += [ '-X', 'importtime' ]
+    if pycache_dir:
+        cmd += [ '-X', 'pycache_prefix=' + pycache_dir, '-m', 'exodep' ]
+        env = dict( os.environ, PYTHONPATH=os.path.dirname( exodep_py ) )
+        env.pop( 'PYTHONDONTWRITEBYTECODE', None )
+    else:
+        cmd.append( exodep_py )
+    cmd += flags
+    if recipe:
+        cmd.append( recipe )
+    stderr_file = os.path.join( work_dir, 'importtime.txt' )
+    start = time.perf_counter()
+    with open( stderr_file, 'w' ) as ferr:
+        proc = subprocess.Popen( cmd, cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=ferr if is_importtime else None )
+        peak_rss = None
+        if hasattr( os, 'wait4' ):
+            pid, status, rusage = os.wait4( proc.pid, 0 )
+            proc.returncode = status
+            peak_rss = rusage.ru_maxrss
+            if sys.platform.startswith( 'darwin' ):
+                peak_rss = peak_rss // 1024     # macOS reports bytes rather than kilobytes
+        else:
+            proc.wait()
+    wall = time.perf_counter() - start
+    return wall, peak_rss, read_import_time( stderr_file ) if is_importtime else None
+
+def read_import_time( file ):
+    # Top-level entries in -X importtime output have no indentation before the module name
+    total = 0
+    with open( file ) as fin:
+        for line in fin:
+            parts = line.split( '|' )
+            if line.startswith( 'import time:' ) and len( parts ) == 3 and not parts[2].startswith( '  ' ):
+                try:
+                    total += int( parts[1] )
+                except ValueError:
+                    pass
+    return total
+
+def check_startup_budget( results, budget ):
+    if 'startup' not in results or budget == None:
+        return []
+    overhead = results['startup']['module_wall_s'] - results['startup']['interpreter_s']
+    if overhead > budget:
+        return [ "startup module_wall_s: " + str( round( overhead, 4 ) ) + "s over interpreter startup (budget " + str( budget ) + "s)" ]
+    return []
+
+def compare_with_baseline( results, baseline, tolerance ):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline.get( 'workloads', {} ):
+            continue
+        base = baseline['workloads'][name]
+        for key in [ 'wall_s', 'module_wall_s', 'requests', 'bytes', 'peak_rss_kb', 'import_us' ]:
+            if result.get( key ) == None or base.get( key ) == None:
+                continue
+            allowed = base[key] * (1 + tolerance) if key in [ 'wall_s', 'module_wall_s', 'peak_rss_kb', 'import_us' ] else base[key]
+            if result[key] > allowed:
+                regressions.append( name + " " + key + ": " + str( result[key] ) + " (baseline " + str( base[key] ) + ")" )
+    return regressions
+
+def to_file( file, content ):
+    with open( file, 'w' ) as fout:
+        fout.write( content )
+
+def write_json( file, data ):
+    with open( file, 'w' ) as fout:
+        json.dump( data, fout, indent=4 )
+
+def read_json( file ):
+    with open( file ) as fin:
+        return json.load( fin )
+
+if __name__ == '__main__':
+    main()
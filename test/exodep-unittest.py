@@ -28,21 +28,48 @@
 
 import sys
 import io
+import contextlib
 import os
 import unittest
 import shutil
 import filecmp
-
-sys.path.append("..")
+import glob
+import json
+import threading
+import http.server
+import functools
+import time
+import subprocess
+import tarfile
+import zipfile
+import urllib.request
+import urllib.error
+import tempfile
+
+test_dir = os.path.dirname( os.path.abspath( __file__ ) )
+exodep_py = os.path.join( os.path.dirname( test_dir ), 'exodep.py' )
+
+sys.path.append( os.path.dirname( exodep_py ) )
 import exodep
 
-exodep_exe = '../exodep.py '
-if sys.platform.startswith( 'win32' ):
-    exodep_exe = '..\\exodep.py '
+exodep_exe = '"' + exodep_py + '" '
 
 def main():
-    pre_clean()
-    unittest.main()
+    # The tests are run in a copy of the test directory, with exodep's cache directory in it, so that they don't
+    # leave files in the tree or the user's cache
+    work_dir = tempfile.mkdtemp( prefix='exodep-unittest-' )
+    try:
+        for name in os.listdir( test_dir ):
+            if os.path.isfile( os.path.join( test_dir, name ) ):
+                shutil.copy2( os.path.join( test_dir, name ), work_dir )
+        os.chdir( work_dir )
+        os.environ['XDG_CACHE_HOME'] = os.path.join( work_dir, 'cache' )
+        pre_clean()
+        program = unittest.main( exit=False )
+    finally:
+        os.chdir( test_dir )
+        shutil.rmtree( work_dir, ignore_errors=True )
+    sys.exit( not program.result.wasSuccessful() )
 
 def pre_clean():
     rmdir( 'download' )
@@ -52,6 +79,31 @@ def pre_clean():
     rmdir( 'stop' )
     rmdir( 'exodep-imports' )
     rmdir( 'dest-dir' )
+    rmdir( 'roots' )
+    rmdir( 'watch-imports' )
+    rmdir( 'trace' )
+    rmdir( 'metrics' )
+    rmdir( 'exec-test' )
+    rmdir( 'getdir-src' )
+    rmdir( 'getdir-dst' )
+    rmdir( 'session' )
+    rmdir( 'lazy' )
+    rmdir( 'depfile' )
+    rmdir( 'output-levels' )
+    rmdir( 'timeouts' )
+    rmdir( 'scheduler' )
+    rmdir( 'proxy' )
+    rmdir( 'check' )
+    rmdir( 'gitrepo' )
+    rmdir( 'archive' )
+    rmdir( 'fetch-uses' )
+    rmdir( 'parallel' )
+    rmdir( 'fingerprint' )
+    rmdir( 'execmemo' )
+    rmdir( 'link' )
+    rmdir( 'bundle' )
+    rmdir( 'journal' )
+    rm( '.exodep-state.json' )
 
 class MyTest(unittest.TestCase):
     def test_default_setup(self):
@@ -201,6 +253,602 @@ class MyTest(unittest.TestCase):
         self.assertTrue( os.path.isfile( 'glob-test-1.txt' ) )
         self.assertTrue( os.path.isfile( 'glob-test-2.txt' ) )
 
+    def test_roots(self):
+        for root in [ 'roots/a', 'roots/b' ]:
+            ensure_dir( root + '/exodep-imports' )
+            to_file( root + '/versions.exodep', 'branch-1 apple\n' )
+            to_file( root + '/exodep-imports/roots-test.exodep',
+                    'uritemplate ${file}\n' +
+                    '$strand apple\n' +
+                    'versions\n' +
+                    'onanychanged $should_not_be_set 1\n' +
+                    'touch ${strand}.txt\n' )
+        os.system( exodep_exe + '--roots roots/a roots/b' )
+        self.assertTrue( os.path.isfile( 'roots/a/branch-1.txt' ) )
+        self.assertTrue( os.path.isfile( 'roots/b/branch-1.txt' ) )
+
+        ensure_dir( 'roots/c/exodep-imports' )
+        to_file( 'roots/c/exodep-imports/roots-test.exodep', 'touch c.txt\n' )
+        to_file( 'roots/roots.txt', '# Roots to process\n\nc\n' )
+        os.system( exodep_exe + '--roots-file roots/roots.txt' )
+        self.assertTrue( os.path.isfile( 'roots/c/c.txt' ) )
+
+        os.unlink( 'roots/c/c.txt' )
+        to_file( 'roots/c/empty-roots.txt', '# No roots\n' )
+        for roots_file in [ 'missing-roots.txt', 'empty-roots.txt' ]:   # The current directory isn't processed instead
+            process = subprocess.run( exodep_exe + '--roots-file ' + roots_file, shell=True, cwd='roots/c',
+                                        stdout=subprocess.PIPE, universal_newlines=True )
+            self.assertEqual( process.returncode, 1 )
+            self.assertTrue( 'Error: ' in process.stdout and roots_file in process.stdout )
+            self.assertFalse( os.path.isfile( 'roots/c/c.txt' ) )
+
+    def test_watch_fingerprint(self):
+        # A run that would be skipped by its fingerprint is still run in full when watching, so that changes are noticed
+        ensure_dir( 'watch-fingerprint/exodep-imports' )
+        to_file( 'watch-fingerprint/exodep-imports/a.exodep', '$a 1\n' )
+        args = [ sys.executable, exodep_py, '--state', 'state.json', '--fingerprint-ttl', '60' ]
+        subprocess.run( args, cwd='watch-fingerprint', stdout=subprocess.DEVNULL )
+        process = subprocess.Popen( args + [ '--watch', '--watch-interval', '0.1' ], cwd='watch-fingerprint',
+                                    stdout=subprocess.PIPE, universal_newlines=True )
+        timer = threading.Timer( 10, process.kill )     # In case the change is never noticed
+        timer.start()
+        try:
+            output = []
+            for line in process.stdout:
+                output.append( line )
+                if line.startswith( 'Watching' ):
+                    time.sleep( 0.2 )
+                    to_file( 'watch-fingerprint/exodep-imports/a.exodep', '$a 2\n' )
+                    os.utime( 'watch-fingerprint/exodep-imports/a.exodep', (time.time() + 10, time.time() + 10) )
+                if line.startswith( 'Rerun.....' ):
+                    break
+        finally:
+            timer.cancel()
+            process.kill()
+            process.wait()
+            process.stdout.close()
+        self.assertFalse( any( line.startswith( 'Unchanged.' ) for line in output ) )
+        self.assertTrue( output[-1].startswith( 'Rerun..... exodep-imports' ) )
+
+    def test_watch_affected(self):
+        ensure_dir( 'watch-imports/child' )
+        to_file( 'watch-imports/__init.exodep', '$v 1\n' )
+        to_file( 'watch-imports/a.exodep', 'include ^common.exodep\n' )
+        to_file( 'watch-imports/^common.exodep', '$w 2\n' )
+        to_file( 'watch-imports/b.exodep', '$x 3\n' )
+        to_file( 'watch-imports/child/__init.exodep', '$y 4\n' )
+        to_file( 'watch-imports/child/c.exodep', '$z 5\n' )
+        session = exodep.Session()
+        session.process_globbed_exodep_imports( 'watch-imports', exodep.default_vars )
+
+        dirs, recipes = session.find_affected_exodep_files( [ 'watch-imports/^common.exodep' ] )
+        self.assertEqual( dirs, [] )
+        self.assertEqual( recipes, [ os.path.normpath( 'watch-imports/a.exodep' ) ] )
+
+        dirs, recipes = session.find_affected_exodep_files( [ 'watch-imports/child/__init.exodep', 'watch-imports/child/c.exodep', 'watch-imports/b.exodep' ] )
+        self.assertEqual( dirs, [ os.path.normpath( 'watch-imports/child' ) ] )
+        self.assertEqual( recipes, [ os.path.normpath( 'watch-imports/b.exodep' ) ] )
+
+        dirs, recipes = session.find_affected_exodep_files( [ 'watch-imports/__init.exodep', 'watch-imports/child/c.exodep' ] )
+        self.assertEqual( dirs, [ os.path.normpath( 'watch-imports' ) ] )
+        self.assertEqual( recipes, [] )
+
+    def test_trace(self):
+        ensure_dir( 'trace' )
+        to_file( 'trace/trace-test.exodep',
+                'uritemplate ${file}\n' +
+                'get dl-test-target.txt trace/\n' +
+                'get dl-test-target.txt trace/\n' +
+                '$val v1\n' )
+        os.system( exodep_exe + '--trace trace/trace.json trace/trace-test.exodep' )
+        with open( 'trace/trace.json' ) as fin:
+            events = json.load( fin )['traceEvents']
+        self.assertTrue( [e for e in events if e['cat'] == 'recipe' and e['name'] == 'trace/trace-test.exodep'] )
+        self.assertEqual( len( [e for e in events if e['cat'] == 'command'] ), 4 )
+        self.assertEqual( [e['args']['outcome'] for e in events if e['cat'] == 'file' and e['name'] == 'compare'], [ 'created' ] )
+        self.assertTrue( [e for e in events if e['cat'] == 'cache' and e['name'] == 'repeat'] )
+        for e in events:
+            self.assertTrue( e['ph'] in [ 'X', 'i' ] )
+
+    def test_metrics(self):
+        ensure_dir( 'metrics' )
+        with LocalServer() as server:
+            to_file( 'metrics/metrics-test.exodep',
+                    'uritemplate ' + server.uri + '${file}\n' +
+                    'get dl-test-target.txt metrics/\n' +
+                    'get dl-test-target.txt metrics/\n' +
+                    'bget dl-test-target-other.txt metrics/\n' +
+                    'get not-a-file.txt metrics/\n' )
+            os.system( exodep_exe + '--events metrics/events.ndjson --prometheus metrics/metrics.prom metrics/metrics-test.exodep' )
+        with open( 'metrics/events.ndjson' ) as fin:
+            events = [json.loads( line ) for line in fin]
+        self.assertEqual( [(e['command'], e['outcome']) for e in events], [ ('get', 'created'), ('get', 'repeat'), ('bget', 'created'), ('get', 'error') ] )
+        self.assertEqual( events[0]['bytes'], os.path.getsize( 'dl-test-target.txt' ) )
+        self.assertEqual( events[0]['dst'], 'metrics/dl-test-target.txt' )
+        with open( 'metrics/metrics.prom' ) as fin:
+            prom = fin.read()
+        self.assertTrue( 'exodep_files_total{outcome="created"} 2\n' in prom )
+        self.assertTrue( 'exodep_cache_lookups_total{cache="repeat",result="hit"} 1\n' in prom )
+        self.assertTrue( 'exodep_errors_total 1\n' in prom )
+        self.assertTrue( 'exodep_request_duration_seconds_count{host="127.0.0.1"} 3\n' in prom )
+
+        with exodep.Session( events_file='metrics/no-dir/events.ndjson' ) as session:
+            result = session.run( io.StringIO( '$a 1\n' ) )
+        self.assertEqual( result.errors, [ 'Unable to open events file: metrics/no-dir/events.ndjson' ] )
+
+    def test_depfile(self):
+        ensure_dir( 'depfile' )
+        to_file( 'depfile/versions.exodep', 'branch-1 apple\n' )
+        to_file( 'depfile/depfile-test.exodep',
+                'include depfile-inc.exodep\n' +
+                'cp dl-test-target.txt depfile/out/copy.txt\n' )
+        to_file( 'depfile/depfile-inc.exodep',
+                'hosting local\n' +
+                'versions depfile/versions.exodep\n' +
+                'get dl-test-target.txt depfile/out/\n' )
+        os.system( exodep_exe + '--depfile depfile/out.d --changed-list depfile/changed.txt depfile/depfile-test.exodep' )
+        with open( 'depfile/out.d' ) as fin:
+            depfile = fin.read()
+        self.assertEqual( depfile, 'depfile/out/copy.txt: \\\n    depfile/depfile-test.exodep \\\n    dl-test-target.txt\n' +
+                                    'depfile/out/dl-test-target.txt: \\\n    depfile/depfile-inc.exodep \\\n    depfile/depfile-test.exodep \\\n' +
+                                    '    depfile/versions.exodep \\\n    dl-test-target.txt\n' )
+        with open( 'depfile/changed.txt' ) as fin:
+            self.assertEqual( fin.read(), 'depfile/out/dl-test-target.txt\ndepfile/out/copy.txt\n' )
+
+        os.system( exodep_exe + '--depfile depfile/out.d --changed-list depfile/changed.txt depfile/depfile-test.exodep' )
+        with open( 'depfile/changed.txt' ) as fin:
+            self.assertEqual( fin.read(), '' )
+        with open( 'depfile/out.d' ) as fin:
+            self.assertEqual( fin.read(), depfile )
+
+        for i in range( 2 ):    # The second run is skipped by the fingerprint, but must still write the same depfile
+            output = subprocess.run( exodep_exe + '--state depfile/state.json --fingerprint-ttl 60 --depfile depfile/out.d depfile/depfile-test.exodep',
+                                        shell=True, stdout=subprocess.PIPE, universal_newlines=True ).stdout
+            with open( 'depfile/out.d' ) as fin:
+                self.assertEqual( fin.read(), depfile )
+        self.assertTrue( 'Unchanged.' in output )
+
+    def test_timeouts(self):
+        with LocalServer( { '/dl-test-target.txt': [ 1.0, 1.0 ] } ) as server:
+            recipe = 'uritemplate ' + server.uri + '${file}\nget dl-test-target.txt timeouts/\n'
+            start = time.time()
+            result = exodep.Session( timeout=0.2 ).run( io.StringIO( recipe ) )
+            self.assertTrue( time.time() - start < 0.9 )
+            self.assertEqual( [a['outcome'] for a in result.actions], [ 'error' ] )
+
+            start = time.time()
+            result = exodep.Session( deadline=0.3 ).run( io.StringIO( recipe + 'get dl-test-target-other.txt timeouts/\necho Done\nget dl-test-target.txt timeouts/again/\n' ) )
+            self.assertTrue( time.time() - start < 0.9 )
+            self.assertEqual( [a['outcome'] for a in result.actions], [ 'incomplete', 'created' ] )    # The two gets are fetched concurrently
+            self.assertEqual( result.errors, [] )
+            self.assertEqual( result.incomplete, [ '<StringIO> (2): Cut short by the run deadline: ' + server.uri + 'dl-test-target.txt',
+                                                    '<StringIO> (4): echo Done', '<StringIO> (5): get dl-test-target.txt timeouts/again/' ] )
+
+    def test_hedged_requests(self):
+        ensure_dir( 'timeouts/src' )
+        for name in [ 'h0', 'h1', 'h2', 'h3', 'h4', 'slow' ]:
+            to_file( 'timeouts/src/' + name + '.txt', name + '\n' )
+        with LocalServer( { '/timeouts/src/slow.txt': [ 1.0 ] } ) as server:
+            recipe = 'uritemplate ' + server.uri + 'timeouts/src/${file}\n'
+            for name in [ 'h0', 'h1', 'h2', 'h3', 'h4', 'slow' ]:
+                recipe += 'get ' + name + '.txt timeouts/dst/\n'
+            start = time.time()
+            result = exodep.Session( hedge=50, jobs=1 ).run( io.StringIO( recipe ) )
+            self.assertTrue( time.time() - start < 0.9 )
+            self.assertEqual( [a['outcome'] for a in result.actions], [ 'created' ] * 6 )
+            self.assertEqual( server.request_count, 7 )
+        self.assertTrue( filecmp.cmp( 'timeouts/src/slow.txt', 'timeouts/dst/slow.txt' ) )
+
+    def test_scheduler(self):
+        ensure_dir( 'scheduler/src' )
+        names = [ 's0', 's1', 's2', 's3' ]
+        for i, name in enumerate( names ):
+            to_file( 'scheduler/src/' + name + '.txt', name * (i + 1) + '\n' )
+        delays = {}
+        for name in names:
+            delays['/scheduler/src/' + name + '.txt'] = [ 0.2 ] * 3
+        with LocalServer( delays ) as server:
+            recipe = 'uritemplate ' + server.uri + 'scheduler/src/${file}\n'
+            for name in names:
+                recipe += 'get ' + name + '.txt scheduler/dst/\n'
+            recipe += 'onlastchanged $last_changed 1\n'
+
+            start = time.time()
+            result = exodep.Session( jobs=4 ).run( io.StringIO( recipe ) )
+            self.assertTrue( time.time() - start < 0.6 )
+            self.assertEqual( [a['dst'] for a in result.actions], [ 'scheduler/dst/' + name + '.txt' for name in names ] )
+
+            to_file( 'scheduler/state.json', json.dumps( { 'sizes': { server.uri + 'scheduler/src/s2.txt': 1000 } } ) )
+            server.httpd.paths = []
+            start = time.time()
+            session = exodep.Session( jobs=4, host_limits={ None: 1 }, state_file='scheduler/state.json' )
+            result = session.run( io.StringIO( recipe ) )
+            session.close()
+            self.assertTrue( time.time() - start >= 0.8 )
+            self.assertEqual( server.httpd.paths, [ '/scheduler/src/s2.txt', '/scheduler/src/s0.txt', '/scheduler/src/s1.txt', '/scheduler/src/s3.txt' ] )
+            self.assertTrue( result.actions[3]['queue_wait'] > 0.5 )      # s3 is fetched last
+            self.assertTrue( result.actions[2]['transfer'] >= 0.2 )
+
+            rate_recipe = 'uritemplate ' + server.uri + 'scheduler/src/${file}\n'
+            for name in names:
+                to_file( 'scheduler/src/r' + name + '.txt', name + '\n' )
+                rate_recipe += 'get r' + name + '.txt scheduler/dst/\nonlastchanged $last_changed 1\n'    # So that each batch has one download
+            start = time.time()
+            exodep.Session( jobs=4, host_rates={ None: 5 } ).run( io.StringIO( rate_recipe ) )
+            self.assertTrue( time.time() - start >= 0.6 )     # The rate limit spaces the 4 requests at least 0.2s apart
+        with open( 'scheduler/state.json' ) as fin:
+            sizes = json.load( fin )['sizes']
+        self.assertEqual( sizes[server.uri + 'scheduler/src/s3.txt'], 9 )
+
+        for setting in [ '--host-limit', '--host-rate' ]:   # A limit of 0 would never let a download start
+            for value in [ '0', '127.0.0.1=0', '-1', 'x' ]:
+                with self.assertRaises( SystemExit ), contextlib.redirect_stderr( io.StringIO() ):
+                    exodep.process_command_line_args( [ setting, value ] )
+            self.assertEqual( getattr( exodep.process_command_line_args( [ setting, '127.0.0.1=2' ] ), setting[2:].replace( '-', '_' ) ), [ ('127.0.0.1', 2.0) ] )
+        with self.assertRaises( ValueError ):
+            exodep.Session( host_limits={ '127.0.0.1': 0 } )
+
+    def test_serve(self):
+        ensure_dir( 'proxy/src' )
+        to_file( 'proxy/src/a.txt', 'a\n' )
+        to_file( 'proxy/src/slow.txt', 'slow\n' )
+        with LocalServer( { '/proxy/src/slow.txt': [ 0.3 ] } ) as upstream:
+            proxy = exodep.CacheProxy( 'proxy/cache', 300, 'http', [ upstream.uri[len( 'http://' ):].rstrip( '/' ) ] )
+            server = exodep.make_proxy_server( ('127.0.0.1', 0), proxy )
+            threading.Thread( target=server.serve_forever, daemon=True ).start()
+            try:
+                proxy_uri = 'http://127.0.0.1:' + str( server.server_address[1] ) + '/'
+                src_uri = proxy_uri + upstream.uri[len( 'http://' ):] + 'proxy/src/'
+                recipe = 'uritemplate ' + src_uri + '${file}\nget a.txt proxy/dst/\n'
+                exodep.Session().run( io.StringIO( recipe ) )
+                exodep.Session().run( io.StringIO( recipe ) )
+                self.assertEqual( upstream.request_count, 1 )
+                self.assertTrue( filecmp.cmp( 'proxy/src/a.txt', 'proxy/dst/a.txt' ) )
+
+                bodies = []
+                def fetch_slow():
+                    with urllib.request.urlopen( src_uri + 'slow.txt' ) as fin:
+                        bodies.append( fin.read() )
+                threads = [threading.Thread( target=fetch_slow ) for i in range( 4 )]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertEqual( bodies, [ b'slow\n' ] * 4 )
+                self.assertEqual( upstream.request_count, 2 )   # Concurrent requests are collapsed into one
+
+                proxy.max_age = 0
+                with urllib.request.urlopen( src_uri + 'a.txt' ) as fin:
+                    self.assertEqual( fin.headers['X-Exodep-Cache'], 'REVALIDATED' )
+                    self.assertEqual( fin.read(), b'a\n' )
+                with self.assertRaises( urllib.error.HTTPError ) as cm:
+                    urllib.request.urlopen( src_uri + 'not-a-file.txt' )
+                self.assertEqual( cm.exception.code, 404 )
+
+                with urllib.request.urlopen( src_uri + 'a.txt?v=2' ) as fin:
+                    self.assertEqual( fin.headers['X-Exodep-Cache'], 'MISS' )     # The query string is part of the cache key
+                self.assertEqual( upstream.httpd.paths[-1], '/proxy/src/a.txt?v=2' )
+                with self.assertRaises( urllib.error.HTTPError ) as cm:
+                    urllib.request.urlopen( proxy_uri + 'localhost:' + str( server.server_address[1] ) + '/a.txt' )
+                self.assertEqual( cm.exception.code, 403 )
+            finally:
+                server.shutdown()
+                server.server_close()
+        default_proxy = exodep.CacheProxy( 'proxy/cache' )
+        self.assertEqual( default_proxy.upstream_uri( '/raw.githubusercontent.com/a/b/master/f.txt' ), 'https://raw.githubusercontent.com/a/b/master/f.txt' )
+        self.assertEqual( default_proxy.upstream_uri( '/169.254.169.254/latest/meta-data/' ), None )
+        args = exodep.process_serve_command_line_args( [ '--allow-host', 'example.com' ] )
+        self.assertEqual( (args.bind, args.allow_host), ('127.0.0.1', [ 'example.com' ]) )
+        self.assertEqual( exodep.make_proxy_uri( 'http://cache:8080/', 'https://raw.githubusercontent.com/a/b/master/f.txt' ),
+                            'http://cache:8080/raw.githubusercontent.com/a/b/master/f.txt' )
+
+    def test_check(self):
+        ensure_dir( 'check/src' )
+        to_file( 'check/src/a.txt', 'a\n' )
+        to_file( 'check/src/b.txt', 'b\n' )
+        with LocalServer() as server:
+            recipe = 'uritemplate ' + server.uri + 'check/src/${file}\nget a.txt check/dst/\nget b.txt check/dst/\ntouch check/dst/touched.txt\n'
+            with exodep.Session( state_file='check/state.json' ) as session:
+                session.run( io.StringIO( recipe ) )
+            dst_mtime = os.path.getmtime( 'check/dst/a.txt' )
+            os.unlink( 'check/dst/touched.txt' )
+
+            with exodep.Session( state_file='check/state.json', check=True ) as session:
+                result = session.run( io.StringIO( recipe ) )
+            self.assertEqual( result.stale(), [] )
+            self.assertEqual( [a['outcome'] for a in result.actions], [ 'same', 'same' ] )
+            self.assertEqual( result.bytes_avoided, 4 )
+            self.assertFalse( os.path.exists( 'check/dst/touched.txt' ) )
+
+            to_file( 'check/src/b.txt', 'b changed\n' )
+            os.utime( 'check/src/b.txt', (time.time() + 10, time.time() + 10) )
+            with exodep.Session( state_file='check/state.json', check=True ) as session:
+                result = session.run( io.StringIO( recipe ) )
+            self.assertEqual( result.stale(), [ 'check/dst/b.txt' ] )
+            self.assertEqual( result.bytes_avoided, 2 )
+            with open( 'check/dst/b.txt' ) as fin:
+                self.assertEqual( fin.read(), 'b\n' )
+            self.assertEqual( os.path.getmtime( 'check/dst/a.txt' ), dst_mtime )
+
+        to_file( 'check/recipe.exodep', 'hosting local\nauthority check/authority.exodep\n' )
+        to_file( 'check/authority.exodep', '# Different\n' )
+        self.assertEqual( subprocess.run( exodep_exe + 'check/recipe.exodep', shell=True, stdout=subprocess.DEVNULL ).returncode, 0 )
+        self.assertEqual( subprocess.run( exodep_exe + '--check check/recipe.exodep', shell=True, stdout=subprocess.DEVNULL ).returncode, 1 )
+
+    def test_hosting_git(self):
+        def git( *args ):
+            subprocess.run( [ 'git', '-C', 'gitrepo/work', '-c', 'user.name=test', '-c', 'user.email=test@example.com' ] + list( args ),
+                            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+        ensure_dir( 'gitrepo/work' )
+        git( 'init', '-q', '-b', 'master' )
+        to_file( 'gitrepo/work/a.txt', 'a\n' )
+        to_file( 'gitrepo/work/versions.exodep', 'master banana\nrelease1 apple\n' )
+        git( 'add', '.' )
+        git( 'commit', '-q', '-m', 'first' )
+        git( 'branch', 'release1' )
+        to_file( 'gitrepo/work/a.txt', 'a changed\n' )
+        git( 'commit', '-q', '-a', '-m', 'second' )
+        subprocess.run( [ 'git', 'clone', '-q', '--bare', 'gitrepo/work', 'gitrepo/mirrors/codalogic/widget.git' ], check=True )
+
+        recipe = '$gitroot gitrepo/mirrors/\n$owner codalogic\n$project widget\nhosting git\nget a.txt gitrepo/dst/\n'
+        with exodep.Session() as session:
+            result = session.run( io.StringIO( recipe ) )
+            self.assertEqual( [a['outcome'] for a in result.actions], [ 'created' ] )
+            with open( 'gitrepo/dst/a.txt' ) as fin:
+                self.assertEqual( fin.read(), 'a changed\n' )
+            result = session.run( io.StringIO( recipe + 'get not-there.txt gitrepo/dst/\n' ) )
+            self.assertEqual( [a['outcome'] for a in result.actions], [ 'same', 'error' ] )
+            result = session.run( io.StringIO( '$strand apple\n' + recipe.replace( 'hosting git', 'hosting git\nversions' ) ) )
+            self.assertEqual( [a['outcome'] for a in result.actions], [ 'fetched', 'updated' ] )
+            with open( 'gitrepo/dst/a.txt' ) as fin:
+                self.assertEqual( fin.read(), 'a\n' )
+
+    def test_getarchive(self):
+        def make_archives( files ):
+            with tarfile.open( 'archive/lib-1.0.tar.gz', 'w:gz' ) as tar, zipfile.ZipFile( 'archive/lib-1.0.zip', 'w' ) as zip:
+                for name, content in files.items():
+                    info = tarfile.TarInfo( 'lib-1.0/' + name )
+                    info.size = len( content )
+                    tar.addfile( info, io.BytesIO( content ) )
+                    zip.writestr( 'lib-1.0/' + name, content )
+        ensure_dir( 'archive' )
+        make_archives( { 'include/a.h': b'a\n', 'include/sub/b.h': b'b\n', 'src/a.c': b'c\n' } )
+        with LocalServer() as server:
+            recipe = 'getarchive ' + server.uri + 'archive/lib-1.0.tar.gz archive/tar/ lib-1.0/include/\n'
+            recipe += 'hosting local\ngetarchive archive/lib-1.0.zip archive/zip/ */*.c\n'
+            result = exodep.Session().run( io.StringIO( recipe ) )
+            self.assertEqual( [(a['dst'], a['outcome']) for a in result.actions],
+                                [ ('archive/tar/a.h', 'created'), ('archive/tar/sub/b.h', 'created'), ('archive/zip/lib-1.0/src/a.c', 'created') ] )
+            with open( 'archive/tar/sub/b.h' ) as fin:
+                self.assertEqual( fin.read(), 'b\n' )
+
+            make_archives( { 'include/a.h': b'a\n', 'include/sub/b.h': b'b changed\n', 'src/a.c': b'c\n' } )
+            result = exodep.Session().run( io.StringIO( recipe ) )
+            self.assertEqual( [a['outcome'] for a in result.actions], [ 'same', 'updated', 'same' ] )
+            with open( 'archive/tar/sub/b.h' ) as fin:
+                self.assertEqual( fin.read(), 'b changed\n' )
+
+            result = exodep.Session().run( io.StringIO( 'hosting local\ngetarchive archive/lib-1.0.zip archive/zip/ not-there/\n' ) )
+            self.assertEqual( len( result.errors ), 1 )
+
+    def test_fetch_uses(self):
+        ensure_dir( 'fetch-uses/remote' )
+        ensure_dir( 'fetch-uses/project' )
+        with LocalServer() as server:
+            remote = server.uri + 'fetch-uses/remote/'
+            to_file( 'fetch-uses/remote/a.exodep', 'uses ' + remote + 'b.exodep\nuses ' + remote + 'c.exodep\n' )
+            to_file( 'fetch-uses/remote/b.exodep', 'uses ' + remote + 'c.exodep  # Already being fetched\nuses ' + remote + 'd.exodep\n' )
+            to_file( 'fetch-uses/remote/c.exodep', '' )
+            to_file( 'fetch-uses/remote/d.exodep', 'uses ' + remote + 'missing.exodep\n' )
+            to_file( 'fetch-uses/project/mydeps.exodep', 'uses ' + remote + 'a.exodep\n' )
+
+            result = exodep.Session( fetch_uses=True ).run( None, [ 'fetch-uses/project' ] )
+            self.assertEqual( sorted( server.httpd.paths ), [ '/fetch-uses/remote/' + name + '.exodep' for name in [ 'a', 'b', 'c', 'd', 'missing' ] ] )
+            self.assertEqual( [(a['dst'], a['outcome']) for a in result.actions], [
+                                ('fetch-uses/project/exodep-imports/a.exodep', 'created'),
+                                ('fetch-uses/project/exodep-imports/b.exodep', 'created'),
+                                ('fetch-uses/project/exodep-imports/c.exodep', 'created'),
+                                ('fetch-uses/project/exodep-imports/d.exodep', 'created'),
+                                ('fetch-uses/project/exodep-imports/missing.exodep', 'error') ] )
+            self.assertEqual( len( result.errors ), 1 )
+
+            server.httpd.paths = []
+            result = exodep.Session( fetch_uses=True ).run( None, [ 'fetch-uses/project' ] )
+            self.assertEqual( server.httpd.paths, [ '/fetch-uses/remote/missing.exodep' ] )
+            self.assertEqual( len( result.errors ), 1 )
+
+    def test_parallel(self):
+        ensure_dir( 'parallel/project/exodep-imports/sub' )
+        ensure_dir( 'parallel/src' )
+        for name in [ 'a', 'b', 'c' ]:
+            to_file( 'parallel/src/' + name + '.txt', name + '\n' )
+        with LocalServer( { '/parallel/src/b.txt': [ 0.3 ], '/parallel/src/c.txt': [ 0.3 ] } ) as server:
+            imports = 'parallel/project/exodep-imports/'
+            template = 'uritemplate ' + server.uri + 'parallel/src/${file}\n'
+            to_file( imports + 'a.exodep', 'uses b.exodep\nuses http://example.com/c.exodep\n' + template + 'get a.txt out/\n' )
+            to_file( imports + 'b.exodep', template + 'get b.txt out/\n' )
+            to_file( imports + 'c.exodep', template + 'get c.txt out/\n' )
+            to_file( imports + 'd.exodep', '$dname d-vars\ninclude sub/e.exodep\n' )
+            to_file( imports + 'sub/e.exodep', 'touch ${dname}.txt\n' )
+
+            output = []
+            start = time.time()
+            result = exodep.Session( output=output.append, verbosity='verbose', parallel=True ).run( None, [ 'parallel/project' ] )
+            self.assertTrue( time.time() - start < 0.55 )
+            self.assertEqual( result.errors, [] )
+            self.assertEqual( sorted( a['dst'] for a in result.actions[:2] ), [ 'parallel/project/out/b.txt', 'parallel/project/out/c.txt' ] )
+            self.assertEqual( result.actions[2]['dst'], 'parallel/project/out/a.txt' )
+            self.assertTrue( os.path.isfile( 'parallel/project/d-vars.txt' ) )
+            self.assertTrue( any( line.startswith( 'Schedule.. ' + imports + 'a.exodep after ' + imports + 'b.exodep, ' + imports + 'c.exodep' ) for line in output ) )
+            self.assertTrue( any( line.startswith( 'Critical.. ' + imports ) and imports + 'a.exodep in ' in line for line in output ) )
+
+        to_file( imports + 'b.exodep', 'uses a.exodep\n' )
+        result = exodep.Session( parallel=True ).run( None, [ 'parallel/project' ] )
+        cycle = result.errors[0].split( ': ' )
+        self.assertEqual( cycle[0], "Cycle in 'uses' and 'include' dependencies" )
+        self.assertTrue( cycle[1] in [ imports + 'a.exodep -> ' + imports + 'b.exodep -> ' + imports + 'a.exodep',
+                                        imports + 'b.exodep -> ' + imports + 'a.exodep -> ' + imports + 'b.exodep' ] )
+
+    def test_fingerprint(self):
+        ensure_dir( 'fingerprint/project/src' )
+        to_file( 'fingerprint/project/src/a.txt', 'a\n' )
+        to_file( 'fingerprint/project/mydeps.exodep', 'hosting local\nget src/a.txt out/\n' )
+        def run( ttl = 60 ):
+            with exodep.Session( state_file='fingerprint/state.json', fingerprint_ttl=ttl ) as session:
+                result = session.run( None, [ 'fingerprint/project' ] )
+            return (result.is_unchanged, [a['outcome'] for a in result.actions])
+
+        self.assertEqual( run(), (False, [ 'created' ]) )
+        self.assertEqual( run(), (True, []) )
+        to_file( 'fingerprint/project/src/a.txt', 'a changed\n' )
+        self.assertEqual( run(), (False, [ 'updated' ]) )
+        self.assertEqual( run(), (True, []) )
+        os.unlink( 'fingerprint/project/out/a.txt' )
+        self.assertEqual( run(), (False, [ 'created' ]) )
+        ensure_dir( 'fingerprint/project/exodep-imports' )
+        to_file( 'fingerprint/project/exodep-imports/new.exodep', '' )
+        self.assertEqual( run(), (False, [ 'same' ]) )
+        self.assertEqual( run(), (True, []) )
+        time.sleep( 0.01 )
+        self.assertEqual( run( 0.001 ), (False, [ 'same' ]) )
+        to_file( 'fingerprint/project/mydeps.exodep', 'hosting local\nget src/not-there.txt out/\n' )
+        self.assertEqual( run(), (False, [ 'error' ]) )
+        self.assertEqual( run(), (False, [ 'error' ]) )
+
+    def test_link(self):
+        ensure_dir( 'link/src' )
+        to_file( 'link/src/a.bin', 'a' )
+        recipe = 'hosting local\nbget link/src/a.bin link/p1/\nbget link/src/a.bin link/p2/\n'
+        exodep.Session( link='hardlink', force_link=True, cache_dir='link/cache' ).run( io.StringIO( recipe ) )
+        cached = glob.glob( 'link/cache/objects/*/*' )
+        self.assertEqual( len( cached ), 1 )
+        self.assertEqual( os.stat( cached[0] ).st_mode & 0o222, 0 )     # Read-only, to protect the cache
+        self.assertEqual( os.stat( cached[0] ).st_ino, os.stat( 'link/p1/a.bin' ).st_ino )
+        self.assertEqual( os.stat( cached[0] ).st_ino, os.stat( 'link/p2/a.bin' ).st_ino )
+
+        to_file( 'link/edit.bin', 'edited' )
+        exodep.Session( cache_dir='link/cache' ).run( io.StringIO( 'cp link/edit.bin link/p1/a.bin\n' ) )
+        for file in [ cached[0], 'link/p2/a.bin' ]:     # The link is replaced, rather than written through
+            with open( file ) as fin:
+                self.assertEqual( fin.read(), 'a' )
+        os.unlink( 'link/p1/a.bin' )
+
+        if exodep.is_superuser():   # Root can write through a read-only link, so files are copied unless forced
+            output = []
+            exodep.Session( output=output.append, link='hardlink', cache_dir='link/cache' ).run( io.StringIO( recipe ) )
+            self.assertNotEqual( os.stat( cached[0] ).st_ino, os.stat( 'link/p1/a.bin' ).st_ino )
+            self.assertTrue( output[0].startswith( 'Warning: --link hardlink is not used when running as root' ) )
+
+        to_file( 'link/src/a.bin', 'a changed' )
+        result = exodep.Session( link='symlink', force_link=True, cache_dir='link/cache' ).run( io.StringIO( recipe ) )
+        self.assertEqual( [a['outcome'] for a in result.actions], [ 'updated', 'updated' ] )
+        self.assertTrue( os.path.islink( 'link/p1/a.bin' ) )
+        with open( 'link/p2/a.bin' ) as fin:
+            self.assertEqual( fin.read(), 'a changed' )
+        with open( cached[0] ) as fin:
+            self.assertEqual( fin.read(), 'a' )
+
+        to_file( 'link/src/a.bin', 'a reflinked' )
+        exodep.Session( link='reflink', cache_dir='link/cache' ).run( io.StringIO( recipe ) )     # Falls back to copying if not supported
+        self.assertFalse( os.path.islink( 'link/p1/a.bin' ) )
+        with open( 'link/p1/a.bin' ) as fin:
+            self.assertEqual( fin.read(), 'a reflinked' )
+        self.assertEqual( len( glob.glob( 'link/cache/objects/*/*' ) ), 3 )
+
+        os.chmod( cached[0], 0o644 )
+        to_file( cached[0], 'x' )   # A corrupted object of the right size is replaced rather than linked to
+        to_file( 'link/src/a.bin', 'a' )
+        exodep.Session( link='hardlink', force_link=True, cache_dir='link/cache' ).run( io.StringIO( recipe ) )
+        with open( 'link/p1/a.bin' ) as fin:
+            self.assertEqual( fin.read(), 'a' )
+        with open( cached[0] ) as fin:
+            self.assertEqual( fin.read(), 'a' )
+
+    def test_bundle(self):
+        ensure_dir( 'bundle/src' )
+        to_file( 'bundle/src/a.txt', 'a\n' )
+        to_file( 'bundle/src/b.bin', 'b' )
+        to_file( 'bundle/src/versions.exodep', 'master alpha\n' )
+        with LocalServer() as server:
+            recipe = 'uritemplate ' + server.uri + 'bundle/src/${file}\nauthority recipe.exodep\nversions\nget a.txt bundle/dst/\nbget b.bin bundle/dst/\n'
+            to_file( 'bundle/recipe.exodep', recipe )
+            to_file( 'bundle/src/recipe.exodep', recipe )
+            with exodep.Session( bundle_create='bundle/out.tar' ) as session:
+                session.run( 'bundle/recipe.exodep' )
+        with tarfile.open( 'bundle/out.tar' ) as tar:
+            self.assertEqual( tar.getnames()[0], 'index.json' )
+            self.assertEqual( len( tar.getnames() ), 5 )
+        shutil.rmtree( 'bundle/dst' )
+
+        with exodep.Session( bundle='bundle/out.tar' ) as session:
+            result = session.run( 'bundle/recipe.exodep' )
+        self.assertEqual( result.errors, [] )
+        self.assertEqual( [a['outcome'] for a in result.actions], [ 'same', 'fetched', 'created', 'created' ] )
+        with open( 'bundle/dst/b.bin' ) as fin:
+            self.assertEqual( fin.read(), 'b' )
+        with exodep.Session( bundle='bundle/out.tar' ) as session:
+            result = session.run( io.StringIO( 'get ' + server.uri + 'bundle/src/not-bundled.txt bundle/dst/\n' ) )
+        self.assertEqual( [a['outcome'] for a in result.actions], [ 'error' ] )
+
+        with tarfile.open( 'bundle/out.tar' ) as tar, tarfile.open( 'bundle/tampered.tar', 'w' ) as tampered:
+            for member in tar:
+                data = tar.extractfile( member ).read()
+                if data == b'a\n':
+                    data = b'x\n'
+                member.size = len( data )
+                tampered.addfile( member, io.BytesIO( data ) )
+        with exodep.Session( bundle='bundle/tampered.tar' ) as session:
+            result = session.run( io.StringIO( 'get ' + server.uri + 'bundle/src/a.txt bundle/tampered/\nbget ' + server.uri + 'bundle/src/b.bin bundle/tampered/\n' ) )
+        self.assertEqual( [a['outcome'] for a in result.actions], [ 'error', 'created' ] )
+        self.assertTrue( 'Bundled body does not match its digest: ' + server.uri + 'bundle/src/a.txt' in result.errors )
+        self.assertFalse( os.path.exists( 'bundle/tampered/a.txt' ) )
+
+        args = exodep.process_bundle_command_line_args( [ 'create', 'out.tar', '--quiet', 'mydeps.exodep' ] )
+        self.assertEqual( (args.bundle_create, args.recipe, args.verbosity), ('out.tar', 'mydeps.exodep', 'quiet') )
+
+    def test_journal(self):
+        ensure_dir( 'journal/src' )
+        to_file( 'journal/src/a.txt', 'a\n' )
+        to_file( 'journal/src/b.bin', 'b' )
+        to_file( 'journal/src/c.txt', 'c\n' )
+        for file in glob.glob( 'journal/src/*' ):
+            os.utime( file, (time.time() - 100, time.time() - 100) )    # So that changes show in the 1s resolution of Last-Modified
+        def interrupt_at_c( line ):
+            if line.startswith( 'Created' ) and 'c.txt' in line:
+                raise KeyboardInterrupt()
+        with LocalServer() as server:
+            recipe = io.StringIO( 'uritemplate ' + server.uri + 'journal/src/${file}\nget a.txt journal/dst/\nbget b.bin journal/dst/\nget c.txt journal/dst/\n' )
+            with self.assertRaises( KeyboardInterrupt ):
+                exodep.Session( output=interrupt_at_c, staging_dir='journal/staging' ).run( recipe )
+            self.assertEqual( server.request_count, 3 )
+            staged = {}
+            with open( 'journal/staging/journal.ndjson' ) as fin:
+                for line in fin:
+                    entry = json.loads( line )
+                    staged[entry['uri'].rsplit( '/', 1 )[1]] = entry['tmp']
+            self.assertEqual( sorted( staged.keys() ), [ 'a.txt', 'b.bin', 'c.txt' ] )
+            to_file( staged['b.bin'], 'corrupted' )
+            to_file( 'journal/staging/exodep-999999999-orphan', 'x' )
+            to_file( 'journal/src/c.txt', 'c changed\n' )
+            shutil.rmtree( 'journal/dst' )
+
+            recipe.seek( 0 )
+            server.httpd.statuses = {}
+            with exodep.Session( staging_dir='journal/staging', bundle_create='journal/out.tar' ) as session:
+                result = session.run( recipe )
+            self.assertEqual( result.errors, [] )
+            # a is revalidated and resumed, b's staged file is corrupt so it is fetched again, and c has changed since it was staged
+            self.assertEqual( server.httpd.statuses, { '/journal/src/a.txt': 304, '/journal/src/b.bin': 200, '/journal/src/c.txt': 200 } )
+        self.assertTrue( filecmp.cmp( 'journal/src/a.txt', 'journal/dst/a.txt' ) )
+        with open( 'journal/dst/b.bin' ) as fin:
+            self.assertEqual( fin.read(), 'b' )
+        self.assertTrue( filecmp.cmp( 'journal/src/c.txt', 'journal/dst/c.txt' ) )
+        self.assertFalse( os.path.exists( 'journal/staging' ) )
+        with tarfile.open( 'journal/out.tar' ) as tar:    # The resumed body is bundled, even though it wasn't fetched again
+            index = json.load( tar.extractfile( 'index.json' ) )['objects']
+            self.assertEqual( sorted( uri.rsplit( '/', 1 )[1] for uri in index ), [ 'a.txt', 'b.bin', 'c.txt' ] )
+            self.assertEqual( len( tar.getnames() ), 4 )
+
     def test_download(self):
         make_ProcessDeps( "uritemplate https://raw.githubusercontent.com/codalogic/exodep/master/test/${file}\n" +
                             "get dl-test-target.txt download/" )
@@ -266,6 +914,58 @@ class MyTest(unittest.TestCase):
         make_ProcessDeps( "bget https://raw.githubusercontent.com/codalogic/exodep/master/test/dl-test-target.txt download/bget-file.txt" )
         self.assertTrue( os.path.isfile( 'download/bget-file.txt' ) )
 
+    def test_getdir(self):
+        ensure_dir( 'getdir-src/sub' )
+        ensure_dir( 'getdir-dst' )
+        to_file( 'getdir-src/a.txt', 'a\n' )
+        to_file( 'getdir-src/b.h', 'b\n' )
+        to_file( 'getdir-src/sub/c.txt', 'c\n' )
+        to_file( 'getdir-dst/stale.txt', 'stale\n' )
+        pd = make_ProcessDeps( 'hosting local\ngetdir getdir-src/ getdir-dst/dir/\nonlastchanged $changed 1\n' )
+        self.assertTrue( filecmp.cmp( 'getdir-src/sub/c.txt', 'getdir-dst/dir/sub/c.txt' ) )
+        self.assertTrue( 'changed' in pd.vars )
+
+        to_file( 'getdir-src/a.txt', 'a changed\n' )
+        pd = make_ProcessDeps( 'hosting local\ngetdir getdir-src getdir-dst prune\n' )
+        self.assertTrue( filecmp.cmp( 'getdir-src/a.txt', 'getdir-dst/a.txt' ) )
+        self.assertFalse( os.path.isfile( 'getdir-dst/stale.txt' ) )
+        self.assertFalse( os.path.isfile( 'getdir-dst/dir/sub/c.txt' ) )
+
+        pd = make_ProcessDeps( 'hosting local\ngetdir getdir-src getdir-dst prune\nonlastchanged $changed 1\n' )
+        self.assertTrue( 'changed' not in pd.vars )
+
+        make_ProcessDeps( 'hosting local\nget getdir-src/*.txt getdir-dst/wild/\n' )
+        self.assertTrue( os.path.isfile( 'getdir-dst/wild/a.txt' ) )
+        self.assertFalse( os.path.isfile( 'getdir-dst/wild/b.h' ) )
+
+        result = exodep.Session().run( io.StringIO( 'hosting local\nget getdir-src/sub/*.txt\n' ) )
+        self.assertEqual( result.errors, [] )
+        self.assertFalse( os.path.exists( 'getdir-src/sub/*.txt' ) )     # Without a destination, files stay where the pattern is
+
+        ensure_dir( 'getdir-dst/empty' )
+        result = exodep.Session().run( io.StringIO( 'hosting local\nget getdir-src/*.none getdir-dst/wild/\ngetdir getdir-dst/empty getdir-dst/copy\n' ) )
+        self.assertEqual( len( result.errors ), 2 )
+        self.assertFalse( os.path.exists( 'getdir-dst/copy' ) )
+
+        with LocalServer() as server:
+            result = exodep.Session().run( io.StringIO( 'get ' + server.uri + 'dl-test-target.txt?raw=true getdir-dst/query.txt\n' ) )
+            self.assertEqual( server.httpd.paths, [ '/dl-test-target.txt?raw=true' ] )
+        self.assertEqual( result.errors, [] )
+        self.assertTrue( filecmp.cmp( 'dl-test-target.txt', 'getdir-dst/query.txt' ) )
+
+    def test_download_fan_out(self):
+        with LocalServer() as server:
+            make_ProcessDeps( 'uritemplate ' + server.uri + '${file}\n' +
+                                'get dl-test-target.txt download/fan-out-1/\n' +
+                                'get dl-test-target.txt download/fan-out-2/\n' +
+                                'get dl-test-target.txt download/fan-out-2/\n' +
+                                'bget dl-test-target.txt download/fan-out-3/\n' )
+            self.assertEqual( server.request_count, 2 )     # One text and one binary fetch
+        self.assertTrue( filecmp.cmp( 'dl-test-target.txt', 'download/fan-out-1/dl-test-target.txt' ) )
+        self.assertTrue( filecmp.cmp( 'dl-test-target.txt', 'download/fan-out-2/dl-test-target.txt' ) )
+        self.assertTrue( filecmp.cmp( 'dl-test-target.txt', 'download/fan-out-3/dl-test-target.txt' ) )
+        self.assertEqual( exodep.get_default_session().fetched_files, {} )    # Not kept once processing is complete
+
     def test_local_file_copying(self):
         make_ProcessDeps( "uritemplate ./${file}\ncopy dl-test-target.txt download/dl-test-target4.txt" )
         self.assertTrue( filecmp.cmp( 'dl-test-target.txt', 'download/dl-test-target4.txt' ) )
@@ -475,21 +1175,162 @@ class MyTest(unittest.TestCase):
                             'linux exec mv ${path}/exec_file2.txt download/exec_renamed_file2.txt' )
         self.assertTrue( os.path.isfile( 'download/exec_renamed_file2.txt' ) )
 
+    def test_exec_subprocess(self):
+        ensure_dir( 'exec-test' )
+        wait_for = lambda file: '[time.sleep( 0.05 ) for i in range( 200 ) if not os.path.exists( \'' + file + '\' )]; '
+        to_file( 'exec-test/exec-test.exodep',
+                '$py ' + sys.executable + '\n' +
+                'exec& ${py} -c "import os, time; ' + wait_for( 'bg2.txt' ) + 'os.path.exists( \'bg2.txt\' ) and open( \'bg1.txt\', \'w\' ).close()"\n' +
+                'exec& ${py} -c "open( \'bg2.txt\', \'w\' ).close()"\n' +
+                'execwait\n' +
+                'exec ${py} -c "import os, sys, time; print( \'first\', flush=True ); ' + wait_for( 'seen.txt' ) +
+                        'print( \'second\' if os.path.exists( \'seen.txt\' ) else \'late\' ); sys.exit( 3 )"\n' )
+        output = []
+        def note_output( line ):
+            output.append( line )
+            if line.endswith( '] first' ):
+                to_file( 'exec-test/seen.txt', '' )     # Only seen in time if output is shown while the command runs
+        session = exodep.Session( output=note_output )
+        exodep.ProcessDeps( 'exec-test/exec-test.exodep', exodep.default_vars, session )
+        self.assertTrue( os.path.isfile( 'exec-test/bg1.txt' ) )  # Background commands run concurrently, in the exodep file's directory
+        self.assertTrue( os.path.isfile( 'exec-test/bg2.txt' ) )
+        self.assertEqual( [line for line in output if line.startswith( '[exec-test.exodep:5]' )],
+                            [ '[exec-test.exodep:5] first', '[exec-test.exodep:5] second' ] )
+        self.assertTrue( 'exited with status 3' in session.alert_messages )
+
+    def test_execmemo(self):
+        ensure_dir( 'execmemo' )
+        to_file( 'execmemo/in.txt', 'a' )
+        to_file( 'execmemo/gen.exodep',
+                '$py ' + sys.executable + '\n' +
+                'execmemo in.txt,*.def out.txt ${py} -c "open( \'out.txt\', \'a\' ).write( open( \'in.txt\' ).read() )"\n' )
+        def run():
+            with exodep.Session( state_file='execmemo/state.json' ) as session:
+                result = session.run( 'execmemo/gen.exodep' )
+            with open( 'execmemo/out.txt' ) as fin:
+                return (result.actions[0]['outcome'], fin.read())
+
+        self.assertEqual( run(), ('ok', 'a') )
+        self.assertEqual( run(), ('cached', 'a') )
+        to_file( 'execmemo/in.txt', 'b' )
+        self.assertEqual( run(), ('ok', 'ab') )
+        self.assertEqual( run(), ('cached', 'ab') )
+        to_file( 'execmemo/x.def', '' )
+        self.assertEqual( run(), ('ok', 'abb') )
+        os.unlink( 'execmemo/out.txt' )
+        self.assertEqual( run(), ('ok', 'b') )
+        self.assertEqual( run(), ('cached', 'b') )
+
+    def test_output_levels(self):
+        ensure_dir( 'output-levels' )
+        to_file( 'output-levels/levels-test.exodep',
+                'hosting local\n' +
+                'get dl-test-target.txt output-levels/\n' +
+                'echo Hello\n' +
+                'alert Levels alert\n' +
+                'get not-a-file.txt output-levels/\n' )
+        outputs = {}
+        for verbosity in [ 'quiet', 'summary', 'normal', 'verbose' ]:
+            outputs[verbosity] = []
+            exodep.Session( output=outputs[verbosity].append, verbosity=verbosity ).run( 'output-levels/levels-test.exodep' )
+        for verbosity in [ 'quiet', 'summary', 'normal', 'verbose' ]:
+            self.assertTrue( [line for line in outputs[verbosity] if line.startswith( 'ALERT:' )] )
+            self.assertTrue( 'Error: output-levels/levels-test.exodep, line 5:' in outputs[verbosity] )
+        self.assertFalse( 'Hello' in outputs['quiet'] )
+        self.assertTrue( 'Hello' in outputs['summary'] )
+        self.assertFalse( [line for line in outputs['summary'] if line.startswith( 'Same......' )] )
+        self.assertTrue( 'Same...... output-levels/dl-test-target.txt' in outputs['normal'] )
+        self.assertTrue( [line for line in outputs['summary'] if line.startswith( 'Summary... 1 same, 1 errors, 1 alerts in ' )] )
+        self.assertFalse( [line for line in outputs['normal'] if line.startswith( 'Summary...' )] )
+        self.assertTrue( [line for line in outputs['verbose'] if line.startswith( 'Get....... not-a-file.txt (error, ' )] )
+
+        stream = io.StringIO()
+        console = exodep.Console( stream )
+        console( 'line 1' )
+        console( 'line 2' )
+        self.assertEqual( stream.getvalue(), '' )     # Held back until flushed
+        console.flush()
+        self.assertEqual( stream.getvalue(), 'line 1\nline 2\n' )
+        console( 'line 3' )
+        for i in range( 100 ):  # Written out by a timer, without waiting for more output or an explicit flush
+            if stream.getvalue().endswith( 'line 3\n' ):
+                break
+            time.sleep( 0.05 )
+        self.assertEqual( stream.getvalue(), 'line 1\nline 2\nline 3\n' )
+
+    def test_lazy_imports(self):
+        ensure_dir( 'lazy' )
+        to_file( 'lazy/lazy-test.exodep', '$x 1\ntouch lazy/lazy.txt\n' )
+        proc = subprocess.run( [ sys.executable, '-X', 'importtime', exodep_py, 'lazy/lazy-test.exodep' ],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True )
+        self.assertTrue( os.path.isfile( 'lazy/lazy.txt' ) )
+        imported = [line.split( '|' )[-1].strip() for line in proc.stderr.splitlines() if line.startswith( 'import time:' )]
+        for module in [ 'urllib.request', 'http.client', 'ssl', 'tempfile', 'subprocess', 'concurrent.futures', 'json' ]:
+            self.assertFalse( module in imported, module + " imported by a run that does not need it" )
+
+    def test_session(self):
+        ensure_dir( 'session' )
+        to_file( 'session/session-test.exodep',
+                'hosting local\n' +
+                'get dl-test-target.txt session/\n' +
+                'get not-a-file.txt session/\n' +
+                'alert Session alert\n' )
+        output = []
+        session = exodep.Session( output=output.append )
+        result = session.run( 'session/session-test.exodep' )
+        self.assertEqual( result.changed(), [ 'session/dl-test-target.txt' ] )
+        self.assertEqual( [(a['command'], a['outcome']) for a in result.actions], [ ('get', 'created'), ('get', 'error') ] )
+        self.assertEqual( len( result.errors ), 1 )
+        self.assertEqual( len( result.alerts ), 1 )
+        self.assertTrue( 'Created... session/dl-test-target.txt' in output )
+
+        result = session.run( 'session/session-test.exodep' )     # Sessions can be re-run without carrying over results
+        self.assertEqual( result.changed(), [] )
+        self.assertEqual( [a['outcome'] for a in result.actions], [ 'same', 'error' ] )
+        self.assertEqual( len( result.alerts ), 1 )
+        self.assertFalse( result.is_stopped )
+
+    def test_session_roots(self):
+        # Embedded sessions don't change the working directory or write to stdout
+        ensure_dir( 'session-roots/a/sub' )
+        to_file( 'session-roots/a/mydeps.exodep', 'uritemplate ${file}\nget source.txt sub/\nonfile sub/source.txt touch found.txt\n' )
+        to_file( 'session-roots/a/source.txt', 'Some text\n' )
+        to_file( 'session-roots/state', 'Not a directory\n' )
+        output = []
+        cwds = set()
+        def note_output( line ):
+            output.append( line )
+            cwds.add( os.getcwd() )
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout( stdout ):
+            session = exodep.Session( output=note_output, state_file='session-roots/state/state.json', fingerprint_ttl=60 )
+            result = session.run( None, [ 'session-roots/a' ] )
+            session.close()
+        self.assertEqual( cwds, { os.getcwd() } )
+        self.assertEqual( result.changed(), [ 'session-roots/a/sub/source.txt' ] )
+        self.assertTrue( os.path.isfile( 'session-roots/a/found.txt' ) )
+        self.assertTrue( 'Error: Unable to write state file: session-roots/state/state.json' in output )
+        self.assertEqual( stdout.getvalue(), '' )
+
     def test_alert(self):
         # This requires visual inspection!
-        self.assertTrue( exodep.ProcessDeps.alert_messages == "" )
+        session = exodep.Session( output=print )
+        self.assertEqual( session.results.alerts, [] )
         if not os.path.isdir( 'alerts' ):
             os.mkdir( 'alerts' )
         rm( 'alerts/alerts.txt.old' )
-        pd = make_ProcessDeps( 'uritemplate https://raw.githubusercontent.com/codalogic/exodep/master/test/${file}\n' +
+        to_file( 'alerts/alerts.txt', 'Alerts from an earlier run\n' )
+        pd = exodep.ProcessDeps( io.StringIO( 'uritemplate https://raw.githubusercontent.com/codalogic/exodep/master/test/${file}\n' +
                             'alert This is an ALERT ${strand}\n' +
                             'alert Another ALERT\n' +
                             'onalerts $has_alerts 1\n' +
                             'showalerts\n' +
                             'alert Even more alert\n' +
                             'alert Still more alerts\n' +
-                            'alertstofile alerts/alerts.txt\n' )
-        self.assertTrue( exodep.ProcessDeps.alert_messages == "ALERT: <StringIO> (6):\n       Even more alert\nALERT: <StringIO> (7):\n       Still more alerts" )
+                            'alertstofile alerts/alerts.txt\n' ), exodep.default_vars, session )
+        self.assertEqual( len( session.results.alerts ), 4 )
+        self.assertEqual( session.results.alerts[2:], [ "ALERT: <StringIO> (6):\n       Even more alert", "ALERT: <StringIO> (7):\n       Still more alerts" ] )
+        self.assertTrue( session.alert_messages == "ALERT: <StringIO> (6):\n       Even more alert\nALERT: <StringIO> (7):\n       Still more alerts" )   # Not yet shown by showalerts
         self.assertTrue( 'has_alerts' in pd.vars )
         self.assertTrue( os.path.isfile( 'alerts/alerts.txt.old' ) )
         self.assertTrue( os.path.isfile( 'alerts/alerts.txt' ) )
@@ -715,6 +1556,48 @@ class MyTest(unittest.TestCase):
     # def test_error_visually(self):
     #     make_ProcessDeps( '# blank line\n\ninclude woops' )
 
+class LocalServer:
+    # Serves the test directory over HTTP so that download behaviour can be tested without network access
+    def __init__( self, delays = None ):
+        self.delays = delays if delays else {}     # Each entry is <request path> : <list of delays for successive requests>
+
+    def __enter__( self ):
+        handler = functools.partial( QuietHTTPRequestHandler, directory=os.getcwd() )
+        self.httpd = http.server.ThreadingHTTPServer( ('127.0.0.1', 0), handler )
+        self.uri = 'http://127.0.0.1:' + str( self.httpd.server_address[1] ) + '/'
+        self.httpd.request_count = 0
+        self.httpd.paths = []
+        self.httpd.statuses = {}    # Each entry is <request path> : <status of the last response>
+        self.httpd.delays = self.delays
+        self.httpd.handle_error = lambda request, client_address: None     # Clients abandoning hedged requests is expected
+        threading.Thread( target=self.httpd.serve_forever, daemon=True ).start()
+        return self
+
+    @property
+    def request_count( self ):
+        return self.httpd.request_count
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        return False
+
+class QuietHTTPRequestHandler( http.server.SimpleHTTPRequestHandler ):
+    def do_GET( self ):
+        self.server.request_count += 1
+        self.server.paths.append( self.path )
+        delays = self.server.delays.get( self.path )
+        if delays:
+            time.sleep( delays.pop( 0 ) )
+        super().do_GET()
+
+    def send_response( self, code, message = None ):
+        self.server.statuses[self.path] = code
+        super().send_response( code, message )
+
+    def log_message( self, format, *args ):
+        pass
+
 def make_ProcessDeps( s ):
     return exodep.ProcessDeps( io.StringIO( s ) )
 